@@ -1,9 +1,10 @@
 import numpy as np
-from scipy import linalg
 
-class GaussianProcess:
+class GaussianProcess(object):
     def compute_rho_corr_func_point(self, a, b, this_rho):
-        """Compute correlation between two points a and b."""
+        """Compute correlation between two points a and b. This is the
+        reference implementation of the kernel, the actual computations use the
+        vectorized `compute_rho_corr_tensor`."""
         corr = np.prod(this_rho**(4 * (a - b)**2))
         return corr
 
@@ -11,9 +12,38 @@ class GaussianProcess:
     def compute_rho_corr_func(self, a, b, this_rho):
         """Compute rho correlation function between two vectors a and b.
         Returns kernel matrix [len(a), len(b)]."""
-        corr_matrix = [self.compute_rho_corr_func_point(a[i], b[j], this_rho)
-            for i in range(a.shape[0]) for j in range(b.shape[0])]
-        return np.array(corr_matrix).reshape(a.shape[0], -1)
+        return self.compute_rho_corr_tensor(a, b, this_rho[None,:])[0]
+
+
+    @staticmethod
+    def compute_sq_dist(a, b):
+        """Compute the squared distances between two sets of points a and b
+        along each input dimension.
+        Returns tensor [len(a), len(b), N_dim_input]."""
+        return (a[:,None,:] - b[None,:,:])**2
+
+
+    def compute_rho_corr_tensor(self, a, b, rho):
+        """Compute rho correlation function between two vectors a and b for
+        a set of correlation lengths rho [N_output, N_dim_input].
+        Returns kernel tensor [N_output, len(a), len(b)]."""
+        return self.corr_from_sq_dist(self.compute_sq_dist(a, b), np.log(rho))
+
+
+    @staticmethod
+    def corr_from_sq_dist(sq_dist, log_rho):
+        """Evaluate the kernel prod(rho**(4*d**2)) as exp(4*log(rho).d**2)
+        for all outputs at once.
+        Parameters
+        ----------
+            sq_dist: squared distances [..., N_dim_input]
+            log_rho: log of correlation lengths [N_output, N_dim_input]
+        Returns
+        -------
+            kernel tensor [N_output, ...]
+        """
+        log_corr = np.dot(sq_dist, 4 * log_rho.T)
+        return np.exp(np.moveaxis(log_corr, -1, 0))
 
 
     def __init__(self, x, y, cov_n, prec_f, rho, compute_lnlike=False):
@@ -30,6 +60,9 @@ class GaussianProcess:
         -------
             None
         """
+        # Imported here such that importing the package does not load scipy
+        from scipy import linalg
+
         self.N_data = len(x)
         self.N_dim_input = x.shape[1]
         self.N_output = y.shape[1]
@@ -51,16 +84,20 @@ class GaussianProcess:
         self.prec_f = prec_f
         self.y_flat = y.flatten(order='F')
 
-        # Correlation matrix
+        self.log_rho = np.log(rho)
+
+        # Correlation matrix, all outputs from a single squared-distance tensor
+        corr_x_x = self.corr_from_sq_dist(self.compute_sq_dist(x, x), self.log_rho)
         self.corrmat = np.zeros((self.N_output*self.N_data, self.N_output*self.N_data))
         for i in range(self.N_output):
-            self.corrmat[i*self.N_data:(i+1)*self.N_data, i*self.N_data:(i+1)*self.N_data] = self.compute_rho_corr_func(x, x, self.corr_rho[i])/self.prec_f[i]
+            self.corrmat[i*self.N_data:(i+1)*self.N_data, i*self.N_data:(i+1)*self.N_data] = corr_x_x[i]/self.prec_f[i]
         try:
             self.cholesky_factor = linalg.cho_factor(self.corrmat + cov_n)
         except:
             print("Could not compute Cholesky decomposition")
             return
         self.Krig_basis = linalg.cho_solve(self.cholesky_factor, self.y_flat)
+        self.set_up_predictive_operators()
 
         if compute_lnlike:
             chi_squared = np.matmul(self.y_flat.T, self.Krig_basis)
@@ -68,6 +105,88 @@ class GaussianProcess:
             self.lnlike = -.5 * chi_squared - .5 * ln_corrmat_det
 
 
+    @classmethod
+    def from_factorization(cls, x, prec_f, rho, cholesky_factor, Krig_basis, predictive_operator=None):
+        """Set up a GP from a pre-computed Cholesky decomposition and Krig
+        basis (e.g., loaded from a cache), skipping the factorization
+        performed in `__init__`.
+        Parameters
+        ----------
+            x: design points [N_data, N_dim_input]
+            prec_f: precision of the GP
+            rho: CP correlation length [N_output, N_dim_input]
+            cholesky_factor: Cholesky decomposition as returned by
+                scipy.linalg.cho_factor
+            Krig_basis: [N_output*N_data]
+            predictive_operator: (optional) as computed by
+                `set_up_predictive_operators` [N_output, N_data,
+                N_output*N_data], computed from `cholesky_factor` if not
+                provided
+        Returns
+        -------
+            GaussianProcess
+        """
+        self = cls.__new__(cls)
+        self.N_data = len(x)
+        self.N_dim_input = x.shape[1]
+        self.N_output = len(prec_f)
+        if rho.shape!=(self.N_output, self.N_dim_input):
+            raise TypeError("Shape of correlation lengths (%d,%d) must be (%d,%d)"%(
+                rho.shape[0], rho.shape[1], self.N_output, self.N_dim_input))
+        if len(Krig_basis)!=self.N_output*self.N_data:
+            raise TypeError("len(Krig_basis) %d must be %d"%(len(Krig_basis), self.N_output*self.N_data))
+        self.x = x
+        self.corr_rho = rho
+        self.log_rho = np.log(rho)
+        self.prec_f = prec_f
+        self.cholesky_factor = cholesky_factor
+        self.Krig_basis = Krig_basis
+        self.set_up_predictive_operators(predictive_operator)
+        return self
+
+
+    def set_up_predictive_operators(self, predictive_operator=None):
+        """Pre-compute the operators that map the kernel between a new point
+        and the design points onto the predictive mean and covariance.
+
+        The kernel vector k_i of output i is zero outside of block i, so only
+        the N_output blocks [N_data] of nonzero kernel values are needed. With
+        the Cholesky decomposition corrmat + cov_n = U^T U, the predictive
+        covariance between outputs i and j is
+        delta_ij/prec_f_i - (U^-T k_i).(U^-T k_j), and U^-T k_i only depends
+        on rows (block i) of U^-1. These rows, divided by prec_f_i, are
+        computed once, such that predictions only need matrix products and no
+        triangular solves.
+        Parameters
+        ----------
+            predictive_operator: (optional) pre-computed operator
+                [N_output, N_data, N_output*N_data]
+        Returns
+        -------
+            None
+        """
+        # Weights of the kernel blocks for the mean [N_output, N_data]
+        self.mean_weights = np.reshape(self.Krig_basis, (self.N_output, self.N_data)) / self.prec_f[:,None]
+
+        N = self.N_output*self.N_data
+        if predictive_operator is None:
+            from scipy import linalg
+
+            factor, lower = self.cholesky_factor
+            inv_factor = linalg.solve_triangular(factor, np.eye(N), lower=lower)
+            if lower:
+                inv_factor = inv_factor.T
+            else:
+                inv_factor = np.triu(inv_factor)
+            predictive_operator = (inv_factor / np.repeat(self.prec_f, self.N_data)[:,None]).reshape(
+                self.N_output, self.N_data, N)
+        elif predictive_operator.shape!=(self.N_output, self.N_data, N):
+            raise TypeError("Shape of predictive operator %s must be (%d,%d,%d)"%(
+                predictive_operator.shape, self.N_output, self.N_data, N))
+        # Block rows of U^-1 [N_output, N_data, N_output*N_data]
+        self.predictive_operator = predictive_operator
+
+
     def predict(self, x_new):
         """
         Parameters: evaluation points [N_dim_input]
@@ -77,18 +196,187 @@ class GaussianProcess:
         if len(x_new)!=self.N_dim_input:
             raise TypeError("Evaluation points %s needs to be shape %d"%(len(x_new), self.N_dim_input))
 
-        # Correlation with design input [N_output, N_data]
-        corr_xnew_x = np.zeros((self.N_output, self.N_output*self.N_data))
-        for i in range(self.N_output):
-            corr_xnew_x[i,i*self.N_data:(i+1)*self.N_data] = [self.compute_rho_corr_func_point(x_new, self.x[j], self.corr_rho[i])
-                                                              for j in range(self.N_data)]
-        corr_xnew_x/= self.prec_f[:,None]
+        eval_mean, eval_covmat = self.predict_batch(np.atleast_2d(x_new))
+        return eval_mean[0], eval_covmat[0]
+
+
+    def predict_gradient(self, x_new):
+        """
+        Parameters: evaluation points [N_dim_input]
+        Returns: (mean [N_output], derivative of the mean with respect to the
+            evaluation point [N_output, N_dim_input])
+        """
+
+        if len(x_new)!=self.N_dim_input:
+            raise TypeError("Evaluation points %s needs to be shape %d"%(len(x_new), self.N_dim_input))
+
+        # The derivative of prod(rho**(4*(x_new-x)**2)) with respect to x_new
+        # is the kernel times 8*log(rho)*(x_new-x)
+        diff = x_new - self.x
+        corr_blocks = self.corr_from_sq_dist(diff**2, self.log_rho)
+        weighted_corr = corr_blocks * self.mean_weights
+
+        eval_mean = np.sum(weighted_corr, axis=1)
+        eval_grad = 8 * self.log_rho * np.dot(weighted_corr, diff)
+
+        return eval_mean, eval_grad
+
+
+    def predict_batch(self, x_new):
+        """
+        Parameters: evaluation points [N_eval, N_dim_input]
+        Returns: (mean [N_eval, N_output], variance [N_eval, N_output, N_output])
+        """
+
+        if x_new.ndim!=2 or x_new.shape[1]!=self.N_dim_input:
+            raise TypeError("Evaluation points %s needs to be shape (N, %d)"%(x_new.shape, self.N_dim_input))
+
+        # Nonzero blocks of the correlation with the design input
+        # [N_output, N_eval, N_data]
+        corr_blocks = self.corr_from_sq_dist(self.compute_sq_dist(x_new, self.x), self.log_rho)
+
+        # Mean prediction
+        eval_mean = np.einsum('ien,in->ei', corr_blocks, self.mean_weights)
+
+        # Variance from the projections U^-T k_i of all outputs
+        # [N_eval, N_output, N_output*N_data]
+        projected = np.swapaxes(np.matmul(corr_blocks, self.predictive_operator), 0, 1)
+        eval_covmat = np.diag(1./self.prec_f) - np.matmul(projected, np.swapaxes(projected, 1, 2))
+
+        return eval_mean, eval_covmat
+
+
+class StackedGaussianProcess(object):
+    def __init__(self, processes, predictive_operator=None):
+        """Stack Gaussian processes that share the same design points (e.g.,
+        the GPs of all emulator redshifts) such that they are evaluated
+        together: the squared distances to the design points are computed
+        once, and the kernels, means, and covariances of all GPs follow from
+        a few batched matrix products.
+        Parameters
+        ----------
+            processes: list of GaussianProcess with identical design points
+                and number of outputs
+            predictive_operator: (optional) stacked predictive operators
+                [N_stack, N_output, N_data, N_output*N_data] of the GPs
+                (e.g., memory-mapped), stacked from `processes` if not
+                provided
+        Returns
+        -------
+            None
+        """
+        self.x = processes[0].x
+        self.N_stack = len(processes)
+        self.N_data, self.N_dim_input = self.x.shape
+        self.N_output = processes[0].N_output
+        for GPreg in processes[1:]:
+            if GPreg.N_output!=self.N_output:
+                raise TypeError("All GPs must have %d outputs"%self.N_output)
+            if GPreg.x.shape!=self.x.shape or not np.array_equal(GPreg.x, self.x):
+                raise TypeError("All GPs must share the same design points")
+
+        # Hyperparameters and operators along the stack axis
+        self.prec_f = np.array([GPreg.prec_f for GPreg in processes])
+        self.log_rho = np.array([GPreg.log_rho for GPreg in processes])
+        self.mean_weights = np.array([GPreg.mean_weights for GPreg in processes])
+        shape = (self.N_stack, self.N_output, self.N_data, self.N_output*self.N_data)
+        if predictive_operator is None:
+            predictive_operator = np.array([GPreg.predictive_operator for GPreg in processes])
+        elif predictive_operator.shape!=shape:
+            raise TypeError("Shape of predictive operator %s must be %s"%(predictive_operator.shape, shape))
+        self.predictive_operator = predictive_operator
+
+
+    def predict(self, x_new, stack_ids=None):
+        """
+        Parameters: evaluation points [N_dim_input], (optional) slice or
+            indices of the GPs to evaluate, default all
+        Returns: (mean [N_stack, N_output],
+            variance [N_stack, N_output, N_output])
+        """
+
+        if len(x_new)!=self.N_dim_input:
+            raise TypeError("Evaluation points %s needs to be shape %d"%(len(x_new), self.N_dim_input))
+
+        eval_mean, eval_covmat = self.predict_batch(np.atleast_2d(x_new), stack_ids)
+        return eval_mean[:,0], eval_covmat[:,0]
+
+
+    def predict_batch(self, x_new, stack_ids=None):
+        """
+        Parameters: evaluation points [N_eval, N_dim_input], (optional) slice
+            or indices of the GPs to evaluate, default all. A slice avoids
+            copying the operators.
+        Returns: (mean [N_stack, N_eval, N_output],
+            variance [N_stack, N_eval, N_output, N_output])
+        """
+
+        return self.predict_from_kernel_exponent(self.kernel_exponent(x_new, stack_ids), stack_ids)
+
+
+    def kernel_exponent(self, x_new, stack_ids=None):
+        """Log of the nonzero kernel blocks, sum_d 4*log(rho_d)*(x_new_d-x_d)**2,
+        of all GPs from one squared-distance tensor.
+        Parameters
+        ----------
+            x_new: evaluation points [N_eval, N_dim_input]
+            stack_ids: (optional) slice or indices of the GPs, default all
+        Returns
+        -------
+            kernel exponent [N_stack, N_output, N_eval, N_data]
+        """
+        if x_new.ndim!=2 or x_new.shape[1]!=self.N_dim_input:
+            raise TypeError("Evaluation points %s needs to be shape (N, %d)"%(x_new.shape, self.N_dim_input))
+        if stack_ids is None:
+            stack_ids = slice(None)
+        log_rho = self.log_rho[stack_ids]
+        N_stack, N_eval = len(log_rho), len(x_new)
+        sq_dist = GaussianProcess.compute_sq_dist(x_new, self.x)
+        log_corr = np.dot(sq_dist, 4 * log_rho.reshape(-1, self.N_dim_input).T)
+        return log_corr.reshape(N_eval, self.N_data, N_stack, self.N_output).transpose(2, 3, 0, 1)
+
+
+    def update_kernel_exponent(self, exponent, x_old, x_new, dims):
+        """Update the kernel exponent of all GPs (see `kernel_exponent`) in
+        place for a move of a single evaluation point from `x_old` to `x_new`
+        that only changes the input dimensions `dims`. Each dimension
+        contributes an additive term, so only these terms are recomputed.
+        Parameters
+        ----------
+            exponent: kernel exponent [N_stack, N_output, 1, N_data]
+            x_old, x_new: evaluation points [N_dim_input]
+            dims: input dimensions that differ between x_old and x_new
+        Returns
+        -------
+            None
+        """
+        for d in dims:
+            delta = (x_new[d] - self.x[:,d])**2 - (x_old[d] - self.x[:,d])**2
+            exponent+= (4 * self.log_rho[:,:,d])[:,:,None,None] * delta
+
+
+    def predict_from_kernel_exponent(self, exponent, stack_ids=None):
+        """
+        Parameters: kernel exponent [N_stack, N_output, N_eval, N_data] (see
+            `kernel_exponent`) of the GPs `stack_ids` (optional slice or
+            indices, default all)
+        Returns: (mean [N_stack, N_eval, N_output],
+            variance [N_stack, N_eval, N_output, N_output])
+        """
+
+        if stack_ids is None:
+            stack_ids = slice(None)
+
+        # Nonzero blocks of the correlation with the design input of all GPs
+        # [N_stack, N_output, N_eval, N_data]
+        corr_blocks = np.exp(exponent)
 
         # Mean prediction
-        eval_mean = np.dot(corr_xnew_x, self.Krig_basis)
+        eval_mean = np.einsum('sien,sin->sei', corr_blocks, self.mean_weights[stack_ids])
 
-        # Variance
-        v = linalg.cho_solve(self.cholesky_factor, corr_xnew_x.T)
-        eval_covmat = np.diag(1./self.prec_f) - np.dot(corr_xnew_x, v)
+        # Variance, see `GaussianProcess.set_up_predictive_operators`
+        projected = np.swapaxes(np.matmul(corr_blocks, self.predictive_operator[stack_ids]), 1, 2)
+        eval_covmat = -np.matmul(projected, np.swapaxes(projected, 2, 3))
+        eval_covmat+= (np.eye(self.N_output) / self.prec_f[stack_ids][:,None,:])[:,None]
 
         return eval_mean, eval_covmat
@@ -1,13 +1,18 @@
 import numpy as np
 import os
-import inspect
 
-from scipy.interpolate import RectBivariateSpline
 
+from . import cache
 from . import GP_matrix as GP
+from .instrumentation import Stats
+from .memo import LRUMemo
+from . import sampling
+from .plan import EvaluationPlan
+from .session import Session
+from . import shared
 
 
-class Emulator:
+class Emulator(object):
     """The Mira-Titan Universe emulator for the halo mass function.
 
     Attributes
@@ -16,9 +21,16 @@ class Emulator:
         Lower and upper limits of the cosmological parameters.
     z_arr : array
         Redshifts of the emulator output.
+    stats : Stats
+        Wall time and number of calls of the stages of the emulator, per
+        emulator redshift. Only recorded if enabled, see `instrument`.
     """
     # Cosmology parameters
     param_names = ['Ommh2', 'Ombh2', 'Omnuh2', 'n_s', 'h', 'sigma_8', 'w_0', 'w_b']
+    # User-facing cosmology parameters, in the column order of parameter arrays
+    input_param_names = ['Ommh2', 'Ombh2', 'Omnuh2', 'n_s', 'h', 'sigma_8', 'w_0', 'w_a']
+    # Alternative parameter names without underscores
+    param_aliases = [('w_0', 'w0'), ('w_a', 'wa'), ('n_s', 'ns'), ('sigma_8', 'sigma8')]
     param_limits = {
         'Ommh2': (.12, .155),
         'Ombh2': (.0215, .0235),
@@ -32,42 +44,355 @@ class Emulator:
     # Emulator redshifts
     z_arr = np.array([2.02, 1.61, 1.01, 0.656, 0.434, 0.242, 0.101, 0.0])
     z_arr_asc = z_arr[::-1]
+    # Masses of the emulator output, log10(M [Msun/h])
+    log10_M_arr = np.linspace(13, 16, 3001)
 
 
 
-    def __init__(self):
-        """No arguments are required when initializing an `Emulator` instance.
-        Upon initialization, a bunch of matrix operations are performed which
-        takes a few seconds."""
-        data_path = os.path.join(os.path.dirname(os.path.abspath(inspect.stack()[0][1])), 'data')
+    def __init__(self, cache_dir=None, lazy=False, memo_size=0, memo_tol=1e-12, memo_max_bytes=None,
+                 instrument=False, dtype=np.float64, draw_chunk_size=1024, data_path=None):
+        """Upon initialization, the covariance matrices of the underlying
+        Gaussian processes are set up and factorized.
 
+        :param cache_dir: Directory in which these factorizations are cached
+            such that later initializations load them from disk instead of
+            recomputing them. The cache is keyed by the content of the emulator
+            data files and the package version. Defaults to the environment
+            variable `MIRATITAN_HMF_CACHE_DIR`; if neither is set, nothing is
+            cached.
+        :type cache_dir: str, optional
+
+        :param lazy: If True, the Gaussian processes and PCA bases are only set
+            up when an emulator redshift is first used, and `predict` only
+            evaluates the emulator redshifts required for the requested
+            redshifts. A lazy emulator reads an existing cache but does not
+            write to it. Default is False.
+        :type lazy: bool, optional
+
+        :param memo_size: Number of cosmologies for which the output of
+            `predict_raw_emu` (and therefore `predict`) is kept in memory: the
+            GP mean and covariance and the tables of the mass function and its
+            error estimates of each emulator redshift. A repeated call with the
+            same cosmology and the same `N_draw` then reuses the GP output and
+            the tables, including the same error estimate, also for other
+            redshifts or masses (e.g., different `z` and `m` grids) within the
+            stored mass range. Tables are extended to a wider mass range when
+            needed, which draws new error realizations. Calls with
+            `return_draws` reuse the GP output but always draw new realizations
+            and return their statistics, which are not stored. Calls with
+            `rng`, `std_normals`, or `draws_dir` are never memoized. Default
+            is 0 (off). See also `memo_info`.
+        :type memo_size: int, optional
+
+        :param memo_tol: Cosmologies whose normalized parameters agree to
+            within this tolerance are considered identical. Default is 1e-12.
+        :type memo_tol: float, optional
+
+        :param memo_max_bytes: Upper limit on the memory taken up by the stored
+            outputs. Default is no limit beyond `memo_size`.
+        :type memo_max_bytes: int, optional
+
+        :param instrument: If True, record the wall time and number of calls
+            of each stage of the prediction in `stats`. Recording can also be
+            switched on later with `stats.enable()` or within
+            `with emu.stats.recording():`. Default is False.
+        :type instrument: bool, optional
+
+        :param dtype: Floating point precision of the PCA bases, the GP
+            predictions, the mass function realizations, and the interpolation
+            tables, `numpy.float64` (default) or `numpy.float32`. The GP
+            covariance matrices and their Cholesky decompositions are always
+            kept in double precision. Single precision halves the memory
+            traffic of the PCA reconstruction and of the error realizations.
+            Compared to the reference outputs of the test suite, the mass
+            function changes by about 1e-6 (relative) and the error estimates
+            by about 1e-5 (relative), far below the percent-level emulator
+            uncertainty.
+        :type dtype: numpy dtype, optional
+
+        :param draw_chunk_size: Number of mass function realizations per
+            emulator redshift that are generated at once when computing error
+            estimates with `error_method='sample'`. Their mean and standard
+            deviation are accumulated chunk by chunk, such that the memory use
+            does not grow with `N_draw`. Default is 1024.
+        :type draw_chunk_size: int, optional
+
+        :param data_path: Directory of the emulator data, e.g., written by
+            `training.build_data_dir`. Default is the data of the Mira-Titan
+            emulator shipped with the package.
+        :type data_path: str, optional
+        """
+        package_path = os.path.dirname(os.path.abspath(__file__))
+        if data_path is None:
+            data_path = os.path.join(package_path, 'data')
+        self.__data_path = data_path
+        self.__lazy = lazy
+        self.__set_up_settings(memo_size, memo_tol, memo_max_bytes, instrument, dtype, draw_chunk_size)
+
+        # PCA standardization parameters
+        self.__GP_means = np.load(os.path.join(self.__data_path, 'GP_params_mean.npy')).astype(self.__dtype)
+        self.__GP_std = np.load(os.path.join(self.__data_path, 'GP_params_std.npy')).astype(self.__dtype)
+        self.__facs = np.load(os.path.join(self.__data_path, 'facs.npy'))
+
+        # GP input data
+        self.__GP_filenames = [os.path.join(self.__data_path, '%s.npy'%name)
+                               for name in ['params_design_w0wb', 'hyperparams', 'means', 'cov_n']]
+        self.__params_design = np.load(self.__GP_filenames[0])
+        self.__hyper_params = np.load(self.__GP_filenames[1])
+        self.__N_PC = np.load(self.__GP_filenames[2], mmap_mode='r').shape[2]
+
+        # Load GP factorizations from cache if possible
+        cache_dir = cache.get_cache_dir(cache_dir)
+        self.__factorization = None
+        if cache_dir is not None:
+            cache_key = cache.cache_key([os.path.join(package_path, 'VERSION')] + self.__GP_filenames)
+            factorization_names = ['%s_%d'%(name, z_id) for z_id in range(len(self.z_arr))
+                                   for name in ['cholesky_factor', 'Krig_basis', 'predictive_operator']]
+            self.__factorization = cache.load(cache_dir, cache_key, factorization_names)
+
+        # Basis functions, PCA means, and GPs for each emulator redshift
+        self.__PCA_means = [None] * len(self.z_arr)
+        self.__PCA_transform = [None] * len(self.z_arr)
+        self.__GPreg = [None] * len(self.z_arr)
+        self.__stacked_GP = None
+        if lazy:
+            return
+        self.__require_z_ids(range(len(self.z_arr)))
+
+        if cache_dir is not None and self.__factorization is None:
+            # GaussianProcess uses the upper triangular Cholesky factor
+            factorization = {}
+            for z_id,GPreg in enumerate(self.__GPreg):
+                factorization['cholesky_factor_%d'%z_id] = GPreg.cholesky_factor[0]
+                factorization['Krig_basis_%d'%z_id] = GPreg.Krig_basis
+                factorization['predictive_operator_%d'%z_id] = GPreg.predictive_operator
+            cache.save(cache_dir, cache_key, factorization)
+
+
+    def __set_up_settings(self, memo_size, memo_tol, memo_max_bytes, instrument, dtype, draw_chunk_size):
+        """Set up everything that does not depend on the emulator data."""
+        self.__memo = LRUMemo(memo_size, memo_max_bytes) if memo_size>0 else None
+        if draw_chunk_size<1:
+            raise ValueError("draw_chunk_size must be positive but is %s"%draw_chunk_size)
+        self.__draw_chunk_size = int(draw_chunk_size)
+        self.__memo_tol = memo_tol
+        self.__dtype = np.dtype(dtype)
+        if self.__dtype not in [np.float32, np.float64]:
+            raise ValueError("dtype must be float32 or float64 but is %s"%self.__dtype)
+        self.stats = Stats(enabled=instrument)
+
+        # Parameter limits in the order of param_names, for array input
+        self.__param_lower = np.array([self.param_limits[param][0] for param in self.param_names])
+        self.__param_upper = np.array([self.param_limits[param][1] for param in self.param_names])
+        self.__i_w_0 = self.input_param_names.index('w_0')
+        self.__i_w_a = self.input_param_names.index('w_a')
+
+
+    def to_shared(self, directory=None):
+        """Write the state of the emulator (PCA bases, GP factorizations, and
+        design) to a single memory-mapped file, from which other processes can
+        set up an emulator with `attach` without reading the emulator data or
+        factorizing any matrices. All processes that attach to the same file
+        share one copy of the data in memory.
+
+        :param directory: Directory of the file. Defaults to `/dev/shm`
+            (shared memory) if available, otherwise the temporary directory.
+        :type directory: str, optional
+
+        :returns: Handle of the state, which can be pickled and passed to other
+            processes. The caller is responsible for deleting the file with
+            `unlink` once it is no longer needed (or for using the handle as a
+            context manager).
+        :rtype: SharedState
+        """
+        self.__require_z_ids(range(len(self.z_arr)))
+        arrays = {'GP_means': self.__GP_means, 'GP_std': self.__GP_std, 'facs': self.__facs,
+                  'params_design': self.__params_design, 'hyper_params': self.__hyper_params}
+        for z_id in range(len(self.z_arr)):
+            arrays['PCA_means_%d'%z_id] = self.__PCA_means[z_id]
+            arrays['PCA_transform_%d'%z_id] = self.__PCA_transform[z_id]
+            arrays['cholesky_factor_%d'%z_id] = self.__GPreg[z_id].cholesky_factor[0]
+            arrays['Krig_basis_%d'%z_id] = self.__GPreg[z_id].Krig_basis
+        arrays['predictive_operator'] = self.__stacked_GP.predictive_operator
+        settings = {'dtype': self.__dtype.str, 'N_PC': self.__N_PC,
+                    'lower': [bool(GPreg.cholesky_factor[1]) for GPreg in self.__GPreg]}
+        return shared.create(arrays, settings, directory)
+
+
+    @classmethod
+    def attach(cls, handle, memo_size=0, memo_tol=1e-12, memo_max_bytes=None, instrument=False,
+               draw_chunk_size=1024):
+        """Set up an emulator from the state written by `to_shared`, e.g., in
+        a worker process. The arrays are memory-mapped read-only and not
+        copied. All emulator redshifts are set up (the emulator is not lazy).
+        The precision (`dtype`) is that of the emulator that wrote the state,
+        the other parameters are as in `Emulator`.
+
+        :param handle: Handle returned by `to_shared`.
+        :type handle: SharedState
+
+        :rtype: Emulator
+        """
+        self = cls.__new__(cls)
+        self.__data_path = None
+        self.__lazy = False
+        self.__set_up_settings(memo_size, memo_tol, memo_max_bytes, instrument, handle.settings['dtype'],
+                               draw_chunk_size)
+
+        arrays = handle.load()
+        self.__GP_means = arrays['GP_means']
+        self.__GP_std = arrays['GP_std']
+        self.__facs = arrays['facs']
+        self.__GP_filenames = None
+        self.__params_design = arrays['params_design']
+        self.__hyper_params = arrays['hyper_params']
+        self.__N_PC = handle.settings['N_PC']
+        self.__factorization = None
+
+        self.__PCA_means = [arrays['PCA_means_%d'%z_id] for z_id in range(len(self.z_arr))]
+        self.__PCA_transform = [arrays['PCA_transform_%d'%z_id] for z_id in range(len(self.z_arr))]
+        self.__GPreg = []
+        for z_id in range(len(self.z_arr)):
+            prec_f = self.__hyper_params[z_id,:self.__N_PC]
+            rho = self.__hyper_params[z_id,self.__N_PC:].reshape(self.__N_PC,-1)
+            self.__GPreg.append(GP.GaussianProcess.from_factorization(
+                self.__params_design, prec_f, rho,
+                (arrays['cholesky_factor_%d'%z_id], handle.settings['lower'][z_id]),
+                arrays['Krig_basis_%d'%z_id], arrays['predictive_operator'][z_id]))
+        self.__stacked_GP = GP.StackedGaussianProcess(self.__GPreg, arrays['predictive_operator'])
+        return self
+
+
+    def __require_z_ids(self, z_ids):
+        """Set up the PCA basis and the GP for those emulator redshifts (given
+        as indices into `z_arr`) that have not been set up yet."""
+        for z_id in z_ids:
+            if self.__GPreg[z_id] is not None:
+                continue
+            with self.stats.timer('setup', self.z_arr[z_id]):
+                self.__set_up_z_id(z_id)
+
+        # Once all GPs are set up, they are evaluated together. The GPs of
+        # the individual redshifts then use views of the stacked operators.
+        if self.__stacked_GP is None and all(GPreg is not None for GPreg in self.__GPreg):
+            with self.stats.timer('setup'):
+                self.__stacked_GP = GP.StackedGaussianProcess(self.__GPreg)
+                for z_id,GPreg in enumerate(self.__GPreg):
+                    GPreg.predictive_operator = self.__stacked_GP.predictive_operator[z_id]
+
+
+    def __set_up_z_id(self, z_id):
+        """Set up the PCA basis and the GP for one emulator redshift."""
         # Basis functions and PCA standardization parameters
         # They have different lengths so they are stored in separate files
-        self.__PCA_means, self.__PCA_transform = [], []
-        for i in range(len(self.z_arr)):
-            filename = os.path.join(data_path, 'PCA_mean_std_transform_%d.npy'%i)
-            _tmp = np.load(filename)
-            self.__PCA_means.append(_tmp[0,:])
-            self.__PCA_transform.append(_tmp[1:,:])
-        self.__GP_means = np.load(os.path.join(data_path, 'GP_params_mean.npy'))
-        self.__GP_std = np.load(os.path.join(data_path, 'GP_params_std.npy'))
-        self.__facs = np.load(os.path.join(data_path, 'facs.npy'))
+        _tmp = np.load(os.path.join(self.__data_path, 'PCA_mean_std_transform_%d.npy'%z_id)).astype(self.__dtype, copy=False)
+        self.__PCA_means[z_id] = _tmp[0,:]
+        self.__PCA_transform[z_id] = _tmp[1:,:]
 
-        # GP input data
-        params_design = np.load(os.path.join(data_path, 'params_design_w0wb.npy'))
-        hyper_params = np.load(os.path.join(data_path, 'hyperparams.npy'))
-        input_means = np.load(os.path.join(data_path, 'means.npy'))
-        cov_mat_data = np.load(os.path.join(data_path, 'cov_n.npy'))
-        N_PC = input_means.shape[2]
-        self.__GPreg = [GP.GaussianProcess(params_design,
-                                           input_means[z_id],
-                                           cov_mat_data[z_id],
-                                           hyper_params[z_id,:N_PC],
-                                           hyper_params[z_id,N_PC:].reshape(N_PC,-1))
-                        for z_id in range(len(self.z_arr))]
-
-
-    def predict(self, requested_cosmology, z, m, get_errors=True, N_draw=1000):
+        prec_f = self.__hyper_params[z_id,:self.__N_PC]
+        rho = self.__hyper_params[z_id,self.__N_PC:].reshape(self.__N_PC,-1)
+        if self.__factorization is not None:
+            self.__GPreg[z_id] = GP.GaussianProcess.from_factorization(self.__params_design, prec_f, rho,
+                                                                       (self.__factorization['cholesky_factor_%d'%z_id], False),
+                                                                       self.__factorization['Krig_basis_%d'%z_id],
+                                                                       self.__factorization['predictive_operator_%d'%z_id])
+        else:
+            input_means = np.load(self.__GP_filenames[2], mmap_mode='r')[z_id]
+            cov_mat_data = np.load(self.__GP_filenames[3], mmap_mode='r')[z_id]
+            self.__GPreg[z_id] = GP.GaussianProcess(self.__params_design,
+                                                    np.array(input_means),
+                                                    np.array(cov_mat_data),
+                                                    prec_f, rho)
+
+
+    def __z_ids(self, z_emu):
+        """Indices into `z_arr` of the emulator redshifts `z_emu` (all if
+        None), in the order of `z_arr`."""
+        if z_emu is None:
+            return list(range(len(self.z_arr)))
+        z_emu = np.atleast_1d(z_emu)
+        is_requested = np.isclose(self.z_arr[:,None], z_emu[None,:], rtol=0, atol=1e-6)
+        if not np.all(np.any(is_requested, axis=0)):
+            raise ValueError("z_emu must be a subset of the emulator redshifts %s"%self.z_arr)
+        return list(np.flatnonzero(np.any(is_requested, axis=1)))
+
+
+    def __predict_GP(self, z_ids, x, session=None):
+        """GP mean and covariance (including the factors `facs`) at the
+        emulator redshifts `z_ids` (indices into `z_arr`) for the normalized
+        parameters x [N, 8]. All redshifts are evaluated together once the
+        stacked GP is set up. With a `session`, the kernel of a single
+        cosmology is updated from the previous evaluation.
+
+        :returns: Dictionaries {z_id: mean [N, N_PC]} and
+            {z_id: covariance [N, N_PC, N_PC]}.
+        :rtype: tuple
+        """
+        z_ids = list(z_ids)
+        wstar, wstar_covmat = {}, {}
+        if self.__stacked_GP is not None and (len(z_ids)>1 or session is not None):
+            # Consecutive redshifts (the usual case) select views of the
+            # stacked operators
+            stack_ids = z_ids
+            if z_ids==list(range(z_ids[0], z_ids[-1]+1)):
+                stack_ids = slice(z_ids[0], z_ids[-1]+1)
+            with self.stats.timer('gp'):
+                if session is None:
+                    mean, covmat = self.__stacked_GP.predict_batch(x, stack_ids)
+                else:
+                    exponent = session.kernel_exponent(x[0])[stack_ids]
+                    mean, covmat = self.__stacked_GP.predict_from_kernel_exponent(exponent, stack_ids)
+                for k,i in enumerate(z_ids):
+                    wstar[i] = mean[k].astype(self.__dtype, copy=False)
+                    wstar_covmat[i] = covmat[k] * self.__facs[i]
+            return wstar, wstar_covmat
+        for i in z_ids:
+            with self.stats.timer('gp', self.z_arr[i]):
+                wstar[i], wstar_covmat[i] = self.__GPreg[i].predict_batch(x)
+                wstar[i] = wstar[i].astype(self.__dtype, copy=False)
+                wstar_covmat[i]*= self.__facs[i]
+        return wstar, wstar_covmat
+
+
+    def evaluation_plan(self, z, m):
+        """Set up the interpolation from the emulator output to a fixed set
+        of redshifts and masses. Passing the plan to `predict` or
+        `predict_batch` instead of `z` and `m` avoids repeating this set-up
+        when the same redshifts and masses are used many times.
+
+        :param z: The redshift(s) for which the mass function is requested.
+        :type z: float or array
+
+        :param m: The mass(es) for which the mass function is requested, in
+            units [Msun/h].
+        :type z: float or array
+
+        :rtype: EvaluationPlan
+        """
+        return EvaluationPlan(self.z_arr_asc, self.log10_M_arr, z, m)
+
+
+    def __get_plan(self, z, m, plan):
+        """Return `plan`, or a new plan for `z` and `m`."""
+        if plan is None:
+            if z is None or m is None:
+                raise TypeError("Either z and m or a plan must be provided")
+            return self.evaluation_plan(z, m)
+        if z is not None or m is not None:
+            raise TypeError("Provide either z and m or a plan, not both")
+        return plan
+
+
+    def __plan_z_emu(self, plan, get_errors):
+        """Emulator redshifts to evaluate for `plan`: in lazy mode only those
+        that contribute to the requested redshifts, otherwise all (None)."""
+        if not self.__lazy:
+            return None
+        return self.z_arr_asc[plan.z_ids_err if get_errors else plan.z_ids]
+
+
+    def predict(self, requested_cosmology, z=None, m=None, get_errors=True, N_draw=1000, plan=None,
+                rng=None, std_normals=None, error_method='sample', session=None):
         """Emulate the halo mass function dn/dlnM for the desired set of
         cosmology parameters, redshifts, and masses.
 
@@ -91,6 +416,35 @@ class Emulator:
             error estimate. Applies only if `get_errors` is `True`.
         :type N_draw: int, optional
 
+        :param plan: Evaluation plan (see `evaluation_plan`) that replaces `z`
+            and `m`.
+        :type plan: EvaluationPlan, optional
+
+        :param rng: Random number generator (`numpy.random.Generator` or
+            `numpy.random.RandomState`) or seed used for the error
+            realizations. If neither `rng` nor `std_normals` is provided, the
+            realizations are drawn from numpy's global random number generator.
+        :type rng: Generator or int, optional
+
+        :param std_normals: Standard normal draws with shape
+            [len(z_arr), N_draw, N_PC] (see `draw_standard_normals`) to use for
+            the error realizations instead of new random numbers. Reusing the
+            same draws for different cosmologies (common random numbers) makes
+            the error estimate a smooth function of the cosmology.
+        :type std_normals: array, optional
+
+        :param error_method: How to compute the error estimate: `'sample'`
+            draws `N_draw` mass functions from the emulator posterior
+            distribution, `'analytic'` propagates the GP covariance through the
+            (log-linear) PCA reconstruction in closed form, which is much
+            faster. Default is `'sample'`.
+        :type error_method: str, optional
+
+        :param session: Kernel state of a sequence of evaluations (see
+            `session`), which speeds up evaluations that change only a few
+            parameters with respect to the previous one.
+        :type session: Session, optional
+
         Returns
         -------
         HMF: array_like
@@ -103,57 +457,246 @@ class Emulator:
             weighted errors from the neighboring redshifts are added in
             quadrature.
         """
-        # Validate requested z and m
-        if np.any(z<0):
-            raise ValueError("z must be >= 0")
-        if np.any(z>self.z_arr_asc[-1]):
-            raise ValueError("z must be <= 2.02")
-        if np.any(m<1e13):
-            raise ValueError("m must be >= 1e13")
-        if np.any(m>1e16):
-            raise ValueError("m must be <= 1e16")
-        z = np.atleast_1d(z)
-        m = np.atleast_1d(m)
+        plan = self.__get_plan(z, m, plan)
 
         # Do we want error estimates?
         if not get_errors:
             N_draw = 0
+            error_method = 'sample'
 
-        # Call the actual emulator
-        emu_dict = self.predict_raw_emu(requested_cosmology, N_draw=N_draw)
+        # Call the actual emulator, only for the masses that contribute to the
+        # requested masses
+        log10_M_range = self.log10_M_arr[[plan.M_window[0], plan.M_window[1]-1]]
+        emu_dict = self.predict_raw_emu(requested_cosmology, N_draw=N_draw, z_emu=self.__plan_z_emu(plan, get_errors),
+                                        rng=rng, std_normals=std_normals, error_method=error_method,
+                                        log10_M_range=log10_M_range, session=session)
 
-        # Set up interpolation grids
-        HMF_interp_input = np.log(np.nextafter(0,1)) * np.ones((len(self.z_arr_asc), 3001))
-        for i,emu_z in enumerate(self.z_arr_asc):
-            HMF_interp_input[i,:len(emu_dict[emu_z]['HMF'])] = np.log(emu_dict[emu_z]['HMF'])
-        HMF_interp = RectBivariateSpline(self.z_arr_asc, np.linspace(13, 16, 3001), HMF_interp_input, kx=1, ky=1)
-
-        if get_errors:
-            HMFerr_interp_input = np.zeros((len(self.z_arr_asc), 3001))
+        # Tables of the emulator output, emulator redshifts that were not
+        # evaluated do not contribute to the interpolation
+        with self.stats.timer('interpolate'):
+            N_M = plan.M_window[1] - plan.M_window[0]
+            HMF_table = np.log(np.nextafter(0,1)) * np.ones((len(self.z_arr_asc), N_M), dtype=self.__dtype)
             for i,emu_z in enumerate(self.z_arr_asc):
-                HMFerr_interp_input[i,:len(emu_dict[emu_z]['HMF_std'])] = emu_dict[emu_z]['HMF_std']
-            HMFerr_interp = RectBivariateSpline(self.z_arr_asc, np.linspace(13, 16, 3001), HMFerr_interp_input, kx=1, ky=1)
+                if emu_z in emu_dict:
+                    HMF_table[i,:len(emu_dict[emu_z]['HMF'])] = np.log(emu_dict[emu_z]['HMF'])
+            HMF_out = np.exp(plan.interpolate(HMF_table))
+
+            HMFerr_out = np.zeros((len(plan.z), len(plan.m)))
+            if get_errors:
+                HMFerr_table = np.zeros((len(self.z_arr_asc), N_M), dtype=self.__dtype)
+                for i,emu_z in enumerate(self.z_arr_asc):
+                    if emu_z in emu_dict:
+                        HMFerr_table[i,:len(emu_dict[emu_z]['HMF_std'])] = emu_dict[emu_z]['HMF_std']
+                HMFerr_out = plan.combine_errors(HMFerr_table)
 
+        return HMF_out, HMFerr_out
 
-        # Call interpolation at input z and m
-        HMF_out = np.exp(HMF_interp(z, np.log10(m)))
 
-        HMFerr_out = np.zeros((len(z), len(m)))
-        if get_errors:
-            # First interpolate to requested m
-            HMFerr_at_m = HMFerr_interp(self.z_arr_asc, np.log10(m))
-            # Now add weighted errors in quadrature
-            for z_id,this_z in enumerate(z):
-                z_id_nearest = np.argsort(np.abs(self.z_arr_asc-this_z))[:2]
-                Delta_z = (this_z - self.z_arr_asc[z_id_nearest])/np.diff(self.z_arr_asc[z_id_nearest])
-                HMFerr_out[z_id] = np.sqrt((HMFerr_at_m[z_id_nearest[0],:]*Delta_z[0])**2 + (HMFerr_at_m[z_id_nearest[1],:]*Delta_z[1])**2)
+    def predict_batch(self, cosmologies, z=None, m=None, get_errors=True, N_draw=1000, plan=None,
+                      rng=None, std_normals=None, error_method='sample'):
+        """Emulate the halo mass function dn/dlnM for a set of cosmologies at
+        once. The GP predictions, the PCA reconstruction, and the interpolation
+        to the requested redshifts and masses are performed as array
+        operations over the whole batch.
+
+        :param cosmologies: The N sets of cosmology parameters for which the
+            mass function is requested. Either a structured array (or a list of
+            dictionaries) with the parameters `Ommh2`, `Ombh2`, `Omnuh2`,
+            `n_s`, `h`, `sigma_8`, `w_0`, `w_a`, or an array of shape [N, 8]
+            with the parameters in this order (see `input_param_names`).
+        :type cosmologies: array or list
+
+        :param z: The redshift(s) for which the mass function is requested.
+        :type z: float or array
+
+        :param m: The mass(es) for which the mass function is requested, in
+            units [Msun/h].
+        :type z: float or array
+
+        :param get_errors: Whether or not to compute error estimates (faster in
+            the latter case). Default is `True`.
+        :type get_errors:  bool, optional
+
+        :param N_draw: How many sample mass functions to draw when computing the
+            error estimate. Applies only if `get_errors` is `True`.
+        :type N_draw: int, optional
+
+        :param plan: Evaluation plan (see `evaluation_plan`) that replaces `z`
+            and `m`.
+        :type plan: EvaluationPlan, optional
+
+        :param rng: Random number generator (`numpy.random.Generator` or
+            `numpy.random.RandomState`) or seed used for the error
+            realizations. If neither `rng` nor `std_normals` is provided, the
+            realizations are drawn from numpy's global random number generator.
+        :type rng: Generator or int, optional
+
+        :param std_normals: Standard normal draws with shape
+            [len(z_arr), N_draw, N_PC] (see `draw_standard_normals`) to use for
+            the error realizations instead of new random numbers. Reusing the
+            same draws for different cosmologies (common random numbers) makes
+            the error estimate a smooth function of the cosmology.
+        :type std_normals: array, optional
+
+        :param error_method: How to compute the error estimate: `'sample'`
+            draws `N_draw` mass functions from the emulator posterior
+            distribution, `'analytic'` propagates the GP covariance through the
+            (log-linear) PCA reconstruction in closed form, which is much
+            faster. Default is `'sample'`.
+        :type error_method: str, optional
+
+        Returns
+        -------
+        HMF: array_like
+            The mass function dN/dlnM in units[(h/Mpc)^3] and with shape
+            [N, len(z), len(m)].
+        HMF_rel_err: array_like
+            The relative error on dN/dlnM, with shape [N, len(z), len(m)]. Zero
+            if `get_errors` is `False`. The errors are computed as in
+            `predict`. The random numbers are drawn in the same order as in a
+            sequence of `predict` calls, and `std_normals` are used for every
+            cosmology.
+        """
+        plan = self.__get_plan(z, m, plan)
+        self.__check_error_method(error_method)
+
+        # Validate and normalize requested cosmologies
+        with self.stats.timer('validate'):
+            params_normed = self.__normalize_param_array(self.__param_array(cosmologies))
+
+        return self.predict_normalized(params_normed, get_errors=get_errors, N_draw=N_draw, plan=plan,
+                                       rng=rng, std_normals=std_normals, error_method=error_method)
+
+
+    def predict_normalized(self, x, z=None, m=None, get_errors=True, N_draw=1000, plan=None,
+                           rng=None, std_normals=None, error_method='sample'):
+        """Emulate the halo mass function dn/dlnM for a set of normalized
+        parameter vectors as returned by `normalize`. The parameters are not
+        validated, which avoids any per-call overhead beyond the emulation
+        itself. All other arguments and the return values are as in
+        `predict_batch`.
+
+        :param x: Normalized parameters [N, 8] (see `param_names`), i.e., the
+            parameters mapped linearly from `param_limits` to [0, 1].
+        :type x: array
+        """
+        plan = self.__get_plan(z, m, plan)
+        self.__check_error_method(error_method)
+        params_normed = np.asarray(x, dtype=float)
+        if params_normed.ndim!=2 or params_normed.shape[1]!=len(self.param_names):
+            raise ValueError("Normalized parameter array must have shape (N, %d) but has shape %s"%(
+                len(self.param_names), params_normed.shape))
+        N_cosmo = len(params_normed)
+
+        # Emulator output for the masses that contribute to the requested
+        # masses, in ascending redshift order. In lazy mode, only for the
+        # emulator redshifts that contribute.
+        z_ids = self.__z_ids(self.__plan_z_emu(plan, get_errors))
+        self.__require_z_ids(z_ids)
+        N_M = plan.M_window[1] - plan.M_window[0]
+        log_HMF_table = np.log(np.nextafter(0,1)) * np.ones((N_cosmo, len(self.z_arr), N_M), dtype=self.__dtype)
+        wstar, wstar_covmat = self.__predict_GP(z_ids, params_normed)
+        for i in z_ids:
+            with self.stats.timer('pca', self.z_arr[i]):
+                cols = self.__M_cols(i, plan.M_window)
+                PC_weight = wstar[i] * self.__GP_std[i] + self.__GP_means[i]
+                log_HMF_table[:,-1-i,:cols.stop-cols.start] = np.dot(PC_weight, self.__PCA_transform[i][:,cols]) + self.__PCA_means[i][cols]
+        with self.stats.timer('interpolate'):
+            HMF_out = np.exp(plan.interpolate(log_HMF_table))
+
+        HMFerr_out = np.zeros((N_cosmo, len(plan.z), len(plan.m)))
+        if get_errors and error_method=='analytic':
+            HMFerr_table = np.zeros((N_cosmo, len(self.z_arr), N_M), dtype=self.__dtype)
+            for i in z_ids:
+                with self.stats.timer('analytic_errors', self.z_arr[i]):
+                    cols = self.__M_cols(i, plan.M_window)
+                    log_HMF_var = self.__log_HMF_variance(i, wstar_covmat[i], cols)
+                    HMFerr_table[:,-1-i,:cols.stop-cols.start] = np.sqrt(np.expm1(log_HMF_var))
+            with self.stats.timer('interpolate'):
+                HMFerr_out = plan.combine_errors(HMFerr_table)
+        elif get_errors:
+            rng = self.__check_random_input(rng, std_normals, N_draw)
+            HMFerr_table = np.zeros((N_cosmo, len(self.z_arr), N_M), dtype=self.__dtype)
+            for n in range(N_cosmo):
+                for i in z_ids:
+                    cols = self.__M_cols(i, plan.M_window)
+                    HMFerr_table[n,-1-i,:cols.stop-cols.start] = self.__HMF_draw_statistics(
+                        i, wstar[i][n], wstar_covmat[i][n], N_draw, rng, std_normals, cols)[1]
+            with self.stats.timer('interpolate'):
+                HMFerr_out = plan.combine_errors(HMFerr_table)
 
         return HMF_out, HMFerr_out
 
 
+    def predict_with_gradient(self, requested_cosmology, z=None, m=None, plan=None):
+        """Emulate the halo mass function dn/dlnM and its derivatives with
+        respect to the cosmology parameters. The derivatives are computed
+        analytically from the GP kernel and the PCA reconstruction, including
+        the parameter normalization and w_b = (-w_0 - w_a)**0.25.
+
+        :param requested_cosmology: The set of cosmology parameters for which
+            the mass function is requested. The parameters are `Ommh2`, `Ombh2`,
+            `Omnuh2`, `n_s`, `h`, `sigma_8`, `w_0`, `w_a`.
+        :type requested_cosmology: dict
+
+        :param z: The redshift(s) for which the mass function is requested.
+        :type z: float or array
+
+        :param m: The mass(es) for which the mass function is requested, in
+            units [Msun/h].
+        :type z: float or array
 
+        :param plan: Evaluation plan (see `evaluation_plan`) that replaces `z`
+            and `m`.
+        :type plan: EvaluationPlan, optional
 
-    def predict_raw_emu(self, requested_cosmology, N_draw=0, return_draws=False):
+        Returns
+        -------
+        HMF: array_like
+            The mass function dN/dlnM in units[(h/Mpc)^3] and with shape
+            [len(z), len(m)].
+        HMF_grad: array_like
+            The derivatives of dN/dlnM with respect to the parameters
+            `input_param_names`, with shape [len(z), len(m), 8].
+        """
+        plan = self.__get_plan(z, m, plan)
+        with self.stats.timer('validate'):
+            requested_cosmology_normed = self.__normalize_params(requested_cosmology)
+
+        # Derivatives of the normalized parameters (param_names) with respect
+        # to the user-facing parameters (input_param_names)
+        param_range = np.array([self.param_limits[param][1] - self.param_limits[param][0] for param in self.param_names])
+        dx_dtheta = np.diag(1./param_range)
+        dw_b = -.25 * (-requested_cosmology['w_0'] - requested_cosmology['w_a'])**-.75 / param_range[-1]
+        dx_dtheta[-1,-2:] = dw_b
+
+        z_ids = self.__z_ids(self.__plan_z_emu(plan, False))
+        self.__require_z_ids(z_ids)
+        N_M = plan.M_window[1] - plan.M_window[0]
+        log_HMF_table = np.log(np.nextafter(0,1)) * np.ones((len(self.z_arr), N_M), dtype=self.__dtype)
+        log_HMF_grad_table = np.zeros((len(self.param_names), len(self.z_arr), N_M), dtype=self.__dtype)
+        for i in z_ids:
+            with self.stats.timer('gp', self.z_arr[i]):
+                wstar, wstar_grad = self.__GPreg[i].predict_gradient(requested_cosmology_normed)
+                wstar = wstar.astype(self.__dtype, copy=False)
+                wstar_grad = wstar_grad.astype(self.__dtype, copy=False)
+            with self.stats.timer('pca', self.z_arr[i]):
+                cols = self.__M_cols(i, plan.M_window)
+                PC_weight = wstar * self.__GP_std[i] + self.__GP_means[i]
+                log_HMF_table[-1-i,:cols.stop-cols.start] = np.dot(PC_weight, self.__PCA_transform[i][:,cols]) + self.__PCA_means[i][cols]
+                PC_weight_grad = wstar_grad * self.__GP_std[i][:,None]
+                log_HMF_grad_table[:,-1-i,:cols.stop-cols.start] = np.dot(PC_weight_grad.T, self.__PCA_transform[i][:,cols])
+
+        with self.stats.timer('interpolate'):
+            HMF_out = np.exp(plan.interpolate(log_HMF_table))
+            log_HMF_grad = np.tensordot(plan.interpolate(log_HMF_grad_table), dx_dtheta, axes=(0, 0))
+
+        return HMF_out, HMF_out[:,:,None] * log_HMF_grad
+
+
+    def predict_raw_emu(self, requested_cosmology, N_draw=0, return_draws=False, z_emu=None,
+                        rng=None, std_normals=None, error_method='sample', log10_M_range=None, session=None,
+                        draws_dir=None):
         """Emulates the halo mass function dn/dlnM for the desired set of
         cosmology parameters and returns an output dictionary. This function
         allows the user to have more fine-grained control over the raw emulator
@@ -175,6 +718,49 @@ class Emulator:
             memory. Applies only if `N_draw` is > 0.
         :type return_draws: bool, optional
 
+        :param z_emu: The subset of the emulator redshifts `z_arr` for which
+            the output is computed. Default is all emulator redshifts.
+        :type z_emu: array, optional
+
+        :param rng: Random number generator (`numpy.random.Generator` or
+            `numpy.random.RandomState`) or seed used for the error
+            realizations. If neither `rng` nor `std_normals` is provided, the
+            realizations are drawn from numpy's global random number generator.
+        :type rng: Generator or int, optional
+
+        :param std_normals: Standard normal draws with shape
+            [len(z_arr), N_draw, N_PC] (see `draw_standard_normals`) to use for
+            the error realizations instead of new random numbers. Reusing the
+            same draws for different cosmologies (common random numbers) makes
+            the error estimate a smooth function of the cosmology.
+        :type std_normals: array, optional
+
+        :param error_method: With `'sample'`, `HMF_mean` and `HMF_std` are
+            computed from `N_draw` mass function draws. With `'analytic'`, they
+            are computed in closed form from the GP covariance, exploiting that
+            the log of the mass function is linear in the GP output such that
+            the mass function is log-normally distributed; `N_draw` and
+            `return_draws` are then ignored. Default is `'sample'`.
+        :type error_method: str, optional
+
+        :param log10_M_range: Range (min, max) of log10(mass [Msun/h]) for
+            which the output is computed. The output covers this range and the
+            neighboring points of the emulator mass grid (which are needed for
+            interpolation), only these are reconstructed from the PCA basis.
+            Default is all masses.
+        :type log10_M_range: tuple, optional
+
+        :param session: Kernel state of a sequence of evaluations (see
+            `session`).
+        :type session: Session, optional
+
+        :param draws_dir: If `return_draws` is True, write the draws of each
+            emulator redshift `z_arr[i]` to the file `HMF_draws_<i>.npy` in
+            this existing directory instead of keeping them in memory, and
+            return them as read-only memory-mapped arrays. Existing files are
+            overwritten.
+        :type draws_dir: str, optional
+
         :returns: A dictionary containing all the emulator output. A `readme`
             key describes the units: The mass functions are dn/dlnM [(h/Mpc)^3].
             The output is organized by redshift -- each dictionary key
@@ -191,11 +777,12 @@ class Emulator:
             HMF_mean: array_like, optional
                 The mass function corresponding to the mean of the mass
                 functions drawn from the emulator posterior distribution. Only
-                if `N_draw` is > 0.
+                if `N_draw` is > 0 or `error_method` is `'analytic'`.
             HMF_std: array_like, optional
                 The (relative) standard deviation in the mass function draws
                 from the emulator posterior distribution. Should be used as a
-                relative error on the mass function. Only if `N_draw` is > 0.
+                relative error on the mass function. Only if `N_draw` is > 0 or
+                `error_method` is `'analytic'`.
             HMF_draws: ndarray, optional
                 Mass function realizations drawn from the emulator posterior
                 distribution. The return values `HMF_mean` and `HMF_std` are
@@ -204,39 +791,338 @@ class Emulator:
         :rtype: dict
         """
         # Validate and normalize requested cosmology
-        requested_cosmology_normed = self.__normalize_params(requested_cosmology)
+        with self.stats.timer('validate'):
+            requested_cosmology_normed = self.__normalize_params(requested_cosmology)
+        self.__check_error_method(error_method)
+        if error_method=='analytic':
+            N_draw = 0
+        if N_draw>0:
+            rng = self.__check_random_input(rng, std_normals, N_draw)
+
+        z_ids = self.__z_ids(z_emu)
+        M_window = self.__M_window(log10_M_range)
+        if session is not None and session.emulator is not self:
+            raise ValueError("The session belongs to a different emulator")
+
+        # Stored GP output and tables of this cosmology
+        memo_key, stored = None, None
+        if self.__memo is not None and rng is None and std_normals is None and draws_dir is None:
+            memo_key = (tuple(np.round(requested_cosmology_normed/self.__memo_tol).astype(np.int64)), N_draw)
+            stored = self.__memo.get(memo_key)
+        if stored is None:
+            stored = {}
+
+        # Call the GPs of the emulator redshifts without stored output
+        GP_ids = [i for i in z_ids if i not in stored]
+        if len(GP_ids)>0:
+            self.__require_z_ids(GP_ids)
+            wstar_all, wstar_covmat_all = self.__predict_GP(GP_ids, requested_cosmology_normed[None,:], session)
 
         output = {'Units': "log10_M is log10(Mass in [Msun/h]), HMFs are given in dn/dlnM [(h/Mpc)^3]"}
-        log10_M_full = np.linspace(13, 16, 3001)
-        for i,emu_z in enumerate(self.z_arr):
+        nodes = {}
+        for i in z_ids:
+            emu_z = self.z_arr[i]
+            node = stored.get(i)
+            if node is None:
+                node = {'wstar': wstar_all[i][0], 'wstar_covmat': wstar_covmat_all[i][0], 'M_window': None}
+
+            # Tables for a mass window that covers the stored and the
+            # requested one
+            if node['M_window'] is None or node['M_window'][0]>M_window[0] or node['M_window'][1]<M_window[1]:
+                node_window = M_window
+                if node['M_window'] is not None:
+                    node_window = (min(node['M_window'][0], M_window[0]), max(node['M_window'][1], M_window[1]))
+                node = {'wstar': node['wstar'], 'wstar_covmat': node['wstar_covmat'], 'M_window': node_window,
+                        'HMF': self.__HMF_table(i, node['wstar'], node_window), 'errors': {}}
+
+            # Error estimates for the tables. Returned draws are always new
+            # and their statistics are not stored.
+            errors = node['errors'].get(error_method)
+            if return_draws and N_draw>0:
+                errors = self.__error_tables(i, node, N_draw, return_draws, error_method, rng, std_normals, draws_dir)
+            elif (N_draw>0 or error_method=='analytic') and errors is None:
+                errors = self.__error_tables(i, node, N_draw, return_draws, error_method, rng, std_normals, draws_dir)
+                node = dict(node, errors=dict(node['errors']))
+                node['errors'][error_method] = errors
+            nodes[i] = node
+
+            # Output for the requested masses
+            cols = self.__M_cols(i, M_window)
+            node_cols = self.__M_cols(i, node['M_window'])
+            window = slice(cols.start-node_cols.start, cols.stop-node_cols.start)
+            take = lambda table: table[...,window] if memo_key is None else np.array(table[...,window])
             output[emu_z] = {'redshift': emu_z,
-                                     'log10_M': log10_M_full[:len(self.__PCA_means[i])],}
+                             'log10_M': self.log10_M_arr[cols],
+                             'HMF': take(node['HMF'])}
+            if N_draw>0 or error_method=='analytic':
+                for key, table in errors.items():
+                    output[emu_z][key] = take(table)
 
-            # Call the GP
-            wstar, wstar_covmat = self.__GPreg[i].predict(requested_cosmology_normed)
-            wstar_covmat*= self.__facs[i]
+        if memo_key is not None and any(stored.get(i) is not nodes[i] for i in z_ids):
+            stored = dict(stored)
+            stored.update(nodes)
+            nbytes = sum(self.__node_nbytes(node) for node in stored.values())
+            self.__memo.put(memo_key, stored, nbytes)
+
+        return output
+
+
+    def __HMF_table(self, z_id, wstar, M_window):
+        """Mass function at the emulator redshift `z_id` for the GP output
+        `wstar` within the mass window."""
+        with self.stats.timer('pca', self.z_arr[z_id]):
+            cols = self.__M_cols(z_id, M_window)
             # De-standardize to GP input
-            PC_weight = wstar * self.__GP_std[i] + self.__GP_means[i]
+            PC_weight = wstar * self.__GP_std[z_id] + self.__GP_means[z_id]
             # PCA transform
-            output[emu_z]['HMF'] = np.exp(np.dot(PC_weight, self.__PCA_transform[i]) + self.__PCA_means[i])
-
-            # Draw parameter realizations
-            if N_draw>0:
-                wstar_draws = np.random.multivariate_normal(wstar, wstar_covmat, N_draw)
-                PC_weight_draws = wstar_draws * self.__GP_std[i] + self.__GP_means[i]
-                HMF_draws = np.exp(np.dot(PC_weight_draws, self.__PCA_transform[i]) + self.__PCA_means[i])
-                # Replace infinites with nan to be able to get mean and std
-                idx = [np.all(np.isfinite(HMF_draws[j])) for j in range(N_draw)]
-                output[emu_z]['HMF_draws'] = HMF_draws[idx]
-                # Compute statistics
-                output[emu_z]['HMF_mean'] = np.mean(output[emu_z]['HMF_draws'], axis=0)
-                output[emu_z]['HMF_std'] = np.std(output[emu_z]['HMF_draws']/output[emu_z]['HMF_mean'], axis=0)
-                if not return_draws:
-                    del output[emu_z]['HMF_draws']
+            return np.exp(np.dot(PC_weight, self.__PCA_transform[z_id][:,cols]) + self.__PCA_means[z_id][cols])
+
+
+    def __error_tables(self, z_id, node, N_draw, return_draws, error_method, rng, std_normals, draws_dir):
+        """`HMF_mean`, `HMF_std`, and (if `return_draws`) `HMF_draws` at the
+        emulator redshift `z_id` for the GP output and mass window of `node`
+        (see `predict_raw_emu`)."""
+        cols = self.__M_cols(z_id, node['M_window'])
+
+        # Log-normal statistics in closed form
+        if error_method=='analytic':
+            with self.stats.timer('analytic_errors', self.z_arr[z_id]):
+                log_HMF_var = self.__log_HMF_variance(z_id, node['wstar_covmat'], cols)
+                return {'HMF_mean': node['HMF'] * np.exp(.5*log_HMF_var), 'HMF_std': np.sqrt(np.expm1(log_HMF_var))}
 
+        # Draw parameter realizations, only keep those that are returned
+        draws = None
+        shape = (N_draw, cols.stop-cols.start)
+        if return_draws and draws_dir is not None:
+            draws_filename = os.path.join(draws_dir, 'HMF_draws_%d.npy'%z_id)
+            draws = np.lib.format.open_memmap(draws_filename, mode='w+', dtype=self.__dtype, shape=shape)
+        elif return_draws:
+            draws = np.empty(shape, dtype=self.__dtype)
+        errors = {}
+        errors['HMF_mean'], errors['HMF_std'], N_finite = self.__HMF_draw_statistics(
+            z_id, node['wstar'], node['wstar_covmat'], N_draw, rng, std_normals, cols, draws)
+        if return_draws and draws_dir is not None:
+            draws.flush()
+            del draws
+            if N_finite<N_draw:
+                sampling.truncate_rows(draws_filename, N_finite, self.__draw_chunk_size)
+            errors['HMF_draws'] = np.load(draws_filename, mmap_mode='r')
+        elif return_draws:
+            errors['HMF_draws'] = draws[:N_finite]
+        return errors
+
+
+    def __node_nbytes(self, node):
+        """Memory taken up by the stored output of one emulator redshift."""
+        tables = [node['wstar'], node['wstar_covmat'], node['HMF']]
+        tables+= [table for errors in node['errors'].values() for table in errors.values()]
+        return sum(table.nbytes for table in tables)
+
+
+    def predict_linearized(self, requested_cosmology, z_emu=None):
+        """Emulate the log of the halo mass function at the emulator
+        redshifts, together with its linear dependence on the GP output. The
+        log of the mass function is log_HMF + basis^T dw, where the GP output
+        dw is normally distributed with zero mean and covariance `covmat`. The
+        GPs of different emulator redshifts are independent. This is the
+        basis of the error propagation to derived quantities (e.g., in
+        `counts`).
+
+        :param requested_cosmology: The set of cosmology parameters for which
+            the mass function is requested. The parameters are `Ommh2`, `Ombh2`,
+            `Omnuh2`, `n_s`, `h`, `sigma_8`, `w_0`, `w_a`.
+        :type requested_cosmology: dict
+
+        :param z_emu: The subset of the emulator redshifts `z_arr` for which
+            the output is computed. Default is all emulator redshifts.
+        :type z_emu: array, optional
+
+        :returns: A dictionary with the emulator redshifts as keys. Each entry
+            is a dictionary with the masses `log10_M`, the log of dn/dlnM
+            [(h/Mpc)^3] `log_HMF` [N_M], the `basis` [N_PC, N_M], and the GP
+            covariance `covmat` [N_PC, N_PC].
+        :rtype: dict
+        """
+        with self.stats.timer('validate'):
+            requested_cosmology_normed = self.__normalize_params(requested_cosmology)
+        z_ids = self.__z_ids(z_emu)
+        self.__require_z_ids(z_ids)
+
+        wstar, wstar_covmat = self.__predict_GP(z_ids, requested_cosmology_normed[None,:])
+        output = {}
+        for i in z_ids:
+            emu_z = self.z_arr[i]
+            with self.stats.timer('pca', emu_z):
+                PC_weight = wstar[i][0] * self.__GP_std[i] + self.__GP_means[i]
+                output[emu_z] = {'log10_M': self.log10_M_arr[:len(self.__PCA_means[i])],
+                                 'log_HMF': np.dot(PC_weight, self.__PCA_transform[i]) + self.__PCA_means[i],
+                                 'basis': self.__GP_std[i][:,None] * self.__PCA_transform[i],
+                                 'covmat': wstar_covmat[i][0]}
         return output
 
 
+    def session(self, max_incremental_dims=4, refresh_interval=100):
+        """Start a session for a sequence of evaluations of single
+        cosmologies, e.g., in a Markov chain or a parameter scan. The session
+        keeps the GP kernel of the last cosmology and, if only some parameters
+        change (e.g., only `sigma_8`), updates the kernel for these parameters
+        instead of recomputing it. All emulator redshifts are set up.
+
+        :param max_incremental_dims: Maximum number of changed parameters for
+            which the kernel is updated rather than recomputed. Note that
+            `w_0` and `w_a` both enter w_b. Default is 4.
+        :type max_incremental_dims: int, optional
+
+        :param refresh_interval: Number of consecutive updates after which
+            the kernel is recomputed from scratch. Default is 100.
+        :type refresh_interval: int, optional
+
+        :rtype: Session
+        """
+        self.__require_z_ids(range(len(self.z_arr)))
+        return Session(self, self.__stacked_GP, max_incremental_dims, refresh_interval)
+
+
+    def memo_info(self):
+        """Counters of the memoization of `predict_raw_emu` (see the
+        `memo_size` argument of `Emulator`).
+
+        :returns: Numbers of `hits` and `misses` (calls for which the
+            cosmology was or was not stored), number of stored cosmologies
+            `size`, memory taken up by the stored outputs `nbytes`, and the
+            limits `max_size` and `max_bytes`. None if memoization is off.
+        :rtype: dict
+        """
+        if self.__memo is None:
+            return None
+        return self.__memo.info()
+
+
+    def memo_clear(self):
+        """Remove all stored outputs and reset the counters of the memoization
+        of `predict_raw_emu`."""
+        if self.__memo is not None:
+            self.__memo.clear()
+
+
+    def __check_error_method(self, error_method):
+        if error_method not in ['sample', 'analytic']:
+            raise ValueError("error_method must be 'sample' or 'analytic' but is %s"%error_method)
+
+
+    def __M_window(self, log10_M_range):
+        """Range (start, stop) of the indices into `log10_M_arr` that cover
+        `log10_M_range` = (min, max) including the interpolation neighbors
+        (all masses if None)."""
+        if log10_M_range is None:
+            return 0, len(self.log10_M_arr)
+        lo, hi = log10_M_range
+        if lo>hi:
+            raise ValueError("log10_M_range (%.4f, %.4f) must be ascending"%(lo, hi))
+        if lo<self.log10_M_arr[0] or hi>self.log10_M_arr[-1]:
+            raise ValueError("log10_M_range (%.4f, %.4f) must be within [%d, %d]"%(
+                lo, hi, self.log10_M_arr[0], self.log10_M_arr[-1]))
+        start = max(np.searchsorted(self.log10_M_arr, lo, side='right') - 1, 0)
+        stop = min(np.searchsorted(self.log10_M_arr, hi, side='left') + 1, len(self.log10_M_arr))
+        return int(start), int(max(stop, start+1))
+
+
+    def __M_cols(self, z_id, M_window):
+        """Columns of the PCA basis of the emulator redshift `z_id` within the
+        mass window."""
+        return slice(M_window[0], max(min(M_window[1], len(self.__PCA_means[z_id])), M_window[0]))
+
+
+    def __log_HMF_variance(self, z_id, wstar_covmat, cols=slice(None)):
+        """Variance of the log of the mass function at the emulator redshift
+        `z_id` (for the PCA columns `cols`) for the GP covariance
+        `wstar_covmat` [..., N_PC, N_PC], i.e., diag(B^T wstar_covmat B) with B
+        the de-standardized PCA basis."""
+        basis = self.__GP_std[z_id][:,None] * self.__PCA_transform[z_id][:,cols]
+        return np.sum(np.matmul(wstar_covmat, basis) * basis, axis=-2)
+
+
+    def draw_standard_normals(self, N_draw, rng=None):
+        """Draw standard normal random numbers that can be passed as
+        `std_normals` to `predict`, `predict_batch`, and `predict_raw_emu`.
+        Using the same draws for different cosmologies (common random numbers)
+        makes the error estimates reproducible and smooth functions of the
+        cosmology.
+
+        :param N_draw: Number of mass function realizations.
+        :type N_draw: int
+
+        :param rng: Random number generator or seed. Default is numpy's global
+            random number generator.
+        :type rng: Generator or int, optional
+
+        :returns: Standard normal draws with shape [len(z_arr), N_draw, N_PC].
+        :rtype: array
+        """
+        return sampling.get_rng(rng).standard_normal((len(self.z_arr), N_draw, self.__N_PC))
+
+
+    def __check_random_input(self, rng, std_normals, N_draw):
+        """Check the shape of `std_normals` and return the random number
+        generator (None for the legacy draws from numpy's global generator)."""
+        if std_normals is not None:
+            if std_normals.shape!=(len(self.z_arr), N_draw, self.__N_PC):
+                raise ValueError("std_normals must have shape (%d, %d, %d) but has shape %s"%(
+                    len(self.z_arr), N_draw, self.__N_PC, std_normals.shape))
+            return None
+        if rng is None:
+            return None
+        return sampling.get_rng(rng)
+
+
+    def __draw_HMF(self, z_id, wstar, wstar_covmat, factor, start, stop, rng, std_normals, cols=slice(None)):
+        """Draw the mass function realizations `start` to `stop`
+        [stop-start, N_M] at the emulator redshift `z_id` (for the PCA columns
+        `cols`) from the GP posterior. Without `rng` and `std_normals`, the
+        draws are taken with `numpy.random.multivariate_normal`, otherwise the
+        covariance factor `factor` (see `sampling.factorize_covmat`) is applied
+        to standard normal draws. Consecutive ranges continue the same random
+        stream, such that the realizations do not depend on the chunking."""
+        if rng is None and std_normals is None:
+            wstar_draws = np.random.multivariate_normal(wstar, wstar_covmat, stop-start)
+        else:
+            if std_normals is None:
+                this_std_normals = rng.standard_normal((stop-start, len(wstar)))
+            else:
+                this_std_normals = std_normals[z_id][start:stop]
+            wstar_draws = sampling.draw(wstar, factor, this_std_normals)
+        PC_weight_draws = wstar_draws.astype(self.__dtype, copy=False) * self.__GP_std[z_id] + self.__GP_means[z_id]
+        return np.exp(np.dot(PC_weight_draws, self.__PCA_transform[z_id][:,cols]) + self.__PCA_means[z_id][cols])
+
+
+    def __HMF_draw_statistics(self, z_id, wstar, wstar_covmat, N_draw, rng, std_normals, cols=slice(None),
+                              draws=None):
+        """Mean and relative standard deviation of `N_draw` mass function
+        realizations at the emulator redshift `z_id`, which are drawn and
+        accumulated in chunks of `draw_chunk_size`. Realizations with
+        non-finite values are discarded. If the array `draws` [N_draw, N_M]
+        is provided, the finite realizations are written to its first rows.
+
+        :returns: Mean [N_M], relative standard deviation [N_M], and the
+            number of finite realizations.
+        :rtype: tuple
+        """
+        factor = None
+        if rng is not None or std_normals is not None:
+            factor = sampling.factorize_covmat(wstar_covmat)
+        running = sampling.RunningStatistics(len(self.__PCA_means[z_id][cols]))
+        for start, stop in sampling.iter_chunks(N_draw, self.__draw_chunk_size):
+            with self.stats.timer('draws', self.z_arr[z_id]):
+                HMF_draws = self.__draw_HMF(z_id, wstar, wstar_covmat, factor, start, stop, rng, std_normals, cols)
+            with self.stats.timer('filter', self.z_arr[z_id]):
+                N_finite = running.count
+                HMF_draws = running.update(HMF_draws)
+                if draws is not None:
+                    draws[N_finite:running.count] = HMF_draws
+        HMF_mean = running.mean.astype(self.__dtype, copy=False)
+        return HMF_mean, (running.std()/running.mean).astype(self.__dtype, copy=False), running.count
+
+
     def __translate_params(self, cosmo_dict):
         """Copy cosmology parameter variables defined without underscores to
         variable names with underscore, which is the default naming scheme. If
@@ -248,7 +1134,7 @@ class Emulator:
         :return: Whether duplicate variables are consistent or not.
         :rtype: bool
         """
-        for var_w, var_wo in zip(['w_0', 'w_a', 'n_s', 'sigma_8'], ['w0', 'wa', 'ns', 'sigma8']):
+        for var_w, var_wo in self.param_aliases:
             if var_wo in cosmo_dict.keys():
                 if var_w in cosmo_dict.keys():
                     if not np.isclose(cosmo_dict[var_wo], cosmo_dict[var_w]):
@@ -319,3 +1205,105 @@ class Emulator:
             normed_p[i] = (cosmo_dict[param] - self.param_limits[param][0]) / (self.param_limits[param][1] - self.param_limits[param][0])
 
         return normed_p
+
+
+    def __param_array(self, cosmologies):
+        """Convert a set of cosmologies (structured array, list of
+        dictionaries, or array [N, 8]) into an array of the user-facing
+        parameters `input_param_names` with shape [N, 8]. The input is not
+        modified."""
+        if isinstance(cosmologies, dict):
+            cosmologies = [cosmologies]
+        if isinstance(cosmologies, np.ndarray) and cosmologies.dtype.names is not None:
+            columns = self.__lookup_params(np.atleast_1d(cosmologies), cosmologies.dtype.names)
+            return np.column_stack(columns)
+        if len(cosmologies)>0 and isinstance(cosmologies[0], dict):
+            return np.array([self.__lookup_params(c, c.keys()) for c in cosmologies])
+        params = np.atleast_2d(np.asarray(cosmologies, dtype=float))
+        if params.ndim!=2 or params.shape[1]!=len(self.input_param_names):
+            raise ValueError("Parameter array must have shape (N, %d) but has shape %s"%(len(self.input_param_names), params.shape))
+        return params
+
+
+    def __lookup_params(self, cosmo, keys):
+        """Look up the parameters `input_param_names` in a dictionary or
+        structured array whose keys are `keys`, accounting for the alternative
+        names without underscores."""
+        aliases = dict(self.param_aliases)
+        values = []
+        for param in self.input_param_names:
+            value = np.asarray(cosmo[param], dtype=float) if param in keys else None
+            if param in aliases and aliases[param] in keys:
+                value_alias = np.asarray(cosmo[aliases[param]], dtype=float)
+                if value is None:
+                    value = value_alias
+                elif not np.all(np.isclose(value, value_alias)):
+                    raise ValueError("%s is provided twice but with inconsistent values"%param)
+            if value is None:
+                raise KeyError("You did not provide %s"%param)
+            values.append(value)
+        return values
+
+
+    def normalize(self, theta):
+        """Map an array of cosmologies to the normalized parameters used by
+        the emulator (see `predict_normalized`) and check which of them are
+        valid. All cosmologies are checked at once, the input is not modified,
+        and invalid cosmologies do not raise an error.
+
+        :param theta: Cosmology parameters [N, 8] or [8] in the order of
+            `input_param_names`, i.e., `Ommh2`, `Ombh2`, `Omnuh2`, `n_s`,
+            `h`, `sigma_8`, `w_0`, `w_a`.
+        :type theta: array
+
+        Returns
+        -------
+        x: array_like
+            Normalized parameters in the order of `param_names` (with
+            w_b = (-w_0 - w_a)**0.25), with shape [N, 8] or [8]. Rows of
+            invalid cosmologies are not meaningful.
+        valid: array_like
+            Whether the cosmologies satisfy w_0 + w_a < 0 and lie within
+            `param_limits`, with shape [N] or scalar.
+        """
+        theta = np.asarray(theta, dtype=float)
+        params = np.atleast_2d(theta)
+        if params.ndim!=2 or params.shape[1]!=len(self.input_param_names):
+            raise ValueError("Parameter array must have shape (N, %d) but has shape %s"%(len(self.input_param_names), theta.shape))
+        lower, upper = self.__param_lower, self.__param_upper
+
+        x = np.empty(params.shape)
+        x[:,:-1] = params[:,:-1]
+        w_0w_a = -params[:,self.__i_w_0] - params[:,self.__i_w_a]
+        valid = w_0w_a > 0
+        x[:,-1] = np.where(valid, w_0w_a, 0)**.25
+        valid&= np.all((x>=lower) & (x<=upper), axis=1)
+        x-= lower
+        x/= upper - lower
+
+        if theta.ndim==1:
+            return x[0], valid[0]
+        return x, valid
+
+
+    def __normalize_param_array(self, params):
+        """Check that an array of cosmologies [N, 8] (see `input_param_names`)
+        is within the bounds of the Mira-Titan Universe design and return the
+        normalized cosmological parameter array [N, 8] (see `param_names`)."""
+        x, valid = self.normalize(params)
+        if np.all(valid):
+            return x
+        # Explain the first invalid cosmology
+        n = np.flatnonzero(~valid)[0]
+        w_0, w_a = params[n,self.__i_w_0], params[n,self.__i_w_a]
+        if w_a > -w_0:
+            raise ValueError("w_0 + w_a must be <0. Cosmology %d has w_0 %.4f and w_a %.4f"%(n, w_0, w_a))
+        this_params = np.append(params[n,:len(self.param_names)-1], (-w_0 - w_a)**.25)
+        for i,param in enumerate(self.param_names):
+            if this_params[i]<self.__param_lower[i]:
+                raise ValueError("Parameter %s of cosmology %d is %.4f but must be >= %.4f"%(
+                    param, n, this_params[i], self.__param_lower[i]))
+            if this_params[i]>self.__param_upper[i]:
+                raise ValueError("Parameter %s of cosmology %d is %.4f but must be <= %.4f"%(
+                    param, n, this_params[i], self.__param_upper[i]))
+        raise ValueError("Parameters of cosmology %d are not finite"%n)
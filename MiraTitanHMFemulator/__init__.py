@@ -1,7 +1,6 @@
-import inspect
 import os
 
-version_filename = os.path.join(os.path.dirname(os.path.abspath(inspect.stack()[0][1])), 'VERSION')
+version_filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'VERSION')
 with open(version_filename, 'r') as version_file:
     __version__ = version_file.read().strip()
 
@@ -9,3 +8,9 @@ __author__ = "Sebastian Bocquet"
 __email__ = "sebastian.bocquet@gmail.com"
 
 from .MiraTitanHMFemulator import Emulator
+from .plan import EvaluationPlan
+from .executor import BatchExecutor
+from .instrumentation import Stats
+from .session import Session
+from .counts import Counts
+from .stream import evaluate_chain
@@ -0,0 +1,77 @@
+"""On-disk cache of the pre-computed Gaussian process factorizations.
+
+Each cache entry is a directory of `.npy` files named after a hash of the
+emulator input files (including the package VERSION), so that a change of
+either the data or the code version never picks up a stale entry. Entries are
+memory-mapped when loaded.
+"""
+import os
+import warnings
+
+import numpy as np
+
+# Increment whenever the content of the cache entries changes
+CACHE_FORMAT = 2
+
+CACHE_DIR_ENV = 'MIRATITAN_HMF_CACHE_DIR'
+
+
+def get_cache_dir(cache_dir=None):
+    """Return the cache directory: `cache_dir` if provided, otherwise the
+    value of the environment variable `MIRATITAN_HMF_CACHE_DIR`, otherwise
+    None (no caching)."""
+    if cache_dir is None:
+        cache_dir = os.environ.get(CACHE_DIR_ENV)
+    return cache_dir or None
+
+
+def cache_key(filenames):
+    """Hash of the cache format and the content of the input files."""
+    import hashlib
+
+    sha = hashlib.sha256(('format %d' % CACHE_FORMAT).encode())
+    for filename in filenames:
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+    return sha.hexdigest()
+
+
+def load(cache_dir, key, names):
+    """Memory-map the arrays `names` of cache entry `key`. Returns a
+    dictionary of arrays, or None if the entry does not exist."""
+    entry_dir = os.path.join(cache_dir, key)
+    if not os.path.isdir(entry_dir):
+        return None
+    try:
+        return {name: np.load(os.path.join(entry_dir, '%s.npy' % name), mmap_mode='r')
+                for name in names}
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def save(cache_dir, key, arrays):
+    """Write the dictionary `arrays` to cache entry `key`. The entry is
+    written to a temporary directory first and then renamed, such that
+    concurrent processes never see incomplete entries. Failures to write the
+    cache only raise a warning."""
+    import shutil
+    import tempfile
+
+    entry_dir = os.path.join(cache_dir, key)
+    if os.path.isdir(entry_dir):
+        return
+    tmp_dir = None
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_dir = tempfile.mkdtemp(prefix='.%s.' % key, dir=cache_dir)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_dir, '%s.npy' % name), array)
+        os.rename(tmp_dir, entry_dir)
+    except (IOError, OSError) as e:
+        if not os.path.isdir(entry_dir):
+            warnings.warn("Could not write emulator cache to %s: %s" % (cache_dir, e))
+    finally:
+        if tmp_dir is not None and os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir, ignore_errors=True)
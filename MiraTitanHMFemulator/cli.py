@@ -0,0 +1,143 @@
+"""Command-line interface of the emulator.
+
+Evaluate the mass function for the cosmologies in a CSV or `.npy` file::
+
+    miratitan-hmf eval cosmologies.csv --z 0,0.5,1 --m-file masses.txt -o hmf.npz
+
+CSV files have a header line with the parameter names (`Ommh2`, `Ombh2`,
+`Omnuh2`, `n_s`, `h`, `sigma_8`, `w_0`, `w_a`, or their names without
+underscores). `.npy` files contain an array [N, 8] with the parameters in this
+order, or a structured array. Run `miratitan-hmf eval --help` for all options.
+"""
+import argparse
+import sys
+import time
+
+import numpy as np
+
+
+def read_cosmologies(filename):
+    """Read cosmologies from a CSV file with a header line or from a `.npy`
+    file (memory-mapped)."""
+    if filename.endswith('.npy'):
+        return np.load(filename, mmap_mode='r')
+    return np.atleast_1d(np.genfromtxt(filename, delimiter=',', names=True, dtype=float))
+
+
+def read_grid(values, filename, name):
+    """Grid from a comma-separated list of values or from a text or `.npy`
+    file."""
+    if (values is None)==(filename is None):
+        raise ValueError("Provide either --%s or --%s-file"%(name, name))
+    if values is not None:
+        return np.array([float(value) for value in values.split(',')])
+    if filename.endswith('.npy'):
+        return np.atleast_1d(np.load(filename))
+    return np.atleast_1d(np.loadtxt(filename, ndmin=1))
+
+
+def write_results(filename, HMF, HMF_err, z, m):
+    """Write the results to a `.npz` file (arrays `HMF`, `HMF_err`, `z`, and
+    `m`) or to `.npy` files (the mass function to `filename` and the errors to
+    `<filename>_err.npy`)."""
+    if filename.endswith('.npz'):
+        arrays = {'HMF': HMF, 'z': z, 'm': m}
+        if HMF_err is not None:
+            arrays['HMF_err'] = HMF_err
+        np.savez(filename, **arrays)
+    elif filename.endswith('.npy'):
+        np.save(filename, HMF)
+        if HMF_err is not None:
+            np.save(filename[:-len('.npy')] + '_err.npy', HMF_err)
+    else:
+        raise ValueError("Output file %s must end with .npz or .npy"%filename)
+
+
+def evaluate(args):
+    from .MiraTitanHMFemulator import Emulator
+    from .executor import BatchExecutor
+    from .stream import iter_chain
+
+    cosmologies = read_cosmologies(args.cosmologies)
+    z = read_grid(args.z, args.z_file, 'z')
+    m = read_grid(args.m, args.m_file, 'm')
+    emulator_kwargs = {'cache_dir': args.cache_dir, 'dtype': np.dtype(args.dtype)}
+    predict_kwargs = {'get_errors': not args.no_errors, 'N_draw': args.N_draw, 'error_method': args.error_method}
+
+    start = time.time()
+    if args.workers>1:
+        with BatchExecutor(args.workers, chunk_size=args.chunk_size, emulator_kwargs=emulator_kwargs,
+                           shared=True) as executor:
+            setup_time = time.time() - start
+            HMF, HMF_err = executor.predict(np.asarray(cosmologies), z, m, seed=args.seed, **predict_kwargs)
+        stats = None
+    else:
+        emulator = Emulator(instrument=True, **emulator_kwargs)
+        setup_time = time.time() - start
+        plan = emulator.evaluation_plan(z, m)
+        HMF = np.zeros((len(cosmologies), len(z), len(m)))
+        HMF_err = np.zeros((len(cosmologies), len(z), len(m)))
+        for chunk_start, chunk_stop, this_HMF, this_HMF_err in iter_chain(
+                emulator, cosmologies, plan=plan, chunk_size=args.chunk_size, seed=args.seed, **predict_kwargs):
+            HMF[chunk_start:chunk_stop] = this_HMF
+            HMF_err[chunk_start:chunk_stop] = this_HMF_err
+        stats = emulator.stats.as_dict()
+    total_time = time.time() - start
+
+    write_results(args.output, HMF, None if args.no_errors else HMF_err, z, m)
+
+    N = len(cosmologies)
+    print("Evaluated %d cosmologies at %d redshifts and %d masses with %d worker(s)"%(N, len(z), len(m), args.workers))
+    print("%-20s %10.4f s"%('setup', setup_time))
+    print("%-20s %10.4f s"%('evaluation', total_time - setup_time))
+    print("%-20s %10.1f cosmologies/s"%('throughput', N/max(total_time - setup_time, 1e-12)))
+    if stats is not None:
+        print("Time per stage:")
+        for stage in sorted(stats.keys(), key=lambda stage: -stats[stage]['time']):
+            print("  %-18s %10.4f s %10d calls"%(stage, stats[stage]['time'], stats[stage]['calls']))
+    return HMF, HMF_err
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='miratitan-hmf',
+                                     description="Mira-Titan Universe halo mass function emulator")
+    subparsers = parser.add_subparsers(dest='command')
+    parser_eval = subparsers.add_parser('eval', help="Evaluate the mass function for a set of cosmologies",
+                                        description="Evaluate the mass function dn/dlnM [(h/Mpc)^3] and its "
+                                        "relative error for a set of cosmologies.")
+    parser_eval.add_argument('cosmologies', help="CSV file with a header line or .npy file of cosmologies")
+    parser_eval.add_argument('-o', '--output', required=True,
+                             help="Output .npz file (HMF, HMF_err, z, m) or .npy file (HMF, errors in <name>_err.npy)")
+    parser_eval.add_argument('--z', help="Comma-separated redshifts")
+    parser_eval.add_argument('--z-file', help="Text or .npy file of redshifts")
+    parser_eval.add_argument('--m', help="Comma-separated masses [Msun/h]")
+    parser_eval.add_argument('--m-file', help="Text or .npy file of masses [Msun/h]")
+    parser_eval.add_argument('--no-errors', action='store_true', help="Do not compute error estimates")
+    parser_eval.add_argument('--N-draw', type=int, default=1000,
+                             help="Number of realizations for the error estimates (default: 1000)")
+    parser_eval.add_argument('--error-method', choices=['sample', 'analytic'], default='sample',
+                             help="How to compute the error estimates (default: sample)")
+    parser_eval.add_argument('--seed', type=int, help="Seed for the error realizations")
+    parser_eval.add_argument('--workers', type=int, default=1,
+                             help="Number of worker processes (default: 1). The time per stage is only reported "
+                             "for a single worker.")
+    parser_eval.add_argument('--chunk-size', type=int, default=64,
+                             help="Number of cosmologies evaluated at once (default: 64)")
+    parser_eval.add_argument('--dtype', choices=['float64', 'float32'], default='float64',
+                             help="Precision of the PCA reconstruction (default: float64)")
+    parser_eval.add_argument('--cache-dir', help="Cache directory of the GP factorizations")
+    args = parser.parse_args(argv)
+
+    if args.command!='eval':
+        parser.print_help()
+        return 1
+    try:
+        evaluate(args)
+    except (IOError, OSError, KeyError, ValueError) as e:
+        sys.stderr.write("miratitan-hmf: error: %s\n"%e)
+        return 2
+    return 0
+
+
+if __name__=='__main__':
+    sys.exit(main())
@@ -0,0 +1,253 @@
+"""Expected halo number counts in bins of redshift and mass.
+
+The counts are the integral of the mass function times the comoving volume
+element over the bins,
+
+    N = solid_angle * int dz int dlnM  dn/dlnM(M, z) dV/dz/dOmega(z) S(z, M),
+
+with an optional selection function S. The mass integral uses the nodes of the
+emulator mass grid (spacing 0.001 in log10(M)), and the redshift integral uses
+Gauss-Legendre quadrature between the emulator redshifts, where the emulator
+output is interpolated linearly.
+
+The comoving volume is computed for a spatially flat cosmology with dark
+energy equation of state w(a) = w_0 + (1-a) w_a and matter density
+Ommh2/h**2 (including massive neutrinos); radiation is neglected.
+"""
+import numpy as np
+
+from .MiraTitanHMFemulator import Emulator
+from .plan import EvaluationPlan
+
+# Hubble distance c/H0 [Mpc/h]
+HUBBLE_DISTANCE = 2997.92458
+
+
+def _get_param(cosmo, param, aliases):
+    """Value of `param` in the dictionary `cosmo`, which may use the name
+    without underscore instead."""
+    if param in cosmo:
+        return cosmo[param]
+    if param in aliases and aliases[param] in cosmo:
+        return cosmo[aliases[param]]
+    raise KeyError("You did not provide %s"%param)
+
+
+def _background(cosmo):
+    """Omega_m, w_0, w_a of a cosmology dictionary."""
+    aliases = dict(Emulator.param_aliases)
+    h = _get_param(cosmo, 'h', aliases)
+    return (_get_param(cosmo, 'Ommh2', aliases) / h**2,
+            _get_param(cosmo, 'w_0', aliases),
+            _get_param(cosmo, 'w_a', aliases))
+
+
+def E_z(cosmo, z):
+    """Dimensionless Hubble rate H(z)/H0.
+
+    :param cosmo: Cosmology parameters (see `Emulator.predict`).
+    :type cosmo: dict
+
+    :param z: Redshift(s).
+    :type z: float or array
+
+    :rtype: array
+    """
+    Om, w_0, w_a = _background(cosmo)
+    a = 1./(1.+np.asarray(z, dtype=float))
+    rho_de = a**(-3*(1+w_0+w_a)) * np.exp(-3*w_a*(1-a))
+    return np.sqrt(Om*a**-3 + (1-Om)*rho_de)
+
+
+def comoving_distance(cosmo, z, N_gauss=8):
+    """Line-of-sight comoving distance [Mpc/h]. The integral of 1/E(z) is
+    evaluated with Gauss-Legendre quadrature of order `N_gauss` between
+    consecutive (sorted) redshifts.
+
+    :param cosmo: Cosmology parameters (see `Emulator.predict`).
+    :type cosmo: dict
+
+    :param z: Redshift(s).
+    :type z: float or array
+
+    :rtype: array
+    """
+    z = np.asarray(z, dtype=float)
+    z_sorted = np.unique(np.append(0, z.ravel()))
+    x, w = np.polynomial.legendre.leggauss(N_gauss)
+    lo, hi = z_sorted[:-1], z_sorted[1:]
+    nodes = .5*(hi-lo)[:,None] * (x+1) + lo[:,None]
+    segments = .5*(hi-lo) * np.dot(1./E_z(cosmo, nodes), w)
+    D_C = HUBBLE_DISTANCE * np.append(0, np.cumsum(segments))
+    return D_C[np.searchsorted(z_sorted, z)]
+
+
+def comoving_volume_element(cosmo, z):
+    """Comoving volume element dV/dz/dOmega [(Mpc/h)^3/sr].
+
+    :param cosmo: Cosmology parameters (see `Emulator.predict`).
+    :type cosmo: dict
+
+    :param z: Redshift(s).
+    :type z: float or array
+
+    :rtype: array
+    """
+    return HUBBLE_DISTANCE * comoving_distance(cosmo, z)**2 / E_z(cosmo, z)
+
+
+def mass_quadrature(log10_M_edges, log10_M_grid):
+    """Trapezoidal quadrature in ln(M) for the bins `log10_M_edges`, using the
+    bin edges and all points of `log10_M_grid` within the bins as nodes.
+
+    :returns: Nodes in log10(M) [N_nodes] and weights [N_bins, N_nodes] such
+        that the integral over bin i is dot(weights[i], f(nodes)).
+    """
+    edges = np.asarray(log10_M_edges, dtype=float)
+    bins = []
+    for lo, hi in zip(edges[:-1], edges[1:]):
+        bins.append(np.unique(np.concatenate(([lo], log10_M_grid[(log10_M_grid>lo)&(log10_M_grid<hi)], [hi]))))
+    nodes = np.unique(np.concatenate(bins))
+    weights = np.zeros((len(bins), len(nodes)))
+    for i, bin_nodes in enumerate(bins):
+        dlnM = np.log(10) * np.diff(bin_nodes)
+        idx = np.searchsorted(nodes, bin_nodes)
+        np.add.at(weights[i], idx[:-1], .5*dlnM)
+        np.add.at(weights[i], idx[1:], .5*dlnM)
+    return nodes, weights
+
+
+def redshift_quadrature(z_edges, z_breaks, N_gauss=4):
+    """Gauss-Legendre quadrature of order `N_gauss` for the bins `z_edges`,
+    with every bin split into segments at the redshifts `z_breaks`.
+
+    :returns: Nodes [N_nodes] and weights [N_bins, N_nodes] such that the
+        integral over bin i is dot(weights[i], f(nodes)).
+    """
+    edges = np.asarray(z_edges, dtype=float)
+    x, w = np.polynomial.legendre.leggauss(N_gauss)
+    nodes, weights = [], []
+    for i, (lo, hi) in enumerate(zip(edges[:-1], edges[1:])):
+        bounds = np.unique(np.concatenate(([lo], z_breaks[(z_breaks>lo)&(z_breaks<hi)], [hi])))
+        for seg_lo, seg_hi in zip(bounds[:-1], bounds[1:]):
+            nodes.append(.5*(seg_hi-seg_lo) * (x+1) + seg_lo)
+            this_weights = np.zeros((len(edges)-1, N_gauss))
+            this_weights[i] = .5*(seg_hi-seg_lo) * w
+            weights.append(this_weights)
+    return np.concatenate(nodes), np.concatenate(weights, axis=1)
+
+
+class Counts(object):
+    """Expected number of halos in bins of redshift and mass, and the
+    covariance of these numbers due to the emulator uncertainty. The
+    quadrature and the interpolation from the emulator output are set up once
+    and reused for every cosmology.
+
+    Attributes
+    -----------------
+    z_edges : array
+        Redshift bin edges.
+    log10_M_edges : array
+        Mass bin edges, log10(M [Msun/h]).
+    """
+    def __init__(self, emulator, z_edges, log10_M_edges, selection=None, solid_angle=4*np.pi, N_gauss=4):
+        """
+        :param emulator: The emulator.
+        :type emulator: Emulator
+
+        :param z_edges: Ascending redshift bin edges within [0, 2.02].
+        :type z_edges: array
+
+        :param log10_M_edges: Ascending bin edges in log10(M [Msun/h]) within
+            [13, 16].
+        :type log10_M_edges: array
+
+        :param selection: Selection function S(z, log10_M) that returns the
+            weights for arrays of redshifts [N_z, 1] and masses [1, N_M] with
+            shape [N_z, N_M]. Default is no selection (S=1).
+        :type selection: callable, optional
+
+        :param solid_angle: Solid angle of the survey [sr]. Default is the
+            full sky.
+        :type solid_angle: float, optional
+
+        :param N_gauss: Order of the Gauss-Legendre quadrature in redshift
+            between emulator redshifts. Default is 4.
+        :type N_gauss: int, optional
+        """
+        self.emulator = emulator
+        self.z_edges = np.asarray(z_edges, dtype=float)
+        self.log10_M_edges = np.asarray(log10_M_edges, dtype=float)
+        if np.any(np.diff(self.z_edges)<=0) or np.any(np.diff(self.log10_M_edges)<=0):
+            raise ValueError("Bin edges must be ascending")
+        self.solid_angle = solid_angle
+
+        self.z_nodes, self.z_weights = redshift_quadrature(self.z_edges, emulator.z_arr_asc, N_gauss)
+        self.log10_M_nodes, self.log10_M_weights = mass_quadrature(self.log10_M_edges, emulator.log10_M_arr)
+        self.plan = EvaluationPlan(emulator.z_arr_asc, emulator.log10_M_arr, self.z_nodes, 10**self.log10_M_nodes)
+        self.selection = np.ones((len(self.z_nodes), len(self.log10_M_nodes)))
+        if selection is not None:
+            self.selection*= selection(self.z_nodes[:,None], self.log10_M_nodes[None,:])
+
+        # Linear interpolation weights from the emulator redshifts (ascending)
+        # to the redshift nodes [N_z_nodes, N_z_emu]
+        self.z_interp = np.zeros((len(self.z_nodes), len(emulator.z_arr_asc)))
+        np.add.at(self.z_interp, (np.arange(len(self.z_nodes)), self.plan.z_idx), 1-self.plan.z_w)
+        np.add.at(self.z_interp, (np.arange(len(self.z_nodes)), self.plan.z_idx+1), self.plan.z_w)
+
+
+    def predict(self, cosmo, get_covariance=True):
+        """Expected number of halos in each bin and their covariance due to the
+        emulator uncertainty. The covariance is obtained by linear propagation
+        of the GP covariance through the log-linear PCA reconstruction and the
+        integrals.
+
+        :param cosmo: Cosmology parameters (see `Emulator.predict`).
+        :type cosmo: dict
+
+        :param get_covariance: Whether to compute the covariance. Default is
+            True.
+        :type get_covariance: bool, optional
+
+        Returns
+        -------
+        counts: array_like
+            Expected number of halos with shape [N_z_bins, N_M_bins].
+        covariance: array_like
+            Covariance of the counts in the order of `counts.flatten()`, with
+            shape [N_z_bins*N_M_bins, N_z_bins*N_M_bins]. None if
+            `get_covariance` is False.
+        """
+        emu = self.emulator
+        plan = self.plan
+        z_emu = emu.z_arr_asc[plan.z_ids]
+        linearized = emu.predict_linearized(cosmo, z_emu=z_emu)
+
+        log_HMF_table = np.log(np.nextafter(0,1)) * np.ones((len(emu.z_arr_asc), len(emu.log10_M_arr)))
+        for i in plan.z_ids:
+            this_log_HMF = linearized[emu.z_arr_asc[i]]['log_HMF']
+            log_HMF_table[i,:len(this_log_HMF)] = this_log_HMF
+        HMF = np.exp(plan.interpolate(log_HMF_table))
+
+        # Integrand at the quadrature nodes [N_z_nodes, N_M_nodes]
+        integrand = self.solid_angle * comoving_volume_element(cosmo, self.z_nodes)[:,None] * self.selection * HMF
+        counts = np.dot(np.dot(self.z_weights, integrand), self.log10_M_weights.T)
+        if not get_covariance:
+            return counts, None
+
+        # Derivatives of the counts with respect to the GP output of each
+        # emulator redshift [N_bins, N_z_emu, N_PC]
+        N_PC = linearized[z_emu[0]]['covmat'].shape[0]
+        basis_table = np.zeros((len(z_emu), N_PC, len(emu.log10_M_arr)))
+        covmat = np.zeros((len(z_emu), N_PC, N_PC))
+        for j, i in enumerate(plan.z_ids):
+            this_basis = linearized[emu.z_arr_asc[i]]['basis']
+            basis_table[j,:,:this_basis.shape[1]] = this_basis
+            covmat[j] = linearized[emu.z_arr_asc[i]]['covmat']
+        basis = basis_table[...,plan.m_idx] * (1-plan.m_w) + basis_table[...,plan.m_idx+1] * plan.m_w
+        z_weighted = np.einsum('bq,qj,qr->bjr', self.z_weights, self.z_interp[:,plan.z_ids], integrand)
+        jacobian = np.einsum('bjr,cr,jpr->bcjp', z_weighted, self.log10_M_weights, basis)
+        jacobian = jacobian.reshape(counts.size, len(z_emu), N_PC)
+        covariance = np.einsum('ajp,jpq,bjq->ab', jacobian, covmat, jacobian)
+
+        return counts, covariance
@@ -0,0 +1,167 @@
+"""Parallel evaluation of the emulator for large sets of cosmologies."""
+import time
+
+import numpy as np
+
+from .MiraTitanHMFemulator import Emulator
+from .plan import EvaluationPlan
+
+
+# Emulator of a worker process, set up once by `_init_worker`
+_worker_emulator = None
+
+
+def _init_worker(emulator_kwargs, handle=None):
+    global _worker_emulator
+    if handle is None:
+        _worker_emulator = Emulator(**emulator_kwargs)
+    else:
+        _worker_emulator = Emulator.attach(handle, **emulator_kwargs)
+
+
+def _evaluate_chunk(emulator, chunk_id, cosmologies, predict_kwargs, seed):
+    """Evaluate one chunk of cosmologies with `Emulator.predict_batch` and
+    time it. With a `seed`, the chunk uses its own random number generator
+    seeded with (seed, chunk_id)."""
+    start = time.time()
+    if seed is not None:
+        predict_kwargs = dict(predict_kwargs, rng=[seed, chunk_id])
+    HMF, HMF_err = emulator.predict_batch(cosmologies, **predict_kwargs)
+    return HMF, HMF_err, time.time() - start
+
+
+def _evaluate_chunk_in_worker(args):
+    return _evaluate_chunk(_worker_emulator, *args)
+
+
+class BatchExecutor(object):
+    """Evaluate the emulator for a set of cosmologies in chunks on a pool of
+    threads or processes. The workers are set up once when the executor is
+    created and are reused for all calls to `predict`.
+
+    Attributes
+    -----------------
+    timings : list
+        Per-chunk timings of the last call to `predict`. Each entry is a
+        dictionary with the indices `start` and `stop` of the chunk in the
+        input and the wall `time` [s] spent evaluating it.
+    """
+    def __init__(self, N_workers=None, backend='process', chunk_size=64, emulator_kwargs=None, shared=False):
+        """
+        :param N_workers: Number of threads or processes. Defaults to the
+            number of CPUs.
+        :type N_workers: int, optional
+
+        :param backend: `'process'` for a process pool in which every worker
+            sets up its own `Emulator` once, or `'thread'` for a thread pool
+            that shares one `Emulator`. Default is `'process'`.
+        :type backend: str, optional
+
+        :param chunk_size: Number of cosmologies evaluated per task with
+            `Emulator.predict_batch`. Default is 64.
+        :type chunk_size: int, optional
+
+        :param emulator_kwargs: Keyword arguments for setting up the
+            `Emulator` (e.g., `cache_dir`).
+        :type emulator_kwargs: dict, optional
+
+        :param shared: Only for the `'process'` backend. If True, the
+            `Emulator` is set up once in this process and its state is shared
+            with the workers via a memory-mapped file (see
+            `Emulator.to_shared`), such that the memory taken up by the
+            workers does not grow with their number. The file is deleted by
+            `close`. Default is False.
+        :type shared: bool, optional
+        """
+        import multiprocessing
+        from multiprocessing import pool
+
+        if backend not in ['process', 'thread']:
+            raise ValueError("backend must be 'process' or 'thread' but is %s"%backend)
+        if N_workers is None:
+            N_workers = multiprocessing.cpu_count()
+        if emulator_kwargs is None:
+            emulator_kwargs = {}
+        self.N_workers = N_workers
+        self.backend = backend
+        self.chunk_size = chunk_size
+        self.timings = []
+
+        self.__shared_state = None
+        if backend=='process' and shared:
+            # Only the settings that do not concern the emulator data apply to
+            # the workers
+            self.__shared_state = Emulator(**emulator_kwargs).to_shared()
+            attach_kwargs = dict((key, value) for key,value in emulator_kwargs.items()
+                                 if key in ['memo_size', 'memo_tol', 'memo_max_bytes', 'instrument',
+                                            'draw_chunk_size'])
+            self.__pool = multiprocessing.Pool(N_workers, initializer=_init_worker,
+                                               initargs=(attach_kwargs, self.__shared_state))
+            self.__emulator = None
+        elif backend=='process':
+            self.__pool = multiprocessing.Pool(N_workers, initializer=_init_worker, initargs=(emulator_kwargs,))
+            self.__emulator = None
+        else:
+            self.__pool = pool.ThreadPool(N_workers)
+            self.__emulator = Emulator(**emulator_kwargs)
+
+
+    def predict(self, cosmologies, z=None, m=None, get_errors=True, N_draw=1000, plan=None,
+                seed=None, std_normals=None, error_method='sample'):
+        """Emulate the halo mass function dn/dlnM for a set of cosmologies, see
+        `Emulator.predict_batch` for the parameters and return values.
+
+        :param seed: Seed for the error realizations. Chunk k draws from a
+            generator seeded with (seed, k), such that the results do not
+            depend on the number of workers. Without a seed (and without
+            `std_normals`), the seed is drawn from numpy's global random
+            number generator, such that every chunk still has its own random
+            stream.
+        :type seed: int, optional
+
+        :returns: HMF and relative errors with shape [N, len(z), len(m)], in
+            the order of the input cosmologies.
+        """
+        if isinstance(cosmologies, dict):
+            cosmologies = [cosmologies]
+        if seed is None and std_normals is None and get_errors and error_method=='sample':
+            # Forked workers inherit the state of the global generator and
+            # would repeat each other's draws
+            seed = np.random.randint(2**31)
+        if plan is None:
+            plan = EvaluationPlan(Emulator.z_arr_asc, Emulator.log10_M_arr, z, m)
+        predict_kwargs = {'plan': plan, 'get_errors': get_errors, 'N_draw': N_draw,
+                          'std_normals': std_normals, 'error_method': error_method}
+        bounds = [(start, min(start+self.chunk_size, len(cosmologies)))
+                  for start in range(0, len(cosmologies), self.chunk_size)]
+        tasks = [(chunk_id, cosmologies[start:stop], predict_kwargs, seed)
+                 for chunk_id,(start,stop) in enumerate(bounds)]
+
+        if self.backend=='process':
+            results = self.__pool.map(_evaluate_chunk_in_worker, tasks, chunksize=1)
+        else:
+            results = self.__pool.map(lambda task: _evaluate_chunk(self.__emulator, *task), tasks, chunksize=1)
+
+        self.timings = [{'start': start, 'stop': stop, 'time': result[2]}
+                        for (start,stop),result in zip(bounds, results)]
+        if len(results)==0:
+            empty = np.zeros((0, len(plan.z), len(plan.m)))
+            return empty, empty.copy()
+        return np.concatenate([result[0] for result in results]), np.concatenate([result[1] for result in results])
+
+
+    def close(self):
+        """Shut down the workers."""
+        self.__pool.close()
+        self.__pool.join()
+        if self.__shared_state is not None:
+            self.__shared_state.unlink()
+            self.__shared_state = None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,114 @@
+from timeit import default_timer
+
+
+class _NullTimer(object):
+    """Context manager that does nothing, used while recording is disabled."""
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer(object):
+    def __init__(self, stats, stage, node):
+        self.stats = stats
+        self.stage = stage
+        self.node = node
+
+
+    def __enter__(self):
+        self.start = default_timer()
+        return self
+
+
+    def __exit__(self, *args):
+        self.stats.record(self.stage, default_timer() - self.start, self.node)
+        return False
+
+
+class Stats(object):
+    """Accumulated wall time and number of calls of the stages of the
+    emulator (e.g., parameter validation, GP prediction, PCA
+    reconstruction, posterior draws, interpolation), in total and per
+    emulator redshift. Recording is off unless enabled.
+
+    Attributes
+    -----------------
+    enabled : bool
+        Whether timings are being recorded.
+    """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.reset()
+
+
+    def enable(self):
+        self.enabled = True
+
+
+    def disable(self):
+        self.enabled = False
+
+
+    def reset(self):
+        """Discard all recorded timings."""
+        self.__stages = {}
+
+
+    def recording(self):
+        """Context manager that records timings within its scope, e.g.::
+
+            with emu.stats.recording():
+                emu.predict(cosmo, z, m)
+            print(emu.stats.as_dict())
+        """
+        return _Recording(self)
+
+
+    def timer(self, stage, node=None):
+        """Context manager that adds its wall time to `stage` (and to the
+        emulator redshift `node`, if provided)."""
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, stage, node)
+
+
+    def record(self, stage, time, node=None):
+        """Add `time` [s] and one call to `stage` (and to the emulator
+        redshift `node`, if provided)."""
+        this_stage = self.__stages.setdefault(stage, {'calls': 0, 'time': 0., 'nodes': {}})
+        this_stage['calls']+= 1
+        this_stage['time']+= time
+        if node is not None:
+            this_node = this_stage['nodes'].setdefault(float(node), {'calls': 0, 'time': 0.})
+            this_node['calls']+= 1
+            this_node['time']+= time
+
+
+    def as_dict(self):
+        """Recorded timings as a dictionary {stage: {'calls': int, 'time':
+        float [s], 'nodes': {redshift: {'calls': int, 'time': float}}}}."""
+        return dict((stage, {'calls': value['calls'], 'time': value['time'],
+                             'nodes': dict((node, dict(v)) for node,v in value['nodes'].items())})
+                    for stage,value in self.__stages.items())
+
+
+class _Recording(object):
+    def __init__(self, stats):
+        self.stats = stats
+
+
+    def __enter__(self):
+        self.was_enabled = self.stats.enabled
+        self.stats.enable()
+        return self.stats
+
+
+    def __exit__(self, *args):
+        self.stats.enabled = self.was_enabled
+        return False
@@ -0,0 +1,59 @@
+import threading
+from collections import OrderedDict
+
+
+class LRUMemo(object):
+    """Bounded least-recently-used store of emulator outputs.
+
+    Entries are evicted once there are more than `max_size` entries or once
+    they take up more than `max_bytes` bytes in total.
+    """
+    def __init__(self, max_size, max_bytes=None):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.__entries = OrderedDict()
+        self.__nbytes = 0
+        self.__lock = threading.Lock()
+
+
+    def get(self, key):
+        """Return the value stored for `key` (None if there is none) and mark
+        it as most recently used."""
+        with self.__lock:
+            if key not in self.__entries:
+                self.misses+= 1
+                return None
+            self.hits+= 1
+            value, nbytes = self.__entries.pop(key)
+            self.__entries[key] = (value, nbytes)
+            return value
+
+
+    def put(self, key, value, nbytes):
+        """Store `value` that takes up `nbytes` bytes and evict the least
+        recently used entries to respect the limits."""
+        with self.__lock:
+            if key in self.__entries:
+                self.__nbytes-= self.__entries.pop(key)[1]
+            self.__entries[key] = (value, nbytes)
+            self.__nbytes+= nbytes
+            while len(self.__entries)>self.max_size or (self.max_bytes is not None and self.__nbytes>self.max_bytes):
+                self.__nbytes-= self.__entries.popitem(last=False)[1][1]
+
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.__nbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+
+    def info(self):
+        """Counters and current size as a dictionary."""
+        with self.__lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self.__entries), 'nbytes': self.__nbytes,
+                    'max_size': self.max_size, 'max_bytes': self.max_bytes}
@@ -0,0 +1,117 @@
+import numpy as np
+
+
+def linear_weights(grid, x):
+    """Indices and weights for linear interpolation on an ascending grid, such
+    that f(x) = (1-w)*f[idx] + w*f[idx+1]."""
+    idx = np.clip(np.searchsorted(grid, x, side='right') - 1, 0, len(grid) - 2)
+    w = (x - grid[idx]) / (grid[idx+1] - grid[idx])
+    return idx, w
+
+
+class EvaluationPlan(object):
+    """Pre-computed interpolation from the emulator output to a fixed set of
+    redshifts and masses. The plan holds the bracketing emulator nodes and
+    the linear weights in z and log10(M), such that evaluating the mass
+    function is a gather-and-weight operation over the emulator output.
+    Plans are obtained from `Emulator.evaluation_plan` and can be passed to
+    `Emulator.predict` and `Emulator.predict_batch`.
+
+    Attributes
+    -----------------
+    z : array
+        Requested redshifts.
+    m : array
+        Requested masses [Msun/h].
+    M_window : tuple
+        Range (start, stop) of the indices into the emulator mass grid that
+        contribute to the requested masses.
+    """
+    def __init__(self, z_emu, log10_M_emu, z, m):
+        """
+        :param z_emu: Ascending emulator redshifts.
+        :type z_emu: array
+
+        :param log10_M_emu: Ascending log10(mass) grid of the emulator output.
+        :type log10_M_emu: array
+
+        :param z: The redshift(s) for which the mass function is requested.
+        :type z: float or array
+
+        :param m: The mass(es) for which the mass function is requested, in
+            units [Msun/h].
+        :type m: float or array
+        """
+        # Validate requested z and m
+        if np.any(z<0):
+            raise ValueError("z must be >= 0")
+        if np.any(z>z_emu[-1]):
+            raise ValueError("z must be <= %.2f"%z_emu[-1])
+        if np.any(m<10**log10_M_emu[0]):
+            raise ValueError("m must be >= 1e%d"%log10_M_emu[0])
+        if np.any(m>10**log10_M_emu[-1]):
+            raise ValueError("m must be <= 1e%d"%log10_M_emu[-1])
+        self.z = np.atleast_1d(z)
+        self.m = np.atleast_1d(m)
+        self.N_z_emu = len(z_emu)
+        self.N_M_emu = len(log10_M_emu)
+
+        # Linear interpolation in z and log10(m)
+        self.z_idx, self.z_w = linear_weights(z_emu, self.z)
+        self.m_idx, self.m_w = linear_weights(log10_M_emu, np.log10(self.m))
+        self.M_window = (int(np.min(self.m_idx)), int(np.max(self.m_idx))+2)
+
+        # The errors of the two nearest emulator redshifts are weighted and
+        # added in quadrature
+        self.z_idx_err = np.argsort(np.abs(z_emu[None,:]-self.z[:,None]), axis=1)[:,:2]
+        z_nearest = z_emu[self.z_idx_err]
+        self.z_w_err = (self.z[:,None] - z_nearest) / (z_nearest[:,1] - z_nearest[:,0])[:,None]
+
+        # Emulator nodes with non-zero weights
+        self.z_ids = np.unique(np.concatenate((self.z_idx[self.z_w<1], self.z_idx[self.z_w>0]+1)))
+        self.z_ids_err = np.union1d(self.z_ids, self.z_idx_err[self.z_w_err!=0])
+
+
+    def __at_m(self, table):
+        """Interpolate a table [..., N_M_emu] or a table restricted to the
+        mass window [..., M_window[1]-M_window[0]] to the requested masses."""
+        m_idx = self.m_idx
+        if table.shape[-1]!=self.N_M_emu:
+            if table.shape[-1]!=self.M_window[1]-self.M_window[0]:
+                raise ValueError("Table must have %d or %d masses but has %d"%(
+                    self.N_M_emu, self.M_window[1]-self.M_window[0], table.shape[-1]))
+            m_idx = m_idx - self.M_window[0]
+        return table[...,m_idx] * (1-self.m_w) + table[...,m_idx+1] * self.m_w
+
+
+    def interpolate(self, table):
+        """Bilinear interpolation of a table of emulator output.
+
+        :param table: Emulator output with shape [..., N_z_emu, N_M_emu],
+            in the order of the ascending emulator redshifts and masses. The
+            table may also be restricted to the masses `M_window`.
+        :type table: array
+
+        :returns: Interpolated table with shape [..., len(z), len(m)].
+        :rtype: array
+        """
+        at_m = self.__at_m(table)
+        return at_m[...,self.z_idx,:] * (1-self.z_w)[:,None] + at_m[...,self.z_idx+1,:] * self.z_w[:,None]
+
+
+    def combine_errors(self, table):
+        """Interpolate a table of relative errors to the requested masses, and
+        add the weighted errors of the two nearest emulator redshifts in
+        quadrature.
+
+        :param table: Relative errors with shape [..., N_z_emu, N_M_emu], in
+            the order of the ascending emulator redshifts and masses. The
+            table may also be restricted to the masses `M_window`.
+        :type table: array
+
+        :returns: Relative errors with shape [..., len(z), len(m)].
+        :rtype: array
+        """
+        at_m = self.__at_m(table)
+        return np.sqrt((at_m[...,self.z_idx_err[:,0],:] * self.z_w_err[:,0,None])**2
+                       + (at_m[...,self.z_idx_err[:,1],:] * self.z_w_err[:,1,None])**2)
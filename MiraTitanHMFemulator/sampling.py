@@ -0,0 +1,114 @@
+import os
+
+import numpy as np
+
+
+def get_rng(rng):
+    """Return a random number generator.
+
+    :param rng: None for numpy's global random number generator, an existing
+        `numpy.random.Generator` or `numpy.random.RandomState`, or a seed for
+        a new generator.
+
+    :rtype: numpy.random.Generator or numpy.random.RandomState
+    """
+    if rng is None:
+        return np.random
+    if hasattr(rng, 'standard_normal'):
+        return rng
+    if hasattr(np.random, 'default_rng'):
+        return np.random.default_rng(rng)
+    return np.random.RandomState(rng)
+
+
+def factorize_covmat(covmat):
+    """Factor L of a (stack of) covariance matrices [..., N, N] such that
+    covmat = L L^T. Uses the Cholesky decomposition and falls back to an
+    eigendecomposition (with negative eigenvalues set to zero) for matrices
+    that are only positive semi-definite."""
+    try:
+        return np.linalg.cholesky(covmat)
+    except np.linalg.LinAlgError:
+        eigval, eigvec = np.linalg.eigh(covmat)
+        return eigvec * np.sqrt(np.clip(eigval, 0, None))[...,None,:]
+
+
+def draw(mean, factor, std_normals):
+    """Draw multivariate normal realizations from standard normal draws.
+
+    :param mean: Mean [N].
+    :param factor: Factor L [N, N] of the covariance matrix L L^T (see
+        `factorize_covmat`).
+    :param std_normals: Standard normal draws [N_draw, N].
+
+    :returns: Realizations [N_draw, N].
+    """
+    return mean + np.dot(std_normals, factor.T)
+
+
+def iter_chunks(N, chunk_size):
+    """Consecutive ranges (start, stop) of at most `chunk_size` of N items."""
+    for start in range(0, N, chunk_size):
+        yield start, min(start+chunk_size, N)
+
+
+class RunningStatistics(object):
+    """Mean and standard deviation of the rows of a stream of blocks
+    [N_rows, N], without keeping the rows in memory. The blocks are combined
+    with the parallel form of Welford's algorithm (Chan et al. 1979). Rows
+    with non-finite entries are skipped.
+
+    Attributes
+    -----------------
+    count : int
+        Number of (finite) rows.
+    mean : array
+        Mean of the rows [N].
+    """
+    def __init__(self, N):
+        self.count = 0
+        self.mean = np.zeros(N)
+        self.__M2 = np.zeros(N)
+
+
+    def update(self, block):
+        """Add the rows of `block` [N_rows, N]. Returns the finite rows."""
+        finite = np.all(np.isfinite(block), axis=1)
+        if not np.all(finite):
+            block = block[finite]
+        N_block = len(block)
+        if N_block==0:
+            return block
+        block_mean = np.mean(block, axis=0, dtype=np.float64)
+        block_M2 = np.sum((block - block_mean)**2, axis=0)
+        if self.count==0:
+            self.mean, self.__M2 = block_mean, block_M2
+        else:
+            count = self.count + N_block
+            delta = block_mean - self.mean
+            self.mean = self.mean + delta * (N_block/float(count))
+            self.__M2 = self.__M2 + block_M2 + delta**2 * (self.count*N_block/float(count))
+        self.count+= N_block
+        return block
+
+
+    def std(self):
+        """Standard deviation of the rows (normalized by the number of rows,
+        as `numpy.std`)."""
+        if self.count==0:
+            return np.nan * self.mean
+        return np.sqrt(self.__M2/self.count)
+
+
+def truncate_rows(filename, N_rows, chunk_size=1024):
+    """Keep only the first `N_rows` rows of the array in the `.npy` file
+    `filename`, copying them in chunks to a new file that replaces it."""
+    array = np.load(filename, mmap_mode='r')
+    tmp_filename = filename + '.tmp'
+    truncated = np.lib.format.open_memmap(tmp_filename, mode='w+', dtype=array.dtype,
+                                          shape=(N_rows,)+array.shape[1:])
+    for start, stop in iter_chunks(N_rows, chunk_size):
+        truncated[start:stop] = array[start:stop]
+    truncated.flush()
+    del array, truncated
+    getattr(os, 'replace', os.rename)(tmp_filename, filename)
@@ -0,0 +1,94 @@
+"""Emulator sessions for samplers that move one parameter at a time.
+
+The GP kernel is a product over the input dimensions, so its log is a sum of
+one term per parameter. A session keeps the log-kernel of the last evaluated
+cosmology against all design points, for every emulator redshift and PC. If
+the next cosmology only differs in a few parameters (e.g., in Gibbs, slice,
+or coordinate-wise sampling, or in one-dimensional scans), only the terms of
+these parameters are updated instead of recomputing the kernel from scratch.
+"""
+import numpy as np
+
+
+class Session(object):
+    """Kernel state of a sequence of evaluations of an emulator, created with
+    `Emulator.session`. Pass it as `session` to `Emulator.predict` or
+    `Emulator.predict_raw_emu`, or use the methods of the same names. The
+    results equal those without a session up to floating-point rounding.
+
+    A session holds the state of one sequence of cosmologies and must not be
+    shared between threads.
+
+    Attributes
+    -----------------
+    emulator : Emulator
+        The emulator.
+    counts : dict
+        Number of evaluations for which the kernel was computed from scratch
+        (`full`), updated for the parameters that changed (`incremental`), or
+        reused because no parameter changed (`unchanged`).
+    """
+    def __init__(self, emulator, stacked_GP, max_incremental_dims=4, refresh_interval=100):
+        """
+        :param emulator: The emulator.
+        :type emulator: Emulator
+
+        :param stacked_GP: The GPs of all emulator redshifts.
+        :type stacked_GP: StackedGaussianProcess
+
+        :param max_incremental_dims: Maximum number of changed parameters for
+            which the kernel is updated incrementally rather than recomputed.
+            Default is 4.
+        :type max_incremental_dims: int, optional
+
+        :param refresh_interval: Number of consecutive incremental updates
+            after which the kernel is recomputed from scratch, which bounds
+            the accumulation of rounding errors. Default is 100.
+        :type refresh_interval: int, optional
+        """
+        self.emulator = emulator
+        self.__stacked_GP = stacked_GP
+        self.max_incremental_dims = max_incremental_dims
+        self.refresh_interval = refresh_interval
+        self.reset()
+
+
+    def reset(self):
+        """Discard the kernel state and reset the counters."""
+        self.__x = None
+        self.__exponent = None
+        self.__N_incremental = 0
+        self.counts = {'full': 0, 'incremental': 0, 'unchanged': 0}
+
+
+    def kernel_exponent(self, x):
+        """Log of the GP kernel blocks of all emulator redshifts for the
+        normalized parameters `x` [8] (see `Emulator.normalize`), updated from
+        the previous call where possible.
+
+        :rtype: array [N_z, N_PC, 1, N_data]
+        """
+        x = np.array(x, dtype=float)
+        dims = None if self.__x is None else np.flatnonzero(x!=self.__x)
+        if dims is not None and len(dims)==0:
+            self.counts['unchanged']+= 1
+        elif dims is not None and len(dims)<=self.max_incremental_dims and self.__N_incremental<self.refresh_interval:
+            self.__stacked_GP.update_kernel_exponent(self.__exponent, self.__x, x, dims)
+            self.__N_incremental+= 1
+            self.counts['incremental']+= 1
+        else:
+            self.__exponent = np.ascontiguousarray(self.__stacked_GP.kernel_exponent(x[None,:]))
+            self.__N_incremental = 0
+            self.counts['full']+= 1
+        self.__x = x
+        return self.__exponent
+
+
+    def predict(self, requested_cosmology, z=None, m=None, **kwargs):
+        """`Emulator.predict` with this session."""
+        return self.emulator.predict(requested_cosmology, z, m, session=self, **kwargs)
+
+
+    def predict_raw_emu(self, requested_cosmology, **kwargs):
+        """`Emulator.predict_raw_emu` with this session."""
+        return self.emulator.predict_raw_emu(requested_cosmology, session=self, **kwargs)
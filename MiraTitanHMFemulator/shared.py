@@ -0,0 +1,93 @@
+"""Emulator state in a single memory-mapped file that several processes can
+map read-only, such that the operating system keeps only one copy of the data
+in memory.
+
+The file is placed in `/dev/shm` (shared memory) if available and in the
+temporary directory otherwise.
+"""
+import os
+
+import numpy as np
+
+# Byte alignment of the arrays within the file
+ALIGNMENT = 64
+
+SHARED_DIR = '/dev/shm'
+
+
+class SharedState(object):
+    """Handle of emulator state written with `create`. The handle is small
+    and can be pickled and passed to other processes, which map the file with
+    `load`.
+
+    Attributes
+    -----------------
+    filename : str
+        File that contains the arrays.
+    layout : list
+        (name, dtype, shape, offset) of each array in the file.
+    settings : dict
+        Settings of the emulator that wrote the state.
+    """
+    def __init__(self, filename, layout, settings):
+        self.filename = filename
+        self.layout = layout
+        self.settings = settings
+
+
+    def load(self):
+        """Memory-map the arrays read-only. Returns a dictionary of arrays
+        that do not copy the data."""
+        data = np.memmap(self.filename, dtype=np.uint8, mode='r')
+        arrays = {}
+        for name, dtype, shape, offset in self.layout:
+            size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            arrays[name] = data[offset:offset+size].view(dtype).reshape(shape)
+        return arrays
+
+
+    def unlink(self):
+        """Delete the file. On POSIX systems, processes that have already
+        mapped it can continue to use it. Windows cannot delete a file that is
+        still mapped, so all emulators attached to it must be released (e.g.,
+        by shutting down the worker processes) before."""
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.unlink()
+
+
+def create(arrays, settings, directory=None):
+    """Write the dictionary `arrays` to a new file in `directory` (default:
+    `/dev/shm` if available, otherwise the temporary directory) and return its
+    `SharedState`."""
+    import tempfile
+
+    if directory is None:
+        directory = SHARED_DIR if os.path.isdir(SHARED_DIR) and os.access(SHARED_DIR, os.W_OK) else None
+    layout = []
+    offset = 0
+    for name in sorted(arrays.keys()):
+        array = np.asarray(arrays[name])
+        layout.append((name, array.dtype.str, array.shape, offset))
+        offset+= -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+
+    fd, filename = tempfile.mkstemp(prefix='miratitan_hmf_', suffix='.bin', dir=directory)
+    os.close(fd)
+    try:
+        data = np.memmap(filename, dtype=np.uint8, mode='w+', shape=(max(offset, 1),))
+        for name, dtype, shape, this_offset in layout:
+            size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            data[this_offset:this_offset+size] = np.ascontiguousarray(arrays[name]).view(np.uint8).ravel()
+        data.flush()
+        del data
+    except Exception:
+        os.remove(filename)
+        raise
+    return SharedState(filename, layout, settings)
@@ -0,0 +1,170 @@
+"""Evaluation of the emulator for long chains of cosmologies in chunks, with
+the results written to memory-mapped `.npy` files. Memory use is bounded by
+the chunk size, and interrupted evaluations can be resumed from a checkpoint.
+"""
+import json
+import os
+
+import numpy as np
+
+CHECKPOINT_FILENAME = 'checkpoint.json'
+
+
+def load_cosmologies(cosmologies):
+    """Memory-map a `.npy` file of cosmologies (array [N, 8] or structured
+    array), or return the array `cosmologies` unchanged."""
+    if isinstance(cosmologies, str):
+        return np.load(cosmologies, mmap_mode='r')
+    return cosmologies
+
+
+def iter_chain(emulator, cosmologies, z=None, m=None, plan=None, chunk_size=1024, start=0, seed=None,
+               **predict_kwargs):
+    """Evaluate `Emulator.predict_batch` for consecutive chunks of a chain of
+    cosmologies.
+
+    :param emulator: The emulator.
+    :type emulator: Emulator
+
+    :param cosmologies: Array of cosmologies (see `Emulator.predict_batch`)
+        or name of a `.npy` file that contains one, which is memory-mapped.
+    :type cosmologies: array or str
+
+    :param chunk_size: Number of cosmologies per chunk. Default is 1024.
+    :type chunk_size: int, optional
+
+    :param start: Index of the first cosmology to evaluate, must be a multiple
+        of `chunk_size` or the number of cosmologies (nothing to evaluate).
+        Default is 0.
+    :type start: int, optional
+
+    :param seed: Seed for the error realizations. Chunk k draws from a
+        generator seeded with (seed, k), such that the results do not depend
+        on where an evaluation was resumed.
+    :type seed: int, optional
+
+    All other arguments are passed to `Emulator.predict_batch`.
+
+    :returns: Generator of (start, stop, HMF, HMF_rel_err) for each chunk.
+    """
+    cosmologies = load_cosmologies(cosmologies)
+    if plan is None:
+        plan = emulator.evaluation_plan(z, m)
+    if start%chunk_size!=0 and start!=len(cosmologies):
+        raise ValueError("start %d must be a multiple of chunk_size %d"%(start, chunk_size))
+    for chunk_start in range(start, len(cosmologies), chunk_size):
+        chunk_stop = min(chunk_start+chunk_size, len(cosmologies))
+        if seed is not None:
+            predict_kwargs['rng'] = [seed, chunk_start//chunk_size]
+        HMF, HMF_err = emulator.predict_batch(np.asarray(cosmologies[chunk_start:chunk_stop]), plan=plan,
+                                              **predict_kwargs)
+        yield chunk_start, chunk_stop, HMF, HMF_err
+
+
+def evaluate_chain(emulator, cosmologies, output_dir, z=None, m=None, chunk_size=1024, get_errors=True,
+                   N_draw=1000, error_method='sample', seed=None, resume=True, callback=None):
+    """Evaluate the emulator for every cosmology of a chain and write the
+    mass functions and their relative errors to memory-mapped files
+    `HMF.npy` and `HMF_err.npy` [N, len(z), len(m)] in `output_dir` (together
+    with `z.npy` and `m.npy`). After every chunk, the files are flushed and
+    the number of evaluated cosmologies is recorded in `checkpoint.json`, such
+    that an interrupted evaluation continues where it stopped.
+
+    :param emulator: The emulator.
+    :type emulator: Emulator
+
+    :param cosmologies: Array of N cosmologies (see `Emulator.predict_batch`)
+        or name of a `.npy` file that contains one, which is memory-mapped.
+    :type cosmologies: array or str
+
+    :param output_dir: Directory of the output files.
+    :type output_dir: str
+
+    :param z: The redshift(s) for which the mass function is requested.
+    :type z: float or array
+
+    :param m: The mass(es) for which the mass function is requested, in
+        units [Msun/h].
+    :type m: float or array
+
+    :param chunk_size: Number of cosmologies per chunk. Default is 1024.
+    :type chunk_size: int, optional
+
+    :param get_errors: Whether or not to compute error estimates. If False, no
+        `HMF_err.npy` is written. Default is True.
+    :type get_errors: bool, optional
+
+    :param N_draw: See `Emulator.predict_batch`.
+    :type N_draw: int, optional
+
+    :param error_method: See `Emulator.predict_batch`.
+    :type error_method: str, optional
+
+    :param seed: Seed for the error realizations, see `iter_chain`. With a
+        seed, a resumed evaluation gives the same results as an uninterrupted
+        one.
+    :type seed: int, optional
+
+    :param resume: Whether to continue from the checkpoint in `output_dir`, if
+        any. The checkpoint must have been written with the same settings. If
+        False, existing output is overwritten. Default is True.
+    :type resume: bool, optional
+
+    :param callback: Function called as callback(stop, N) after each chunk,
+        when the first `stop` cosmologies have been written.
+    :type callback: callable, optional
+
+    :returns: The read-only memory-mapped mass functions and relative errors
+        (None if `get_errors` is False).
+    :rtype: tuple
+    """
+    cosmologies = load_cosmologies(cosmologies)
+    plan = emulator.evaluation_plan(z, m)
+    N = len(cosmologies)
+    shape = (N, len(plan.z), len(plan.m))
+    settings = {'N': N, 'z': plan.z.tolist(), 'm': plan.m.tolist(), 'chunk_size': chunk_size,
+                'get_errors': get_errors, 'N_draw': N_draw, 'error_method': error_method, 'seed': seed}
+
+    filenames = [os.path.join(output_dir, name) for name in ['HMF.npy', 'HMF_err.npy']]
+    checkpoint_filename = os.path.join(output_dir, CHECKPOINT_FILENAME)
+    N_done = 0
+    if resume and os.path.isfile(checkpoint_filename):
+        with open(checkpoint_filename, 'r') as f:
+            checkpoint = json.load(f)
+        if checkpoint['settings']!=json.loads(json.dumps(settings)):
+            raise ValueError("The checkpoint in %s was written with different settings"%output_dir)
+        N_done = checkpoint['N_done']
+
+    if N_done==0:
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        np.save(os.path.join(output_dir, 'z.npy'), plan.z)
+        np.save(os.path.join(output_dir, 'm.npy'), plan.m)
+        outputs = [np.lib.format.open_memmap(filename, mode='w+', dtype=np.float64, shape=shape)
+                   for filename in filenames[:1+get_errors]]
+        _write_checkpoint(checkpoint_filename, settings, 0)
+    else:
+        outputs = [np.lib.format.open_memmap(filename, mode='r+') for filename in filenames[:1+get_errors]]
+
+    for start, stop, HMF, HMF_err in iter_chain(emulator, cosmologies, plan=plan, chunk_size=chunk_size, start=N_done,
+                                                seed=seed, get_errors=get_errors, N_draw=N_draw,
+                                                error_method=error_method):
+        for output, values in zip(outputs, [HMF, HMF_err]):
+            output[start:stop] = values
+            output.flush()
+        _write_checkpoint(checkpoint_filename, settings, stop)
+        if callback is not None:
+            callback(stop, N)
+    del outputs
+
+    results = [np.load(filename, mmap_mode='r') for filename in filenames[:1+get_errors]]
+    return results[0], results[1] if get_errors else None
+
+
+def _write_checkpoint(filename, settings, N_done):
+    """Write the checkpoint to a temporary file first, such that an
+    interruption never leaves an incomplete checkpoint."""
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as f:
+        json.dump({'settings': settings, 'N_done': N_done}, f)
+    getattr(os, 'replace', os.rename)(tmp_filename, filename)
@@ -1,19 +1,142 @@
+import gc
 import numpy as np
 import inspect
 import os
+import pickle
 import pytest
+import scipy.linalg
+import subprocess
+import sys
 
 import MiraTitanHMFemulator
+from MiraTitanHMFemulator import cli
+from MiraTitanHMFemulator import counts
+from MiraTitanHMFemulator import GP_matrix
+from MiraTitanHMFemulator import sampling
+from MiraTitanHMFemulator import stream
+from MiraTitanHMFemulator import training
 
 class TestClass:
     z_arr = np.linspace(0, 2.02, 4)
     m_arr = np.logspace(13, 16, 31)
+    # Tolerance of accelerated code paths with respect to the reference output
+    rtol_accelerated = 1e-6
+    # Tolerance of the analytic error estimate with respect to the reference
+    # output based on 1000 draws
+    rtol_analytic_errors = .1
+    # Agreement of single-precision evaluation with the reference outputs
+    rtol_float32 = 1e-5
+    # Upper limit on the time [s] to import the package (after numpy)
+    max_import_time = 1.
 
 
     def test_init(self):
         self.HMFemu = MiraTitanHMFemulator.Emulator()
 
 
+    def test_cache(self, tmpdir):
+        cache_dir = str(tmpdir.join('cache'))
+        fiducial_cosmo = {'Ommh2': .3*.7**2,
+                          'Ombh2': .022,
+                          'Omnuh2': .006,
+                          'n_s': .96,
+                          'h': .7,
+                          'w_0': -1,
+                          'w_a': 0,
+                          'sigma_8': .8,
+                          }
+
+        # The first instance fills the cache, the second one reads from it
+        res = []
+        for i in range(2):
+            HMFemu = MiraTitanHMFemulator.Emulator(cache_dir=cache_dir)
+            assert len(os.listdir(cache_dir))==1
+            np.random.seed(1328)
+            res.append(HMFemu.predict(fiducial_cosmo.copy(), self.z_arr, self.m_arr))
+        assert np.all(res[0][0]==res[1][0])
+        assert np.all(res[0][1]==res[1][1])
+
+
+    def test_kernel(self):
+        rng = np.random.RandomState(42)
+        x = rng.uniform(size=(20, 3))
+        y = rng.normal(size=(20, 2))
+        rho = rng.uniform(.2, 1, size=(2, 3))
+        GPreg = GP_matrix.GaussianProcess(x, y, 1e-8*np.eye(40), np.array([1., 2.]), rho)
+
+        # Vectorized kernel matches the point-by-point reference
+        for i in range(2):
+            ref = [[GPreg.compute_rho_corr_func_point(x[j], x[k], rho[i]) for k in range(20)] for j in range(20)]
+            assert np.allclose(GPreg.compute_rho_corr_func(x, x, rho[i]), ref)
+
+        # Prediction at a design point reproduces the training data
+        mean, covmat = GPreg.predict(x[3])
+        assert np.allclose(mean, y[3], atol=1e-2)
+        assert covmat.shape==(2, 2)
+
+        # Pre-computed predictive operators match the dense solve with the
+        # full correlation vector
+        x_new = rng.uniform(size=(5, 3))
+        corr_xnew_x = np.zeros((5, 2, 40))
+        for i in range(2):
+            corr_xnew_x[:,i,i*20:(i+1)*20] = GPreg.compute_rho_corr_func(x_new, x, rho[i]) / GPreg.prec_f[i]
+        cov = GPreg.corrmat + 1e-8*np.eye(40)
+        ref_mean = np.dot(corr_xnew_x, np.linalg.solve(cov, GPreg.y_flat))
+        ref_covmat = np.diag(1./GPreg.prec_f) - np.matmul(corr_xnew_x, np.linalg.solve(cov, np.swapaxes(corr_xnew_x, 1, 2)))
+        mean, covmat = GPreg.predict_batch(x_new)
+        assert np.allclose(mean, ref_mean, rtol=1e-8, atol=0)
+        assert np.allclose(covmat, ref_covmat, rtol=1e-8, atol=1e-12)
+        for lower in [False, True]:
+            cholesky_factor = scipy.linalg.cho_factor(cov, lower=lower)
+            GPreg_fact = GP_matrix.GaussianProcess.from_factorization(x, GPreg.prec_f, rho, cholesky_factor,
+                                                                      GPreg.Krig_basis)
+            assert np.allclose(GPreg_fact.predict_batch(x_new)[1], covmat, rtol=1e-10, atol=1e-14)
+        GPreg_fact = GP_matrix.GaussianProcess.from_factorization(x, GPreg.prec_f, rho, GPreg.cholesky_factor,
+                                                                  GPreg.Krig_basis, GPreg.predictive_operator)
+        assert np.all(GPreg_fact.predict_batch(x_new)[1]==covmat)
+
+
+    def test_stacked_GP(self):
+        rng = np.random.RandomState(42)
+        x = rng.uniform(size=(20, 3))
+        processes = [GP_matrix.GaussianProcess(x, rng.normal(size=(20, 2)), 1e-8*np.eye(40),
+                                               rng.uniform(.5, 2, size=2), rng.uniform(.2, 1, size=(2, 3)))
+                     for i in range(3)]
+        stacked_GP = GP_matrix.StackedGaussianProcess(processes)
+        x_new = rng.uniform(size=(5, 3))
+        mean, covmat = stacked_GP.predict_batch(x_new)
+        assert mean.shape==(3, 5, 2)
+        assert covmat.shape==(3, 5, 2, 2)
+        for i,GPreg in enumerate(processes):
+            ref = GPreg.predict_batch(x_new)
+            assert np.allclose(mean[i], ref[0], rtol=1e-12, atol=0)
+            assert np.allclose(covmat[i], ref[1], rtol=1e-10, atol=1e-14)
+        for stack_ids in [slice(1, 3), [0, 2]]:
+            res = stacked_GP.predict_batch(x_new, stack_ids)
+            assert np.all(res[0]==mean[stack_ids])
+            assert np.all(res[1]==covmat[stack_ids])
+        res = stacked_GP.predict(x_new[1])
+        assert np.allclose(res[1], covmat[:,1], rtol=1e-12, atol=1e-16)
+
+        # Different design points cannot be stacked
+        processes.append(GP_matrix.GaussianProcess(x+.1, rng.normal(size=(20, 2)), 1e-8*np.eye(40),
+                                                   np.ones(2), np.ones((2, 3))*.5))
+        with pytest.raises(TypeError):
+            GP_matrix.StackedGaussianProcess(processes)
+
+        # The lazy emulator evaluates the GPs one by one until all are set up
+        HMFemu = MiraTitanHMFemulator.Emulator()
+        HMFemu_lazy = MiraTitanHMFemulator.Emulator(lazy=True)
+        cosmologies = np.array([[.3*.7**2, .022, .006, .96, .7, .8, -1, 0],
+                                [.14, .022, .004, .95, .65, .75, -.9, -.2]])
+        for get_errors in [False, True]:
+            res = HMFemu_lazy.predict_batch(cosmologies, .3, self.m_arr, get_errors=get_errors,
+                                            error_method='analytic')
+            ref = HMFemu.predict_batch(cosmologies, .3, self.m_arr, get_errors=get_errors, error_method='analytic')
+            assert np.allclose(res[0], ref[0], rtol=1e-12, atol=0)
+            assert np.allclose(res[1], ref[1], rtol=1e-10, atol=1e-14)
+
+
     def test_translate_params(self):
         HMFemu = MiraTitanHMFemulator.Emulator()
         fiducial_cosmo_no_underscore = {'Ommh2': .3*.7**2,
@@ -194,3 +317,881 @@ class TestClass:
         # np.save(_fname, res[1])
         ref = np.load(_fname)
         assert np.all(np.isclose(res[1], ref))
+
+
+    def test_batch(self):
+        data_path = os.path.dirname(os.path.abspath(inspect.stack()[0][1]))
+
+        HMFemu = MiraTitanHMFemulator.Emulator()
+
+        fiducial_cosmo = {'Ommh2': .3*.7**2,
+                          'Ombh2': .022,
+                          'Omnuh2': .006,
+                          'n_s': .96,
+                          'h': .7,
+                          'w_0': -1,
+                          'w_a': 0,
+                          'sigma_8': .8,
+                          }
+        mid_cosmo = {}
+        for k in ['Ommh2', 'Ombh2', 'Omnuh2', 'n_s', 'h', 'sigma_8', 'w_0']:
+            mid_cosmo[k] = .5 * np.sum(HMFemu.param_limits[k])
+        mid_cosmo['w_a'] = .5 * (-1.73 + 1.28)
+
+        # Structured array, list of dicts, and parameter array
+        params = np.array([[c[k] for k in HMFemu.input_param_names] for c in [fiducial_cosmo, mid_cosmo]])
+        cosmo_struct = np.zeros(2, dtype=[(k, float) for k in HMFemu.input_param_names])
+        for i,k in enumerate(HMFemu.input_param_names):
+            cosmo_struct[k] = params[:,i]
+        for cosmologies in [params, cosmo_struct, [fiducial_cosmo, mid_cosmo]]:
+            np.random.seed(1328)
+            res = HMFemu.predict_batch(cosmologies, self.z_arr, self.m_arr)
+            assert res[0].shape==(2, len(self.z_arr), len(self.m_arr))
+            assert np.all(np.isclose(res[0][0], np.load(os.path.join(data_path, 'fid.npy'))))
+            assert np.all(np.isclose(res[0][1], np.load(os.path.join(data_path, 'mid.npy'))))
+            # Same draws as in a sequence of predict calls
+            np.random.seed(1328)
+            for i,c in enumerate([fiducial_cosmo, mid_cosmo]):
+                ref = HMFemu.predict(c.copy(), self.z_arr, self.m_arr)
+                assert np.all(np.isclose(res[0][i], ref[0]))
+                assert np.all(np.isclose(res[1][i], ref[1]))
+
+        with pytest.raises(ValueError):
+            HMFemu.predict_batch(params[:,:7], self.z_arr, self.m_arr)
+        _params = params.copy()
+        _params[1,4] = 2
+        with pytest.raises(ValueError):
+            HMFemu.predict_batch(_params, self.z_arr, self.m_arr)
+
+
+    def test_lazy(self):
+        data_path = os.path.dirname(os.path.abspath(inspect.stack()[0][1]))
+
+        HMFemu = MiraTitanHMFemulator.Emulator(lazy=True)
+        fiducial_cosmo = {'Ommh2': .3*.7**2,
+                          'Ombh2': .022,
+                          'Omnuh2': .006,
+                          'n_s': .96,
+                          'h': .7,
+                          'w_0': -1,
+                          'w_a': 0,
+                          'sigma_8': .8,
+                          }
+
+        # Only the two emulator redshifts bracketing z=0.2 are set up
+        res = HMFemu.predict(fiducial_cosmo.copy(), .2, self.m_arr, get_errors=False)
+        assert sum(GPreg is not None for GPreg in HMFemu._Emulator__GPreg)==2
+        HMFemu_full = MiraTitanHMFemulator.Emulator()
+        ref = HMFemu_full.predict(fiducial_cosmo.copy(), .2, self.m_arr, get_errors=False)
+        assert np.all(np.isclose(res[0], ref[0]))
+
+        res = HMFemu.predict(fiducial_cosmo.copy(), self.z_arr, self.m_arr, get_errors=False)
+        ref = np.load(os.path.join(data_path, 'fid.npy'))
+        assert np.all(np.isclose(res[0], ref))
+
+        res = HMFemu.predict_raw_emu(fiducial_cosmo.copy(), z_emu=HMFemu.z_arr[:2])
+        assert len(res)==3
+        with pytest.raises(ValueError):
+            HMFemu.predict_raw_emu(fiducial_cosmo.copy(), z_emu=.5)
+
+
+    def test_plan(self):
+        data_path = os.path.dirname(os.path.abspath(inspect.stack()[0][1]))
+
+        HMFemu = MiraTitanHMFemulator.Emulator()
+        fiducial_cosmo = {'Ommh2': .3*.7**2,
+                          'Ombh2': .022,
+                          'Omnuh2': .006,
+                          'n_s': .96,
+                          'h': .7,
+                          'w_0': -1,
+                          'w_a': 0,
+                          'sigma_8': .8,
+                          }
+        plan = HMFemu.evaluation_plan(self.z_arr, self.m_arr)
+
+        np.random.seed(1328)
+        res = HMFemu.predict(fiducial_cosmo, plan=plan)
+        assert np.all(np.isclose(res[0], np.load(os.path.join(data_path, 'fid.npy'))))
+        assert np.all(np.isclose(res[1], np.load(os.path.join(data_path, 'fid_err.npy'))))
+
+        res = HMFemu.predict_batch([fiducial_cosmo], plan=plan, get_errors=False)
+        assert np.all(np.isclose(res[0][0], np.load(os.path.join(data_path, 'fid.npy'))))
+
+        with pytest.raises(TypeError):
+            HMFemu.predict(fiducial_cosmo)
+        with pytest.raises(TypeError):
+            HMFemu.predict(fiducial_cosmo, self.z_arr, self.m_arr, plan=plan)
+        with pytest.raises(ValueError):
+            HMFemu.evaluation_plan(3, self.m_arr)
+
+
+    def test_random_draws(self):
+        HMFemu = MiraTitanHMFemulator.Emulator()
+        fiducial_cosmo = {'Ommh2': .3*.7**2,
+                          'Ombh2': .022,
+                          'Omnuh2': .006,
+                          'n_s': .96,
+                          'h': .7,
+                          'w_0': -1,
+                          'w_a': 0,
+                          'sigma_8': .8,
+                          }
+
+        # Reproducible with a seed, independent of the global state
+        res = [HMFemu.predict(fiducial_cosmo.copy(), self.z_arr, self.m_arr, N_draw=100, rng=42) for i in range(2)]
+        assert np.all(res[0][1]==res[1][1])
+
+        # Common random numbers
+        std_normals = HMFemu.draw_standard_normals(100, rng=42)
+        res = HMFemu.predict(fiducial_cosmo.copy(), self.z_arr, self.m_arr, N_draw=100, std_normals=std_normals)
+        res_batch = HMFemu.predict_batch([fiducial_cosmo, fiducial_cosmo], self.z_arr, self.m_arr, N_draw=100, std_normals=std_normals)
+        assert np.all(np.isclose(res_batch[1][0], res[1]))
+        assert np.all(np.isclose(res_batch[1][1], res[1]))
+        with pytest.raises(ValueError):
+            HMFemu.predict(fiducial_cosmo.copy(), self.z_arr, self.m_arr, N_draw=1000, std_normals=std_normals)
+
+        # Positive semi-definite covariance matrix
+        covmat = np.array([[1., 1.], [1., 1.]])
+        factor = sampling.factorize_covmat(covmat)
+        assert np.allclose(np.dot(factor, factor.T), covmat)
+
+
+    def test_analytic_errors(self):
+        HMFemu = MiraTitanHMFemulator.Emulator()
+        fiducial_cosmo = {'Ommh2': .3*.7**2,
+                          'Ombh2': .022,
+                          'Omnuh2': .006,
+                          'n_s': .96,
+                          'h': .7,
+                          'w_0': -1,
+                          'w_a': 0,
+                          'sigma_8': .8,
+                          }
+
+        res = HMFemu.predict(fiducial_cosmo.copy(), self.z_arr, self.m_arr, error_method='analytic')
+        ref = HMFemu.predict(fiducial_cosmo.copy(), self.z_arr, self.m_arr, N_draw=20000, rng=1328)
+        assert np.all(np.isclose(res[1], ref[1], rtol=.05, atol=1e-4))
+
+        res_batch = HMFemu.predict_batch([fiducial_cosmo], self.z_arr, self.m_arr, error_method='analytic')
+        assert np.all(np.isclose(res_batch[1][0], res[1]))
+
+        res = HMFemu.predict_raw_emu(fiducial_cosmo.copy(), error_method='analytic')
+        for emu_z in HMFemu.z_arr:
+            assert np.all(res[emu_z]['HMF_mean']>=res[emu_z]['HMF'])
+            assert np.all(res[emu_z]['HMF_std']>0)
+
+        with pytest.raises(ValueError):
+            HMFemu.predict(fiducial_cosmo.copy(), self.z_arr, self.m_arr, error_method='exact')
+
+
+    def test_executor(self):
+        HMFemu = MiraTitanHMFemulator.Emulator()
+        cosmologies = np.array([[.3*.7**2, .022, .006, .96, .7, .8, -1, 0],
+                                [.14, .022, .004, .95, .65, .75, -.9, -.2],
+                                [.13, .023, .002, 1., .75, .85, -1.1, .1]])
+        ref = HMFemu.predict_batch(cosmologies, self.z_arr, self.m_arr, error_method='analytic')
+
+        res = []
+        for backend, N_workers, shared in [('thread', 2, False), ('process', 2, False), ('process', 1, False), ('process', 2, True)]:
+            with MiraTitanHMFemulator.BatchExecutor(N_workers, backend=backend, chunk_size=2, shared=shared) as executor:
+                this_res = executor.predict(cosmologies, self.z_arr, self.m_arr, error_method='analytic')
+                assert np.all(np.isclose(this_res[0], ref[0]))
+                assert np.all(np.isclose(this_res[1], ref[1]))
+                assert [(t['start'], t['stop']) for t in executor.timings]==[(0, 2), (2, 3)]
+                res.append(executor.predict(cosmologies, self.z_arr, self.m_arr, N_draw=100, seed=1328))
+
+        # Seeded draws do not depend on the backend or the number of workers
+        for this_res in res[1:]:
+            assert np.all(this_res[1]==res[0][1])
+
+        # Without a seed, chunks on different workers draw different
+        # realizations
+        with MiraTitanHMFemulator.BatchExecutor(2, chunk_size=1) as executor:
+            res = executor.predict(cosmologies[[0, 0, 0, 0]], self.z_arr, self.m_arr, N_draw=100)
+        for i in range(1, 4):
+            assert not np.all(res[1][i]==res[1][0])
+
+
+    def test_memo(self):
+        HMFemu = MiraTitanHMFemulator.Emulator(memo_size=2)
+        fiducial_cosmo = {'Ommh2': .3*.7**2,
+                          'Ombh2': .022,
+                          'Omnuh2': .006,
+                          'n_s': .96,
+                          'h': .7,
+                          'w_0': -1,
+                          'w_a': 0,
+                          'sigma_8': .8,
+                          }
+
+        res = [HMFemu.predict(fiducial_cosmo.copy(), self.z_arr, self.m_arr, N_draw=100) for i in range(2)]
+        assert np.all(res[0][0]==res[1][0])
+        assert np.all(res[0][1]==res[1][1])
+        info = HMFemu.memo_info()
+        assert (info['hits'], info['misses'], info['size'])==(1, 1, 1)
+
+        # Returned draws are new and do not replace the stored error estimate
+        res_draws = HMFemu.predict_raw_emu(fiducial_cosmo.copy(), N_draw=100, return_draws=True)
+        res_raw = HMFemu.predict_raw_emu(fiducial_cosmo.copy(), N_draw=100)
+        for emu_z in HMFemu.z_arr:
+            assert res_draws[emu_z]['HMF_draws'].shape[1]==len(res_raw[emu_z]['HMF'])
+            assert not np.all(res_draws[emu_z]['HMF_std']==res_raw[emu_z]['HMF_std'])
+            assert 'HMF_draws' not in res_raw[emu_z]
+        assert np.all(HMFemu.predict(fiducial_cosmo.copy(), self.z_arr, self.m_arr, N_draw=100)[1]==res[0][1])
+
+        # Modifying the output does not modify the stored output
+        res = HMFemu.predict_raw_emu(fiducial_cosmo.copy(), N_draw=100)
+        res[0.0]['HMF'][:] = 0
+        assert np.all(HMFemu.predict_raw_emu(fiducial_cosmo.copy(), N_draw=100)[0.0]['HMF']>0)
+
+        # Least recently used outputs are evicted
+        for sigma_8 in [.75, .85]:
+            _cosmo = fiducial_cosmo.copy()
+            _cosmo['sigma_8'] = sigma_8
+            HMFemu.predict(_cosmo, self.z_arr, self.m_arr, get_errors=False)
+        assert HMFemu.memo_info()['size']==2
+        HMFemu.memo_clear()
+        assert HMFemu.memo_info()['size']==0
+        assert MiraTitanHMFemulator.Emulator().memo_info() is None
+
+        # The GP output of each emulator redshift is reused for other
+        # redshifts
+        HMFemu = MiraTitanHMFemulator.Emulator(memo_size=2, lazy=True, instrument=True)
+        HMFemu_ref = MiraTitanHMFemulator.Emulator(lazy=True)
+        for z_emu in [HMFemu.z_arr[:2], HMFemu.z_arr[1:3]]:
+            res = HMFemu.predict_raw_emu(fiducial_cosmo.copy(), z_emu=z_emu, error_method='analytic')
+            ref = HMFemu_ref.predict_raw_emu(fiducial_cosmo.copy(), z_emu=z_emu, error_method='analytic')
+            for emu_z in z_emu:
+                for key in ['HMF', 'HMF_mean', 'HMF_std']:
+                    assert np.allclose(res[emu_z][key], ref[emu_z][key], rtol=1e-12, atol=0)
+        info = HMFemu.memo_info()
+        assert (info['hits'], info['misses'], info['size'])==(1, 1, 1)
+        # Only the GP of the new emulator redshift is evaluated
+        assert HMFemu.stats.as_dict()['gp']['calls']==3
+
+
+    def test_gradient(self):
+        data_path = os.path.dirname(os.path.abspath(inspect.stack()[0][1]))
+
+        HMFemu = MiraTitanHMFemulator.Emulator()
+        fiducial_cosmo = {'Ommh2': .3*.7**2,
+                          'Ombh2': .022,
+                          'Omnuh2': .006,
+                          'n_s': .96,
+                          'h': .7,
+                          'w_0': -1,
+                          'w_a': -.1,
+                          'sigma_8': .8,
+                          }
+        z_arr = np.array([0, .3, 1, 2])
+        m_arr = np.logspace(13, 15, 11)
+
+        HMF, HMF_grad = HMFemu.predict_with_gradient(fiducial_cosmo.copy(), z_arr, m_arr)
+        assert HMF_grad.shape==(len(z_arr), len(m_arr), 8)
+        assert np.all(np.isclose(HMF, HMFemu.predict(fiducial_cosmo.copy(), z_arr, m_arr, get_errors=False)[0]))
+
+        # Compare to central finite differences
+        for i,param in enumerate(HMFemu.input_param_names):
+            step = 1e-6
+            _cosmo_plus, _cosmo_minus = fiducial_cosmo.copy(), fiducial_cosmo.copy()
+            _cosmo_plus[param]+= step
+            _cosmo_minus[param]-= step
+            HMF_plus = HMFemu.predict(_cosmo_plus, z_arr, m_arr, get_errors=False)[0]
+            HMF_minus = HMFemu.predict(_cosmo_minus, z_arr, m_arr, get_errors=False)[0]
+            HMF_grad_fd = (HMF_plus - HMF_minus) / (2*step)
+            assert np.all(np.isclose(HMF_grad[:,:,i], HMF_grad_fd, rtol=1e-3, atol=1e-3*np.max(np.abs(HMF_grad_fd))))
+
+        # Fiducial mass function
+        fiducial_cosmo['w_a'] = 0
+        HMF, HMF_grad = HMFemu.predict_with_gradient(fiducial_cosmo.copy(), self.z_arr, self.m_arr)
+        assert np.all(np.isclose(HMF, np.load(os.path.join(data_path, 'fid.npy'))))
+
+
+    def test_accelerated_paths(self):
+        data_path = os.path.dirname(os.path.abspath(inspect.stack()[0][1]))
+
+        HMFemu = MiraTitanHMFemulator.Emulator()
+        HMFemu_lazy = MiraTitanHMFemulator.Emulator(lazy=True)
+        HMFemu_memo = MiraTitanHMFemulator.Emulator(memo_size=4)
+        plan = HMFemu.evaluation_plan(self.z_arr, self.m_arr)
+
+        fiducial_cosmo = {'Ommh2': .3*.7**2,
+                          'Ombh2': .022,
+                          'Omnuh2': .006,
+                          'n_s': .96,
+                          'h': .7,
+                          'w_0': -1,
+                          'w_a': 0,
+                          'sigma_8': .8,
+                          }
+        mid_cosmo = {}
+        for k in ['Ommh2', 'Ombh2', 'Omnuh2', 'n_s', 'h', 'sigma_8', 'w_0']:
+            mid_cosmo[k] = .5 * np.sum(HMFemu.param_limits[k])
+        mid_cosmo['w_a'] = .5 * (-1.73 + 1.28)
+
+        for cosmo, name in [(fiducial_cosmo, 'fid'), (mid_cosmo, 'mid')]:
+            ref = np.load(os.path.join(data_path, '%s.npy'%name))
+            ref_err = np.load(os.path.join(data_path, '%s_err.npy'%name))
+            paths = {
+                'plan': lambda: HMFemu.predict(cosmo.copy(), plan=plan, get_errors=False)[0],
+                'batch': lambda: HMFemu.predict_batch([cosmo], self.z_arr, self.m_arr, get_errors=False)[0][0],
+                'lazy': lambda: HMFemu_lazy.predict(cosmo.copy(), self.z_arr, self.m_arr, get_errors=False)[0],
+                'memo': lambda: HMFemu_memo.predict(cosmo.copy(), self.z_arr, self.m_arr, get_errors=False)[0],
+                'gradient': lambda: HMFemu.predict_with_gradient(cosmo.copy(), self.z_arr, self.m_arr)[0],
+            }
+            for path in sorted(paths.keys()):
+                for i in range(2):
+                    assert np.allclose(paths[path](), ref, rtol=self.rtol_accelerated, atol=0), path
+
+            res = HMFemu.predict(cosmo.copy(), self.z_arr, self.m_arr, error_method='analytic')
+            assert np.allclose(res[0], ref, rtol=self.rtol_accelerated, atol=0)
+            assert np.allclose(res[1], ref_err, rtol=self.rtol_analytic_errors, atol=1e-4)
+
+
+    def test_stats(self):
+        HMFemu = MiraTitanHMFemulator.Emulator(lazy=True)
+        fiducial_cosmo = {'Ommh2': .3*.7**2,
+                          'Ombh2': .022,
+                          'Omnuh2': .006,
+                          'n_s': .96,
+                          'h': .7,
+                          'w_0': -1,
+                          'w_a': 0,
+                          'sigma_8': .8,
+                          }
+
+        # Nothing is recorded unless enabled
+        HMFemu.predict(fiducial_cosmo.copy(), .5, 1e14, N_draw=10)
+        assert HMFemu.stats.as_dict()=={}
+
+        with HMFemu.stats.recording():
+            HMFemu.predict(fiducial_cosmo.copy(), HMFemu.z_arr, self.m_arr, N_draw=10)
+            HMFemu.predict_batch([fiducial_cosmo]*2, HMFemu.z_arr, self.m_arr, error_method='analytic')
+        assert not HMFemu.stats.enabled
+        stats = HMFemu.stats.as_dict()
+        for stage in ['setup', 'validate', 'gp', 'pca', 'draws', 'filter', 'analytic_errors', 'interpolate']:
+            assert stats[stage]['calls']>0, stage
+            assert stats[stage]['time']>=0, stage
+        assert sorted(stats['pca']['nodes'].keys())==sorted(HMFemu.z_arr)
+        assert stats['pca']['calls']==2*len(HMFemu.z_arr)
+        assert stats['pca']['nodes'][0.]['calls']==2
+        # All redshifts are evaluated by the stacked GP at once
+        assert stats['gp']['calls']==2
+        assert stats['draws']['calls']==len(HMFemu.z_arr)
+        assert stats['validate']['nodes']=={}
+
+        HMFemu.stats.reset()
+        assert HMFemu.stats.as_dict()=={}
+
+
+    def test_float32(self):
+        data_path = os.path.dirname(os.path.abspath(inspect.stack()[0][1]))
+
+        HMFemu = MiraTitanHMFemulator.Emulator()
+        HMFemu_32 = MiraTitanHMFemulator.Emulator(dtype=np.float32)
+        fiducial_cosmo = {'Ommh2': .3*.7**2,
+                          'Ombh2': .022,
+                          'Omnuh2': .006,
+                          'n_s': .96,
+                          'h': .7,
+                          'w_0': -1,
+                          'w_a': 0,
+                          'sigma_8': .8,
+                          }
+        ref = np.load(os.path.join(data_path, 'fid.npy'))
+
+        res = HMFemu_32.predict(fiducial_cosmo.copy(), self.z_arr, self.m_arr, get_errors=False)
+        assert np.allclose(res[0], ref, rtol=self.rtol_float32, atol=0)
+        res = HMFemu_32.predict_batch([fiducial_cosmo]*2, self.z_arr, self.m_arr, get_errors=False)
+        assert np.allclose(res[0], ref, rtol=self.rtol_float32, atol=0)
+        res = HMFemu_32.predict_with_gradient(fiducial_cosmo.copy(), self.z_arr, self.m_arr)
+        assert np.allclose(res[0], ref, rtol=self.rtol_float32, atol=0)
+
+        # Same random numbers, errors agree with double precision
+        for error_method in ['sample', 'analytic']:
+            res = HMFemu.predict(fiducial_cosmo.copy(), self.z_arr, self.m_arr, rng=1, error_method=error_method)
+            res_32 = HMFemu_32.predict(fiducial_cosmo.copy(), self.z_arr, self.m_arr, rng=1, error_method=error_method)
+            assert np.allclose(res_32[1], res[1], rtol=10*self.rtol_float32, atol=1e-6)
+
+        # Single precision output of the raw emulator
+        res = HMFemu_32.predict_raw_emu(fiducial_cosmo.copy(), N_draw=10, return_draws=True, rng=1)
+        assert res[0.]['HMF'].dtype==np.float32
+        assert res[0.]['HMF_draws'].dtype==np.float32
+
+        with pytest.raises(ValueError):
+            MiraTitanHMFemulator.Emulator(dtype=np.int32)
+
+
+    def test_normalize(self):
+        HMFemu = MiraTitanHMFemulator.Emulator()
+        fiducial_cosmo = {'Ommh2': .3*.7**2,
+                          'Ombh2': .022,
+                          'Omnuh2': .006,
+                          'n_s': .96,
+                          'h': .7,
+                          'w_0': -1,
+                          'w_a': 0,
+                          'sigma_8': .8,
+                          }
+        theta = np.array([[fiducial_cosmo[param] for param in HMFemu.input_param_names]]*4)
+        theta[1,HMFemu.input_param_names.index('w_a')] = 1.5
+        theta[2,HMFemu.input_param_names.index('h')] = .9
+        theta[3,HMFemu.input_param_names.index('Omnuh2')] = np.nan
+        _theta = theta.copy()
+
+        x, valid = HMFemu.normalize(theta)
+        assert np.all(theta[:3]==_theta[:3])
+        assert x.shape==(4, 8)
+        assert np.all(valid==[True, False, False, False])
+        x_0, valid_0 = HMFemu.normalize(theta[0])
+        assert x_0.shape==(8,) and valid_0
+        assert np.all(x_0==x[0])
+
+        # Same as the dictionary path
+        res = HMFemu.predict_normalized(x[:1], self.z_arr, self.m_arr, get_errors=False)[0]
+        ref = HMFemu.predict(fiducial_cosmo.copy(), self.z_arr, self.m_arr, get_errors=False)[0]
+        assert np.all(np.isclose(res[0], ref))
+        res = HMFemu.predict_normalized(x[:1], self.z_arr, self.m_arr, N_draw=100, rng=1)[1]
+        ref = HMFemu.predict(fiducial_cosmo.copy(), self.z_arr, self.m_arr, N_draw=100, rng=1)[1]
+        assert np.all(np.isclose(res[0], ref))
+
+        for i in range(1, 4):
+            with pytest.raises(ValueError):
+                HMFemu.predict_batch(theta[i:i+1], self.z_arr, self.m_arr, get_errors=False)
+        with pytest.raises(ValueError):
+            HMFemu.normalize(theta[:,:7])
+        with pytest.raises(ValueError):
+            HMFemu.predict_normalized(x[0], self.z_arr, self.m_arr)
+
+
+    def test_import_time(self):
+        package_path = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(inspect.stack()[0][1]))))
+        script = "; ".join(["import sys, time",
+                            "import numpy",
+                            "start = time.time()",
+                            "import MiraTitanHMFemulator",
+                            "import_time = time.time() - start",
+                            "MiraTitanHMFemulator.Emulator(lazy=True)",
+                            "sys.stdout.write('%r %d' % (import_time, 'scipy' in sys.modules))"])
+        output = subprocess.check_output([sys.executable, '-c', script], cwd=package_path)
+        import_time, scipy_loaded = output.decode().split()
+        import_time, scipy_loaded = float(import_time), bool(int(scipy_loaded))
+        print("Import time %.4f s"%import_time)
+        assert import_time<self.max_import_time
+        # scipy is only loaded once a GP is set up or evaluated
+        assert not scipy_loaded
+
+
+    def test_shared(self):
+        cosmologies = np.array([[.3*.7**2, .022, .006, .96, .7, .8, -1, 0],
+                                [.14, .022, .004, .95, .65, .75, -.9, -.2]])
+
+        for dtype in [np.float64, np.float32]:
+            HMFemu = MiraTitanHMFemulator.Emulator(dtype=dtype)
+            with HMFemu.to_shared() as handle:
+                handle = pickle.loads(pickle.dumps(handle))
+                assert os.path.isfile(handle.filename)
+                HMFemu_shared = MiraTitanHMFemulator.Emulator.attach(handle, memo_size=2)
+                for error_method in ['sample', 'analytic']:
+                    ref = HMFemu.predict_batch(cosmologies, self.z_arr, self.m_arr, N_draw=100, rng=1, error_method=error_method)
+                    res = HMFemu_shared.predict_batch(cosmologies, self.z_arr, self.m_arr, N_draw=100, rng=1, error_method=error_method)
+                    assert np.all(res[0]==ref[0])
+                    assert np.all(res[1]==ref[1])
+                assert HMFemu_shared.memo_info()['max_size']==2
+                if os.name=='nt':
+                    # Windows cannot delete a file that is still mapped
+                    del HMFemu_shared
+                    gc.collect()
+            assert not os.path.exists(handle.filename)
+
+            # On POSIX systems, the attached emulator keeps working after the
+            # file is deleted
+            if os.name!='nt':
+                res = HMFemu_shared.predict_batch(cosmologies, self.z_arr, self.m_arr, get_errors=False)
+                assert np.all(res[0]==ref[0])
+
+
+    def test_counts(self):
+        from scipy import integrate
+
+        HMFemu = MiraTitanHMFemulator.Emulator()
+        cosmo = {'Ommh2': .3*.7**2,
+                 'Ombh2': .022,
+                 'Omnuh2': .006,
+                 'n_s': .96,
+                 'h': .7,
+                 'w0': -.9,
+                 'wa': -.3,
+                 'sigma8': .8,
+                 }
+
+        # Comoving distance
+        z = np.array([.1, .5, 1., 2.])
+        D_C = [counts.HUBBLE_DISTANCE * integrate.quad(lambda x: 1/counts.E_z(cosmo, x), 0, this_z)[0] for this_z in z]
+        assert np.allclose(counts.comoving_distance(cosmo, z), D_C, rtol=1e-10, atol=0)
+
+        # Counts, compared to a brute-force integration on a fine grid
+        z_edges = [.1, .4, 1.]
+        log10_M_edges = [14, 14.3, 14.7, 15.5]
+        engine = MiraTitanHMFemulator.Counts(HMFemu, z_edges, log10_M_edges)
+        N, cov = engine.predict(cosmo.copy())
+        assert N.shape==(2, 3)
+        assert cov.shape==(6, 6)
+        assert np.allclose(cov, cov.T)
+        assert np.all(np.linalg.eigvalsh(cov)>-1e-10*np.max(cov))
+
+        z_fine = np.linspace(.1, 1., 1801)
+        log10_M_fine = np.linspace(14, 15.5, 1501)
+        HMF = HMFemu.predict(cosmo.copy(), z_fine, 10**log10_M_fine, get_errors=False)[0]
+        integrand = 4*np.pi * counts.comoving_volume_element(cosmo, z_fine)[:,None] * HMF
+        trapz = lambda f, x: np.sum(.5 * (f[...,1:] + f[...,:-1]) * np.diff(x), axis=-1)
+        for i in range(2):
+            for j in range(3):
+                i_z = (z_fine>=z_edges[i]-1e-9) & (z_fine<=z_edges[i+1]+1e-9)
+                i_M = (log10_M_fine>=log10_M_edges[j]-1e-9) & (log10_M_fine<=log10_M_edges[j+1]+1e-9)
+                ref = trapz(trapz(integrand[i_z][:,i_M], np.log(10)*log10_M_fine[i_M]), z_fine[i_z])
+                assert np.isclose(N[i,j], ref, rtol=1e-4, atol=0)
+
+        # Selection and solid angle
+        engine = MiraTitanHMFemulator.Counts(HMFemu, z_edges, log10_M_edges, solid_angle=np.pi,
+                                             selection=lambda z, log10_M: .5*np.ones(np.broadcast(z, log10_M).shape))
+        assert np.allclose(engine.predict(cosmo.copy(), get_covariance=False)[0], N/8)
+
+        # In a narrow bin, the relative variance of the counts is that of the
+        # mass function
+        engine = MiraTitanHMFemulator.Counts(HMFemu, [.1005, .1015], [14.0005, 14.0015])
+        N, cov = engine.predict(cosmo.copy())
+        res = HMFemu.predict_raw_emu(cosmo.copy(), error_method='analytic')[.101]['HMF_std'][1001]
+        assert np.isclose(np.sqrt(cov[0,0])/N[0,0], res, rtol=1e-2)
+
+        with pytest.raises(ValueError):
+            MiraTitanHMFemulator.Counts(HMFemu, [.5, .1], log10_M_edges)
+        with pytest.raises(ValueError):
+            MiraTitanHMFemulator.Counts(HMFemu, [0, 3], log10_M_edges)
+
+
+    def test_mass_window(self):
+        HMFemu = MiraTitanHMFemulator.Emulator()
+        fiducial_cosmo = {'Ommh2': .3*.7**2,
+                          'Ombh2': .022,
+                          'Omnuh2': .006,
+                          'n_s': .96,
+                          'h': .7,
+                          'w_0': -1,
+                          'w_a': 0,
+                          'sigma_8': .8,
+                          }
+
+        full = HMFemu.predict_raw_emu(fiducial_cosmo.copy(), error_method='analytic')
+        res = HMFemu.predict_raw_emu(fiducial_cosmo.copy(), error_method='analytic', log10_M_range=(14.3005, 15.5))
+        for emu_z in HMFemu.z_arr:
+            assert res[emu_z]['log10_M'][0]==14.3
+            assert np.isclose(res[emu_z]['log10_M'][-1], min(15.5, full[emu_z]['log10_M'][-1]))
+            idx = np.searchsorted(full[emu_z]['log10_M'], res[emu_z]['log10_M'])
+            for key in ['HMF', 'HMF_std']:
+                assert np.allclose(res[emu_z][key], full[emu_z][key][idx], rtol=1e-12, atol=0)
+
+        # The window of the plan
+        m_arr = np.logspace(14.3, 15.5, 11)
+        plan = HMFemu.evaluation_plan(self.z_arr, m_arr)
+        assert plan.M_window[0]==1300 and plan.M_window[1] in [2501, 2502]
+        std_normals = HMFemu.draw_standard_normals(100, rng=1)
+        for error_method in ['sample', 'analytic']:
+            res = HMFemu.predict_raw_emu(fiducial_cosmo.copy(), N_draw=100, std_normals=std_normals,
+                                         error_method=error_method)
+            # Interpolate the full tables
+            HMF_table = np.log(np.nextafter(0,1)) * np.ones((len(HMFemu.z_arr), len(HMFemu.log10_M_arr)))
+            HMFerr_table = np.zeros((len(HMFemu.z_arr), len(HMFemu.log10_M_arr)))
+            for i,emu_z in enumerate(HMFemu.z_arr_asc):
+                HMF_table[i,:len(res[emu_z]['HMF'])] = np.log(res[emu_z]['HMF'])
+                HMFerr_table[i,:len(res[emu_z]['HMF'])] = res[emu_z]['HMF_std']
+            ref = np.exp(plan.interpolate(HMF_table)), plan.combine_errors(HMFerr_table)
+            res = HMFemu.predict(fiducial_cosmo.copy(), plan=plan, N_draw=100, std_normals=std_normals,
+                                 error_method=error_method)
+            assert np.allclose(res[0], ref[0], rtol=1e-12, atol=0)
+            assert np.allclose(res[1], ref[1], rtol=1e-10, atol=0)
+            res = HMFemu.predict_batch([fiducial_cosmo], plan=plan, N_draw=100, std_normals=std_normals,
+                                       error_method=error_method)
+            assert np.allclose(res[0][0], ref[0], rtol=1e-12, atol=0)
+            assert np.allclose(res[1][0], ref[1], rtol=1e-10, atol=0)
+
+        with pytest.raises(ValueError):
+            HMFemu.predict_raw_emu(fiducial_cosmo.copy(), log10_M_range=(15, 14))
+        for log10_M_range in [(16.5, 17), (12, 14)]:
+            with pytest.raises(ValueError):
+                HMFemu.predict_raw_emu(fiducial_cosmo.copy(), log10_M_range=log10_M_range)
+
+        # Memoized outputs are reused for other mass grids
+        HMFemu = MiraTitanHMFemulator.Emulator(memo_size=2)
+        res = [HMFemu.predict(fiducial_cosmo.copy(), self.z_arr, m, N_draw=100)
+               for m in [m_arr, m_arr[2:5], np.logspace(13.5, 15.5, 11)]]
+        info = HMFemu.memo_info()
+        assert (info['hits'], info['misses'], info['size'])==(2, 1, 1)
+        assert np.allclose(res[1][0], res[0][0][:,2:5], rtol=1e-12, atol=0)
+        assert np.allclose(res[1][1], res[0][1][:,2:5], rtol=1e-12, atol=0)
+        ref = MiraTitanHMFemulator.Emulator().predict(fiducial_cosmo.copy(), self.z_arr, np.logspace(13.5, 15.5, 11),
+                                                      get_errors=False)
+        assert np.allclose(res[2][0], ref[0], rtol=1e-12, atol=0)
+
+
+    def test_stream(self, tmpdir):
+        HMFemu = MiraTitanHMFemulator.Emulator()
+        cosmologies = np.array([[.3*.7**2, .022, .006, .96, .7, .8, -1, 0],
+                                [.14, .022, .004, .95, .65, .75, -.9, -.2],
+                                [.13, .023, .002, 1., .75, .85, -1.1, .1],
+                                [.145, .0225, .005, .9, .6, .8, -1, -.1],
+                                [.135, .022, .008, 1., .7, .72, -.8, -.3]])
+        chain_filename = str(tmpdir.join('chain.npy'))
+        np.save(chain_filename, cosmologies)
+        ref = HMFemu.predict_batch(cosmologies, self.z_arr, self.m_arr, error_method='analytic')
+
+        output_dir = str(tmpdir.join('output'))
+        res = stream.evaluate_chain(HMFemu, chain_filename, output_dir, self.z_arr, self.m_arr, chunk_size=2,
+                                    error_method='analytic')
+        assert np.allclose(res[0], ref[0], rtol=1e-12, atol=0)
+        assert np.allclose(res[1], ref[1], rtol=1e-10, atol=1e-12)
+        assert np.all(np.load(os.path.join(output_dir, 'z.npy'))==self.z_arr)
+
+        # Interrupt after the first chunk and resume
+        ref = stream.evaluate_chain(HMFemu, cosmologies, str(tmpdir.join('ref')), self.z_arr, self.m_arr,
+                                    chunk_size=2, N_draw=50, seed=1)
+        def interrupt(stop, N):
+            raise KeyboardInterrupt
+        output_dir = str(tmpdir.join('resumed'))
+        with pytest.raises(KeyboardInterrupt):
+            stream.evaluate_chain(HMFemu, cosmologies, output_dir, self.z_arr, self.m_arr, chunk_size=2,
+                                  N_draw=50, seed=1, callback=interrupt)
+        progress = []
+        res = stream.evaluate_chain(HMFemu, cosmologies, output_dir, self.z_arr, self.m_arr, chunk_size=2,
+                                    N_draw=50, seed=1, callback=lambda stop, N: progress.append((stop, N)))
+        assert progress==[(4, 5), (5, 5)]
+        assert np.all(res[0]==ref[0])
+        assert np.all(res[1]==ref[1])
+
+        # A finished evaluation returns the existing results
+        progress = []
+        res = stream.evaluate_chain(HMFemu, cosmologies, output_dir, self.z_arr, self.m_arr, chunk_size=2,
+                                    N_draw=50, seed=1, callback=lambda stop, N: progress.append((stop, N)))
+        assert progress==[]
+        assert np.all(res[0]==ref[0])
+        assert np.all(res[1]==ref[1])
+
+        # A checkpoint with different settings is not used
+        with pytest.raises(ValueError):
+            stream.evaluate_chain(HMFemu, cosmologies, output_dir, self.z_arr, self.m_arr, chunk_size=3,
+                                  N_draw=50, seed=1)
+        res = stream.evaluate_chain(HMFemu, cosmologies, output_dir, self.z_arr, self.m_arr, chunk_size=3,
+                                    get_errors=False, resume=False)
+        assert np.allclose(res[0], ref[0], rtol=1e-12, atol=0)
+        assert res[1] is None
+
+
+    def test_cli(self, tmpdir, capsys):
+        HMFemu = MiraTitanHMFemulator.Emulator()
+        cosmologies = np.array([[.3*.7**2, .022, .006, .96, .7, .8, -1, 0],
+                                [.14, .022, .004, .95, .65, .75, -.9, -.2],
+                                [.13, .023, .002, 1., .75, .85, -1.1, .1]])
+        ref = HMFemu.predict_batch(cosmologies, self.z_arr, self.m_arr, error_method='analytic')
+
+        csv_filename = str(tmpdir.join('cosmologies.csv'))
+        np.savetxt(csv_filename, cosmologies, delimiter=',', header='Ommh2,Ombh2,Omnuh2,ns,h,sigma8,w0,wa', comments='')
+        npy_filename = str(tmpdir.join('cosmologies.npy'))
+        np.save(npy_filename, cosmologies)
+        m_filename = str(tmpdir.join('m.txt'))
+        np.savetxt(m_filename, self.m_arr)
+        z = ','.join('%r'%float(z) for z in self.z_arr)
+
+        output = str(tmpdir.join('hmf.npz'))
+        assert cli.main(['eval', csv_filename, '--z', z, '--m-file', m_filename, '-o', output,
+                         '--error-method', 'analytic', '--chunk-size', '2'])==0
+        res = np.load(output)
+        assert np.allclose(res['HMF'], ref[0], rtol=1e-12, atol=0)
+        assert np.allclose(res['HMF_err'], ref[1], rtol=1e-10, atol=1e-12)
+        assert np.all(res['z']==self.z_arr)
+        out = capsys.readouterr().out
+        assert 'cosmologies/s' in out
+        assert 'gp' in out
+
+        output = str(tmpdir.join('hmf.npy'))
+        assert cli.main(['eval', npy_filename, '--z', z, '--m-file', m_filename, '-o', output,
+                         '--no-errors', '--workers', '2'])==0
+        assert np.allclose(np.load(output), ref[0], rtol=1e-12, atol=0)
+        assert not os.path.exists(str(tmpdir.join('hmf_err.npy')))
+
+        # Invalid input
+        assert cli.main(['eval', npy_filename, '--m-file', m_filename, '-o', output])==2
+        assert cli.main(['eval', npy_filename, '--z', '3', '--m-file', m_filename, '-o', output])==2
+
+
+    def test_session(self):
+        HMFemu = MiraTitanHMFemulator.Emulator()
+        fiducial_cosmo = {'Ommh2': .3*.7**2,
+                          'Ombh2': .022,
+                          'Omnuh2': .006,
+                          'n_s': .96,
+                          'h': .7,
+                          'w_0': -1,
+                          'w_a': 0,
+                          'sigma_8': .8,
+                          }
+        session = HMFemu.session(refresh_interval=5)
+
+        # One-parameter moves, a two-parameter move (w_a enters w_b), a
+        # repeated cosmology, and a move of all parameters
+        cosmologies = [fiducial_cosmo.copy()]
+        for param, value in [('sigma_8', .75), ('sigma_8', .85), ('h', .65), ('w_a', -.3), ('w_a', -.3),
+                             ('Ommh2', .13), ('n_s', .9), ('Omnuh2', .002), ('Ombh2', .0225)]:
+            cosmologies.append(dict(cosmologies[-1], **{param: value}))
+        cosmologies.append({'Ommh2': .14, 'Ombh2': .022, 'Omnuh2': .004, 'n_s': .95, 'h': .65, 'w_0': -.9,
+                            'w_a': -.2, 'sigma_8': .75})
+        plan = HMFemu.evaluation_plan(self.z_arr, self.m_arr)
+        for cosmo in cosmologies:
+            res = session.predict_raw_emu(cosmo.copy(), error_method='analytic')
+            ref = HMFemu.predict_raw_emu(cosmo.copy(), error_method='analytic')
+            for emu_z in HMFemu.z_arr:
+                for key in ['HMF', 'HMF_std']:
+                    assert np.allclose(res[emu_z][key], ref[emu_z][key], rtol=1e-9, atol=0)
+            res = session.predict(cosmo.copy(), plan=plan, N_draw=20, rng=3)
+            ref = HMFemu.predict(cosmo.copy(), plan=plan, N_draw=20, rng=3)
+            assert np.allclose(res[0], ref[0], rtol=1e-9, atol=0)
+            assert np.allclose(res[1], ref[1], rtol=1e-9, atol=0)
+        # The first cosmology, the refresh after 5 updates, and the last
+        # cosmology are computed from scratch
+        assert session.counts=={'full': 3, 'incremental': 7, 'unchanged': len(cosmologies)+1}
+
+        session.reset()
+        assert session.counts=={'full': 0, 'incremental': 0, 'unchanged': 0}
+        with pytest.raises(ValueError):
+            MiraTitanHMFemulator.Emulator(lazy=True).predict_raw_emu(fiducial_cosmo.copy(), session=session)
+
+
+    def test_draw_statistics(self, tmpdir):
+        # Streaming statistics match the statistics of all finite rows
+        rng = np.random.RandomState(3)
+        rows = rng.lognormal(size=(100, 5))
+        rows[[3, 40, 41]] = np.inf
+        running = sampling.RunningStatistics(5)
+        for start, stop in sampling.iter_chunks(len(rows), 17):
+            running.update(rows[start:stop])
+        finite_rows = rows[np.all(np.isfinite(rows), axis=1)]
+        assert running.count==97
+        assert np.allclose(running.mean, np.mean(finite_rows, axis=0), rtol=1e-14, atol=0)
+        assert np.allclose(running.std(), np.std(finite_rows, axis=0), rtol=1e-12, atol=0)
+        assert np.all(np.isnan(sampling.RunningStatistics(5).std()))
+
+        # Draws do not depend on the chunk size
+        fiducial_cosmo = {'Ommh2': .3*.7**2,
+                          'Ombh2': .022,
+                          'Omnuh2': .006,
+                          'n_s': .96,
+                          'h': .7,
+                          'w_0': -1,
+                          'w_a': 0,
+                          'sigma_8': .8,
+                          }
+        HMFemu = MiraTitanHMFemulator.Emulator()
+        HMFemu_chunked = MiraTitanHMFemulator.Emulator(draw_chunk_size=7)
+        for rng in [None, 5]:
+            res = []
+            for emu in [HMFemu, HMFemu_chunked]:
+                np.random.seed(1328)
+                res.append(emu.predict_raw_emu(fiducial_cosmo.copy(), N_draw=50, return_draws=True, rng=rng))
+            for emu_z in HMFemu.z_arr:
+                for key in ['HMF_draws', 'HMF_mean', 'HMF_std']:
+                    assert np.allclose(res[0][emu_z][key], res[1][emu_z][key], rtol=1e-12, atol=0)
+
+        # Draws spilled to memory-mapped files
+        draws_dir = str(tmpdir)
+        res_file = HMFemu_chunked.predict_raw_emu(fiducial_cosmo.copy(), N_draw=50, return_draws=True, rng=5,
+                                                  draws_dir=draws_dir)
+        for i,emu_z in enumerate(HMFemu.z_arr):
+            assert isinstance(res_file[emu_z]['HMF_draws'], np.memmap)
+            assert os.path.isfile(os.path.join(draws_dir, 'HMF_draws_%d.npy'%i))
+            for key in ['HMF_draws', 'HMF_mean', 'HMF_std']:
+                assert np.all(res_file[emu_z][key]==res[1][emu_z][key])
+
+        std_normals = HMFemu.draw_standard_normals(50, rng=2)
+        plan = HMFemu.evaluation_plan(self.z_arr, self.m_arr)
+        res = [emu.predict(fiducial_cosmo.copy(), plan=plan, N_draw=50, std_normals=std_normals)
+               for emu in [HMFemu, HMFemu_chunked]]
+        assert np.allclose(res[0][1], res[1][1], rtol=1e-12, atol=0)
+
+        # Truncation of spilled draws
+        filename = os.path.join(draws_dir, 'rows.npy')
+        np.save(filename, rows)
+        sampling.truncate_rows(filename, 30, chunk_size=7)
+        assert np.all(np.load(filename)==rows[:30])
+
+        with pytest.raises(ValueError):
+            MiraTitanHMFemulator.Emulator(lazy=True, draw_chunk_size=0)
+
+
+    def test_training(self, tmpdir):
+        data_path = os.path.join(os.path.dirname(MiraTitanHMFemulator.__file__), 'data')
+        load = lambda name: np.load(os.path.join(data_path, '%s.npy'%name))
+        design = load('params_design_w0wb')[:40]
+        means = load('means')[:,:40]
+        hyperparams = load('hyperparams')
+        N_PC = means.shape[2]
+
+        # Analytic gradient of the log-likelihood
+        rng = np.random.RandomState(4)
+        sq_dist = (design[:,None,:] - design[None,:,:])**2
+        cov_n = 1e-4 * np.eye(len(design))
+        params = training.hyperparams_to_params(2., rng.uniform(.3, .9, size=design.shape[1]))
+        value, gradient = training.lnlike(params, sq_dist, means[0,:,0], cov_n)
+        for d in range(len(params)):
+            step = np.zeros(len(params))
+            step[d] = 1e-6
+            numerical = (training.lnlike(params+step, sq_dist, means[0,:,0], cov_n, get_gradient=False)
+                         - training.lnlike(params-step, sq_dist, means[0,:,0], cov_n, get_gradient=False)) / 2e-6
+            assert np.isclose(gradient[d], numerical, rtol=1e-5, atol=1e-6)
+
+        # Equals the log-likelihood of the GP for noise that is block diagonal
+        # in the PCs
+        prec_f = hyperparams[0,:2]
+        rho = hyperparams[0,N_PC:].reshape(N_PC, -1)[:2]
+        GP = GP_matrix.GaussianProcess(design, means[0,:,:2], 1e-4*np.eye(2*len(design)), prec_f, rho,
+                                       compute_lnlike=True)
+        lnlike = sum(training.lnlike(training.hyperparams_to_params(prec_f[i], rho[i]), sq_dist, means[0,:,i],
+                                     cov_n, get_gradient=False) for i in range(2))
+        assert np.isclose(lnlike, GP.lnlike, rtol=1e-10)
+
+        # The fit improves on its starting points
+        fit_prec_f, fit_rho, fit_lnlike = training.fit_GP(design, means[0,:,0], cov_n, maxiter=200)
+        assert fit_rho.shape==(design.shape[1],)
+        for prec_f, rho in training.DEFAULT_STARTS:
+            start = training.hyperparams_to_params(prec_f, rho*np.ones(design.shape[1]))
+            assert fit_lnlike>=training.lnlike(start, sq_dist, means[0,:,0], cov_n, get_gradient=False)
+
+        # Fits on a pool of processes equal those in this process
+        cov_n_all = 1e-4 * np.eye(N_PC*len(design))[None,:,:]
+        res = [training.fit_hyperparameters(design, means[:1], cov_n_all, N_workers=N_workers, maxiter=20)
+               for N_workers in [1, 2]]
+        assert np.allclose(res[0][0], res[1][0], rtol=1e-8, atol=0)
+        assert np.allclose(res[0][1], res[1][1], rtol=1e-10, atol=0)
+
+        # Retrained emulator reproduces the design mass functions
+        N_M = 300
+        log_HMF = []
+        for z_id in range(len(MiraTitanHMFemulator.Emulator.z_arr)):
+            PCA = load('PCA_mean_std_transform_%d'%z_id)[:,:N_M]
+            weights = means[z_id] * load('GP_params_std')[z_id] + load('GP_params_mean')[z_id]
+            log_HMF.append(np.dot(weights, PCA[1:]) + PCA[0])
+        output_dir = str(tmpdir)
+        lnlikes = training.build_data_dir(output_dir, design, log_HMF, N_workers=1, maxiter=50)
+        assert lnlikes.shape==(len(log_HMF), N_PC)
+        assert np.all(np.isfinite(lnlikes))
+        HMFemu = MiraTitanHMFemulator.Emulator(data_path=output_dir)
+        m_arr = 10**HMFemu.log10_M_arr[:N_M:50]
+        HMF = HMFemu.predict_normalized(design[:5], HMFemu.z_arr, m_arr, get_errors=False)[0]
+        for z_id in range(len(log_HMF)):
+            assert np.allclose(HMF[:,z_id], np.exp(log_HMF[z_id][:5,:N_M:50]), rtol=1e-3, atol=0)
+
+        with pytest.raises(ValueError):
+            training.build_data_dir(output_dir, design[:,:7], log_HMF)
+        with pytest.raises(ValueError):
+            training.build_data_dir(output_dir, design, log_HMF[:7])
+        with pytest.raises(ValueError):
+            training.build_data_dir(output_dir, design, [x[:10] for x in log_HMF])
@@ -0,0 +1,326 @@
+"""Training of the emulator from a suite of simulated mass functions.
+
+`build_data_dir` writes a data directory for `Emulator(data_path=...)`:
+
+1. For every emulator redshift, a principal component analysis (PCA) of the
+   log of the mass functions of the design cosmologies yields the basis
+   functions and the PC weights of each cosmology. The weights are
+   standardized to zero mean and unit variance.
+2. The uncertainty of the simulated mass functions (if provided) is projected
+   onto the standardized weights, which gives the noise covariance `cov_n`.
+3. The GP hyperparameters (precision `prec_f` and correlation lengths `rho`)
+   of every redshift and PC are fit by maximizing the marginal likelihood,
+   in parallel.
+
+The hyperparameters of each PC are fit with the block of the noise covariance
+that belongs to this PC, such that the fits of all redshifts and PCs are
+independent. The emulator itself uses the full noise covariance.
+"""
+import os
+
+import numpy as np
+
+from .GP_matrix import GaussianProcess
+from .MiraTitanHMFemulator import Emulator
+
+# Bounds of the fit parameters log(prec_f) and log(-log(rho))
+LOG_PREC_F_BOUNDS = (-10., 10.)
+LOG_LOG_RHO_BOUNDS = (-12., 5.)
+
+# Starting points (prec_f, rho) of the hyperparameter fits
+DEFAULT_STARTS = [(1., .3), (1., .5), (1., .8)]
+
+
+def hyperparams_to_params(prec_f, rho):
+    """Fit parameters [1+N_dim_input], log(prec_f) and log(-log(rho)), of
+    the GP of one PC. The parametrization keeps rho within (0, 1)."""
+    return np.concatenate(([np.log(prec_f)], np.log(-np.log(rho))))
+
+
+def params_to_hyperparams(params):
+    """Inverse of `hyperparams_to_params`, returns (prec_f, rho)."""
+    return np.exp(params[0]), np.exp(-np.exp(params[1:]))
+
+
+def lnlike(params, sq_dist, y, cov_n, get_gradient=True):
+    """Log marginal likelihood of the GP of one PC (up to a constant, as
+    `GaussianProcess.lnlike`) and its gradient with respect to the fit
+    parameters (see `hyperparams_to_params`).
+
+    The covariance of the design values is K = C/prec_f + cov_n with the
+    correlation C = prod(rho**(4*d**2)). With alpha = K^-1 y, the gradient is
+    0.5 tr((alpha alpha^T - K^-1) dK/dparam), where dK/dlog(prec_f) = -C/prec_f
+    and dK/dlog(-log(rho_d)) = 4 log(rho_d) d_d**2 C/prec_f. The Cholesky
+    decomposition of K is computed once for both.
+
+    :param params: Fit parameters [1+N_dim_input].
+    :type params: array
+
+    :param sq_dist: Squared distances between the design points along each
+        input dimension [N_data, N_data, N_dim_input].
+    :type sq_dist: array
+
+    :param y: Standardized design values of the PC [N_data].
+    :type y: array
+
+    :param cov_n: Noise covariance of `y` [N_data, N_data].
+    :type cov_n: array
+
+    :returns: The log-likelihood and, if `get_gradient`, its gradient
+        [1+N_dim_input].
+    """
+    from scipy import linalg
+
+    prec_f = np.exp(params[0])
+    log_rho = -np.exp(params[1:])
+    corr = GaussianProcess.corr_from_sq_dist(sq_dist, log_rho[None,:])[0] / prec_f
+    cholesky_factor = linalg.cho_factor(corr + cov_n, lower=True)
+    alpha = linalg.cho_solve(cholesky_factor, y)
+    value = -.5 * np.dot(y, alpha) - np.sum(np.log(np.diag(cholesky_factor[0])))
+    if not get_gradient:
+        return value
+
+    W = np.outer(alpha, alpha) - linalg.cho_solve(cholesky_factor, np.eye(len(y)))
+    W_corr = W * corr
+    gradient = np.empty(len(params))
+    gradient[0] = -.5 * np.sum(W_corr)
+    gradient[1:] = 2 * log_rho * np.einsum('ab,abd->d', W_corr, sq_dist)
+    return value, gradient
+
+
+def fit_GP(x, y, cov_n, starts=None, maxiter=1000):
+    """Maximize the marginal likelihood of the GP of one PC over `prec_f`
+    and `rho` with L-BFGS-B and analytic gradients, from several starting
+    points. Starting points with `rho` close to 1, where the correlation
+    matrix is ill-conditioned, tend to end on the plateau rho -> 0.
+
+    :param x: Design points [N_data, N_dim_input].
+    :type x: array
+
+    :param y: Standardized design values of the PC [N_data].
+    :type y: array
+
+    :param cov_n: Noise covariance of `y` [N_data, N_data].
+    :type cov_n: array
+
+    :param starts: Starting points (prec_f, rho), where rho is a float or an
+        array [N_dim_input]. Default is `DEFAULT_STARTS`.
+    :type starts: list, optional
+
+    :param maxiter: Maximum number of iterations per starting point. Default
+        is 1000.
+    :type maxiter: int, optional
+
+    :returns: The best-fit `prec_f`, `rho` [N_dim_input], and the
+        log-likelihood.
+    :rtype: tuple
+    """
+    from scipy import optimize
+
+    if starts is None:
+        starts = DEFAULT_STARTS
+    sq_dist = GaussianProcess.compute_sq_dist(x, x)
+    bounds = [LOG_PREC_F_BOUNDS] + [LOG_LOG_RHO_BOUNDS] * x.shape[1]
+
+    def neg_lnlike(params):
+        value, gradient = lnlike(params, sq_dist, y, cov_n)
+        return -value, -gradient
+
+    best = None
+    for prec_f, rho in starts:
+        params = hyperparams_to_params(prec_f, rho*np.ones(x.shape[1]))
+        params = np.clip(params, *np.transpose(bounds))
+        result = optimize.minimize(neg_lnlike, params, jac=True, method='L-BFGS-B', bounds=bounds,
+                                   options={'maxiter': maxiter})
+        if best is None or result.fun<best.fun:
+            best = result
+    prec_f, rho = params_to_hyperparams(best.x)
+    return prec_f, rho, -best.fun
+
+
+def _fit_task(args):
+    return fit_GP(*args)
+
+
+def fit_hyperparameters(x, means, cov_n, N_workers=None, hyperparams=None, maxiter=1000):
+    """Fit the GP hyperparameters of all emulator redshifts and PCs (see
+    `fit_GP`) on a pool of processes.
+
+    :param x: Design points [N_data, N_dim_input].
+    :type x: array
+
+    :param means: Standardized design values [N_z, N_data, N_PC].
+    :type means: array
+
+    :param cov_n: Noise covariance [N_z, N_PC*N_data, N_PC*N_data] of the
+        design values in the order of `means[z].flatten(order='F')`. Only the
+        diagonal block of each PC enters its fit.
+    :type cov_n: array
+
+    :param N_workers: Number of processes. Defaults to the number of CPUs, 1
+        fits in this process.
+    :type N_workers: int, optional
+
+    :param hyperparams: Hyperparameters [N_z, N_PC+N_PC*N_dim_input] in the
+        format of the emulator data (`prec_f` of all PCs, followed by `rho` of
+        each PC) used as an additional starting point of the fits, e.g., from
+        a previous training.
+    :type hyperparams: array, optional
+
+    :param maxiter: Maximum number of iterations per fit and starting point.
+        Default is 1000.
+    :type maxiter: int, optional
+
+    :returns: The best-fit hyperparameters [N_z, N_PC+N_PC*N_dim_input] in
+        the format of the emulator data and the log-likelihood of each fit
+        [N_z, N_PC].
+    :rtype: tuple
+    """
+    N_z, N_data, N_PC = means.shape
+    N_dim_input = x.shape[1]
+    if cov_n.shape!=(N_z, N_PC*N_data, N_PC*N_data):
+        raise ValueError("Shape of cov_n %s must be (%d, %d, %d)"%(cov_n.shape, N_z, N_PC*N_data, N_PC*N_data))
+    tasks = []
+    for z_id in range(N_z):
+        for i in range(N_PC):
+            block = slice(i*N_data, (i+1)*N_data)
+            starts = list(DEFAULT_STARTS)
+            if hyperparams is not None:
+                starts.append((hyperparams[z_id,i], hyperparams[z_id,N_PC:].reshape(N_PC, N_dim_input)[i]))
+            tasks.append((x, means[z_id,:,i], cov_n[z_id][block,block], starts, maxiter))
+
+    if N_workers==1:
+        results = [_fit_task(task) for task in tasks]
+    else:
+        import multiprocessing
+
+        pool = multiprocessing.Pool(N_workers)
+        try:
+            results = pool.map(_fit_task, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    fit_hyperparams = np.zeros((N_z, N_PC*(1+N_dim_input)))
+    lnlikes = np.zeros((N_z, N_PC))
+    for k,(prec_f, rho, this_lnlike) in enumerate(results):
+        z_id, i = divmod(k, N_PC)
+        fit_hyperparams[z_id,i] = prec_f
+        fit_hyperparams[z_id,N_PC+i*N_dim_input:N_PC+(i+1)*N_dim_input] = rho
+        lnlikes[z_id,i] = this_lnlike
+    return fit_hyperparams, lnlikes
+
+
+def pca(log_HMF, N_PC):
+    """Principal component analysis of the log of the mass functions of the
+    design cosmologies [N_data, N_M].
+
+    :returns: The mean [N_M], the orthonormal basis functions [N_PC, N_M],
+        and the PC weights of the design cosmologies [N_data, N_PC], such that
+        log_HMF ~ mean + dot(weights, basis).
+    :rtype: tuple
+    """
+    PCA_mean = np.mean(log_HMF, axis=0)
+    _, _, basis = np.linalg.svd(log_HMF - PCA_mean, full_matrices=False)
+    basis = basis[:N_PC]
+    return PCA_mean, basis, np.dot(log_HMF - PCA_mean, basis.T)
+
+
+def build_data_dir(output_dir, design, log_HMF, N_PC=4, log_HMF_var=None, nugget=1e-6, facs=None,
+                   N_workers=None, hyperparams=None, maxiter=1000):
+    """Train the emulator and write its data to `output_dir`, which can then
+    be used with `Emulator(data_path=output_dir)`.
+
+    :param output_dir: Output directory, created if needed. Existing files
+        are overwritten.
+    :type output_dir: str
+
+    :param design: Normalized parameters of the design cosmologies
+        [N_data, 8] (see `Emulator.param_names` and `Emulator.normalize`).
+    :type design: array
+
+    :param log_HMF: For each emulator redshift `Emulator.z_arr`, the natural
+        log of the mass function dn/dlnM [(h/Mpc)^3] of the design cosmologies
+        [N_data, N_M] at the first N_M masses of `Emulator.log10_M_arr`. N_M
+        may differ between redshifts.
+    :type log_HMF: list
+
+    :param N_PC: Number of principal components. Default is 4.
+    :type N_PC: int, optional
+
+    :param log_HMF_var: For each emulator redshift, the variance of
+        `log_HMF` [N_data, N_M] (e.g., due to shot noise). Default is no
+        uncertainty.
+    :type log_HMF_var: list, optional
+
+    :param nugget: Variance added to the diagonal of the noise covariance of
+        the standardized PC weights, for numerical stability. Default is 1e-6.
+    :type nugget: float, optional
+
+    :param facs: Factors by which the GP covariance of each redshift is
+        scaled in the error estimates [N_z]. Default is 1.
+    :type facs: array, optional
+
+    :param N_workers: Number of processes for the hyperparameter fits, see
+        `fit_hyperparameters`.
+    :type N_workers: int, optional
+
+    :param hyperparams: Additional starting point of the hyperparameter
+        fits, see `fit_hyperparameters`.
+    :type hyperparams: array, optional
+
+    :param maxiter: Maximum number of iterations per fit and starting point.
+        Default is 1000.
+    :type maxiter: int, optional
+
+    :returns: The log-likelihood of the hyperparameter fit of each redshift
+        and PC [N_z, N_PC].
+    :rtype: array
+    """
+    design = np.asarray(design, dtype=float)
+    N_z = len(Emulator.z_arr)
+    N_data = len(design)
+    if design.ndim!=2 or design.shape[1]!=len(Emulator.param_names):
+        raise ValueError("design must have shape (N, %d) but has shape %s"%(len(Emulator.param_names), design.shape))
+    if len(log_HMF)!=N_z:
+        raise ValueError("log_HMF must be given for the %d emulator redshifts"%N_z)
+    if facs is None:
+        facs = np.ones(N_z)
+
+    GP_means = np.zeros((N_z, N_PC))
+    GP_std = np.zeros((N_z, N_PC))
+    means = np.zeros((N_z, N_data, N_PC))
+    cov_n = np.zeros((N_z, N_PC*N_data, N_PC*N_data))
+    PCA_tables = []
+    for z_id in range(N_z):
+        this_log_HMF = np.asarray(log_HMF[z_id], dtype=float)
+        if this_log_HMF.ndim!=2 or len(this_log_HMF)!=N_data or this_log_HMF.shape[1]>len(Emulator.log10_M_arr):
+            raise ValueError("log_HMF[%d] must have shape (%d, N_M) with N_M<=%d but has shape %s"%(
+                z_id, N_data, len(Emulator.log10_M_arr), this_log_HMF.shape))
+        PCA_mean, basis, weights = pca(this_log_HMF, N_PC)
+        PCA_tables.append(np.vstack((PCA_mean, basis)))
+        GP_means[z_id] = np.mean(weights, axis=0)
+        GP_std[z_id] = np.std(weights, axis=0)
+        means[z_id] = (weights - GP_means[z_id]) / GP_std[z_id]
+
+        # Noise covariance of the standardized weights; the PCs of one
+        # design cosmology are correlated, different cosmologies are not
+        if log_HMF_var is not None:
+            weights_cov = np.einsum('im,nm,jm->nij', basis, log_HMF_var[z_id], basis)
+            weights_cov/= GP_std[z_id][:,None] * GP_std[z_id][None,:]
+            for i in range(N_PC):
+                for j in range(N_PC):
+                    cov_n[z_id,i*N_data+np.arange(N_data),j*N_data+np.arange(N_data)] = weights_cov[:,i,j]
+        cov_n[z_id]+= nugget * np.eye(N_PC*N_data)
+
+    fit_hyperparams, lnlikes = fit_hyperparameters(design, means, cov_n, N_workers, hyperparams, maxiter)
+
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    arrays = {'GP_params_mean': GP_means, 'GP_params_std': GP_std, 'facs': np.asarray(facs, dtype=float),
+              'params_design_w0wb': design, 'hyperparams': fit_hyperparams, 'means': means, 'cov_n': cov_n}
+    for z_id in range(N_z):
+        arrays['PCA_mean_std_transform_%d'%z_id] = PCA_tables[z_id]
+    for name, array in arrays.items():
+        np.save(os.path.join(output_dir, '%s.npy'%name), array)
+    return lnlikes
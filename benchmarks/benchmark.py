@@ -0,0 +1,144 @@
+"""Benchmarks of the Mira-Titan HMF emulator.
+
+Run from the repository root (no network access required)::
+
+    python benchmarks/benchmark.py
+    python benchmarks/benchmark.py --compare benchmarks/results/0.1.1.json
+
+The timings [s] (and memory [MB]) are printed and written to
+`benchmarks/results/<version>.json`, such that they can be tracked across
+versions. With `--compare`, the ratios to an earlier set of results are
+printed as well. The accuracy of the accelerated code paths is checked by the
+test suite (`pytest`), not here.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import MiraTitanHMFemulator  # noqa: E402
+
+
+# Representative cosmologies: fiducial, center of the design, and near the
+# edges of the parameter space
+COSMOLOGIES = [
+    {'Ommh2': .3*.7**2, 'Ombh2': .022, 'Omnuh2': .006, 'n_s': .96, 'h': .7,
+     'w_0': -1, 'w_a': 0, 'sigma_8': .8},
+    {'Ommh2': .1375, 'Ombh2': .0225, 'Omnuh2': .005, 'n_s': .95, 'h': .7,
+     'w_0': -1, 'w_a': -.225, 'sigma_8': .8},
+    {'Ommh2': .153, 'Ombh2': .0216, 'Omnuh2': .0005, 'n_s': 1.04, 'h': .56,
+     'w_0': -.72, 'w_a': -1.2, 'sigma_8': .89},
+]
+
+# (len(z), len(m)) of the predict benchmarks
+GRIDS = [(1, 1), (10, 50), (50, 200)]
+
+
+def best_time(func, repeat, number=1):
+    """Best wall time of `func` [s] out of `repeat` repetitions."""
+    return min(timeit.repeat(func, repeat=repeat, number=number)) / number
+
+
+def run(repeat=5):
+    results = {}
+
+    # Initialization, without and with the on-disk cache
+    results['init'] = best_time(MiraTitanHMFemulator.Emulator, repeat)
+    cache_dir = tempfile.mkdtemp()
+    try:
+        MiraTitanHMFemulator.Emulator(cache_dir=cache_dir)
+        results['init_cached'] = best_time(lambda: MiraTitanHMFemulator.Emulator(cache_dir=cache_dir), repeat)
+    finally:
+        shutil.rmtree(cache_dir)
+    results['init_lazy'] = best_time(lambda: MiraTitanHMFemulator.Emulator(lazy=True), repeat)
+
+    HMFemu = MiraTitanHMFemulator.Emulator()
+
+    # Raw emulator
+    for N_draw in [0, 1000]:
+        results['predict_raw_emu N_draw=%d'%N_draw] = np.mean([
+            best_time(lambda: HMFemu.predict_raw_emu(cosmo.copy(), N_draw=N_draw, rng=0), repeat)
+            for cosmo in COSMOLOGIES])
+
+    # Full prediction as a function of the grid size and the error method
+    for N_z, N_m in GRIDS:
+        z = np.linspace(0, 2, N_z)
+        m = np.logspace(13, 15.5, N_m)
+        for label, kwargs in [('no errors', {'get_errors': False}),
+                              ('N_draw=1000', {'N_draw': 1000, 'rng': 0}),
+                              ('analytic', {'error_method': 'analytic'})]:
+            results['predict %dx%d %s'%(N_z, N_m, label)] = np.mean([
+                best_time(lambda: HMFemu.predict(cosmo.copy(), z, m, **kwargs), repeat)
+                for cosmo in COSMOLOGIES])
+
+    # Single precision
+    HMFemu_32 = MiraTitanHMFemulator.Emulator(dtype=np.float32)
+    z = np.linspace(0, 2, 10)
+    m = np.logspace(13, 15.5, 50)
+    results['predict 10x50 N_draw=1000 float32'] = np.mean([
+        best_time(lambda: HMFemu_32.predict(cosmo.copy(), z, m, N_draw=1000, rng=0), repeat)
+        for cosmo in COSMOLOGIES])
+
+    # Batch prediction, per cosmology
+    z = np.linspace(0, 2, 10)
+    m = np.logspace(13, 15.5, 50)
+    cosmologies = [COSMOLOGIES[i%len(COSMOLOGIES)] for i in range(100)]
+    results['predict_batch 10x50 no errors, per cosmology'] = best_time(
+        lambda: HMFemu.predict_batch(cosmologies, z, m, get_errors=False), repeat) / len(cosmologies)
+    results['predict_with_gradient 10x50'] = np.mean([
+        best_time(lambda: HMFemu.predict_with_gradient(cosmo.copy(), z, m), repeat)
+        for cosmo in COSMOLOGIES])
+
+    # Peak memory of the draws (tracemalloc requires python 3)
+    try:
+        import tracemalloc
+    except ImportError:
+        sys.stderr.write("tracemalloc is not available, skipping the memory benchmark\n")
+    else:
+        tracemalloc.start()
+        HMFemu.predict_raw_emu(COSMOLOGIES[0].copy(), N_draw=1000, return_draws=True, rng=0)
+        results['memory predict_raw_emu N_draw=1000 return_draws [MB]'] = tracemalloc.get_traced_memory()[1] / 1e6
+        tracemalloc.stop()
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--output', help="Output JSON file (default: benchmarks/results/<version>.json)")
+    parser.add_argument('--compare', help="JSON file of earlier results to compare to")
+    parser.add_argument('--repeat', type=int, default=5, help="Number of repetitions of each benchmark")
+    args = parser.parse_args(argv)
+
+    results = run(args.repeat)
+
+    reference = {}
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            reference = json.load(f)['results']
+    for key, value in results.items():
+        line = '%-60s %12.6g'%(key, value)
+        if key in reference:
+            line+= '   x%.3f'%(value/reference[key])
+        print(line)
+
+    output = args.output
+    if output is None:
+        output = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results',
+                              '%s.json'%MiraTitanHMFemulator.__version__)
+    if not os.path.isdir(os.path.dirname(os.path.abspath(output))):
+        os.makedirs(os.path.dirname(os.path.abspath(output)))
+    with open(output, 'w') as f:
+        json.dump({'version': MiraTitanHMFemulator.__version__,
+                   'numpy': np.__version__,
+                   'results': results}, f, indent=1)
+
+
+if __name__=='__main__':
+    main()
@@ -26,4 +26,5 @@ setuptools.setup(
         "Operating System :: OS Independent",
     ],
     install_requires = ['numpy', 'scipy'],
+    entry_points = {'console_scripts': ['miratitan-hmf = MiraTitanHMFemulator.cli:main']},
 )